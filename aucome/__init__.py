@@ -1,3 +1,17 @@
-from aucome import analysis, check, compare, spontaneous, reconstruction, orthology, utils, workflow, structural
-
-__version__='0.5.1'
+import importlib
+
+__version__='0.5.1'
+
+# The subcommand modules are imported when they are first used (aucome.check, aucome.compare, ...),
+# so the CLI does not import the dependencies of all the subcommands (matplotlib, pandas, seaborn, mpwt...) at startup.
+SUBMODULES = ['analysis', 'check', 'compare', 'spontaneous', 'reconstruction', 'orthology', 'orthologue_cache', 'reaction_matrix', 'utils', 'workflow', 'structural']
+
+
+def __getattr__(name):
+    if name in SUBMODULES:
+        return importlib.import_module('aucome.' + name)
+    raise AttributeError("module 'aucome' has no attribute '" + name + "'")
+
+
+def __dir__():
+    return sorted(list(globals()) + SUBMODULES)
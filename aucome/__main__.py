@@ -29,22 +29,25 @@ See 'aucome <command> -h' for more information on a specific command.
 import configparser
 import csv
 import docopt
+import importlib
 import logging
-import mpwt
 import os
-import pkg_resources
 import re
-import requests
 import shutil
 import subprocess
 import sys
 
-import aucome
-
 logging.basicConfig(format='%(message)s', level=logging.CRITICAL)
 logger = logging.getLogger(__name__)
 logging.getLogger("aucome").setLevel(logging.DEBUG)
 
+# k = subcommand, v = function parsing the arguments of the subcommand in the module aucome.<subcommand>.
+# The module of a subcommand is only imported when the subcommand is used.
+COMMAND_PARSERS = {'workflow': 'workflow_parse_args', 'check': 'check_parse_args',
+                   'reconstruction': 'reconstruction_parse_args', 'orthology': 'orthology_parse_args',
+                   'structural': 'structural_parse_args', 'spontaneous': 'spontaneous_parse_args',
+                   'analysis': 'analysis_parse_args', 'compare': 'compare_parse_args'}
+
 
 def main(args=None):
     args = docopt.docopt(__doc__, options_first=True)
@@ -76,39 +79,19 @@ def main(args=None):
         return
 
     if command:
-        if command not in ['workflow', 'check', 'reconstruction', 'orthology', 'spontaneous', 'structural', 'analysis', 'compare']:
+        if command not in COMMAND_PARSERS:
             sys.exit(command + ' not a valid command: workflow, check, reconstruction, orthology, spontaneous, structural, analysis, compare.')
 
+        command_module = importlib.import_module('aucome.' + command)
+
         if '-h' in command_args:
-            getattr(aucome, command).command_help()
+            command_module.command_help()
             sys.exit()
 
         # Add command to command_args to be parse by docopt.
         command_args.insert(0,command)
 
-        if command == 'workflow':
-            aucome.workflow.workflow_parse_args(command_args)
-
-        elif command == 'check':
-            aucome.check.check_parse_args(command_args)
-
-        elif command == 'reconstruction':
-            aucome.reconstruction.reconstruction_parse_args(command_args)
-        
-        elif command == 'orthology':
-            aucome.orthology.orthology_parse_args(command_args)
-
-        elif command == 'structural':
-            aucome.structural.structural_parse_args(command_args)
-
-        elif command == 'spontaneous':
-            aucome.spontaneous.spontaneous_parse_args(command_args)
-
-        elif command == 'analysis':
-            aucome.analysis.analysis_parse_args(command_args)
-
-        elif command == 'compare':
-            aucome.compare.compare_parse_args(command_args)
+        getattr(command_module, COMMAND_PARSERS[command])(command_args)
 
 
 def create_run(run_id):
@@ -125,7 +108,7 @@ def create_run(run_id):
                         ['orthology_based', '1_sbml_orthology'], \
                        ['orthology_based', '2_padmet_orthology'], ['orthology_based', '3_padmet_filtered'], ['annotation_based'],\
                        ['annotation_based', 'PGDBs'], ['annotation_based', 'PADMETs'],\
-                       ['annotation_based', 'SBMLs'], ['analysis'], ['logs'],\
+                       ['annotation_based', 'SBMLs'], ['analysis'], ['logs'], ['cache'],\
                        ['networks', 'PADMETs'], ['networks', 'SBMLs'],
                        ['structural_check'], ['structural_check', '0_specifics_reactions'],
                        ['structural_check', '1_blast_results'], ['structural_check', '1_blast_results', 'analysis'], ['structural_check', '1_blast_results', 'tmp'],
@@ -167,6 +150,7 @@ def create_config_file(config_file_path, run_id):
     config.set('PATHS_IN_RUN', 'log_path', '/logs')
     config.set('PATHS_IN_RUN', 'analysis_path', '/analysis')
     config.set('PATHS_IN_RUN', 'analysis_group_file_path', '%(analysis_path)s/group_template.tsv')
+    config.set('PATHS_IN_RUN', 'cache_path', '/cache')
 
     config.set('PATHS_IN_RUN', 'structural_path', '/structural_check')
     config.set('PATHS_IN_RUN', 'structural_specifics_reactions_path', '%(structural_path)s/0_specifics_reactions')
@@ -239,6 +223,7 @@ def uninstalling_pwt():
             print('Wrong command')
             ask_delete_ptools(ptools_path)
 
+    import mpwt
     ptools_path = mpwt.find_ptools_path()
 
     cmd_uninstall = ['/programs/pathway-tools/uninstall', '--mode', 'unattended']
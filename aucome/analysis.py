@@ -15,16 +15,20 @@ options:
 import csv
 import docopt
 import os
+import pickle
 import sys
 import time
 
-from multiprocessing import Pool
+from padmet.classes import PadmetSpec
+from padmet.utils.connection import sbmlGenerator
 
-from padmet.utils.connection import sbmlGenerator, padmet_to_padmet
-from padmet.utils.exploration import compare_padmet, dendrogram_reactions_distance
-from padmet.classes import PadmetRef
+from aucome.reaction_matrix import get_reaction_matrix, load_reaction_matrix
+from aucome.utils import get_run_context, create_aucome_pool, StepTelemetry
 
-from aucome.utils import parse_config_file
+# Padmets of the networks already loaded by this worker, k = path to the padmet, v = ((size, mtime), pickle of the PadmetSpec).
+NETWORK_PADMETS_LOADED = {}
+# Reaction matrices already loaded by this worker, k = path to the folder of the matrix, v = ((size, mtime) of reaction_matrix.npz, ReactionMatrix).
+REACTION_MATRICES_LOADED = {}
 
 
 def command_help():
@@ -61,20 +65,56 @@ def run_analysis(run_id, nb_cpu_to_use, pvclust, verbose):
     if verbose:
         print('--- Running analysis step ---')
     analysis_start_time = time.time()
-    config_data = parse_config_file(run_id)
+    step_telemetry = StepTelemetry(run_id, 'analysis')
+    run_context = get_run_context(run_id)
 
-    analysis_group_file_path = config_data['analysis_group_file_path']
+    analysis_group_file_path = run_context.analysis_group_file_path
+
+    aucome_pool = create_aucome_pool(nb_cpu_to_use)
+
+    # The padmets are read once for all the groups.
+    with step_telemetry.stage('reaction_matrix'):
+        reaction_matrix = get_reaction_matrix(run_id, nb_cpu_to_use, verbose, aucome_pool)
 
     # Create list of dictionaries containing input data for multiprocessing.
     # As we have to give one argument after the function to pool().
     # Create one dictionary by group in the group_template.tsv file.
-    group_data = []
+    # The groups are checked here, as a sys.exit in a worker would stop the worker and not the analysis.
+    padmet_from_networks_path = run_context.padmet_from_networks_path
+    analysis_path = run_context.analysis_path
+    group_datas = []
     with open(analysis_group_file_path, 'r') as group_file:
         group_reader = csv.reader(group_file, delimiter='\t')
         for row in group_reader:
             group_name = row[0]
             groups = [org_name for org_name in row[1:] if org_name]
-            analysis_on_group(group_name, groups, config_data, pvclust, nb_cpu_to_use, verbose)
+            group_analysis_path = analysis_path + '/' + group_name
+            if os.path.isdir(group_analysis_path):
+                print(group_analysis_path + ' already exists. Delete it if you want to relaunch the analysis.')
+                continue
+            if len(groups) == 1:
+                sys.exit('A group must contain more than one member.')
+            for org_name in groups:
+                if org_name not in reaction_matrix.organism_indexes:
+                    sys.exit("Padmet file of organism %s from group %s not found in %s" %(org_name, group_name, padmet_from_networks_path))
+            # Only the names are sent to the workers, they load the configuration of the run and the matrix once.
+            group_datas.append({'group_name': group_name, 'groups': groups, 'run_id': run_id, 'matrix_path': reaction_matrix.matrix_path,
+                                'verbose': verbose})
+
+    # The groups are analysed in parallel, with the pool used to read the padmets of the reaction matrix.
+    step_telemetry.map(aucome_pool, 'analysis_group', analysis_on_group, [[group_data] for group_data in group_datas],
+                       [group_data['group_name'] for group_data in group_datas])
+    aucome_pool.close()
+    aucome_pool.join()
+
+    # pvclust runs its bootstraps in parallel on all the CPUs, so it is run for one group at a time after the pool.
+    if pvclust:
+        from padmet.utils.exploration import dendrogram_reactions_distance
+        for group_data in group_datas:
+            group_analysis_path = analysis_path + '/' + group_data['group_name']
+            with step_telemetry.stage('pvclust', group_data['group_name']):
+                dendrogram_reactions_distance.create_pvclust_dendrogram(reaction_file=group_analysis_path + '/reactions.tsv',
+                                                                        output_folder=group_analysis_path + '/dendrogram_output')
 
     analysis_end_time = (time.time() - analysis_start_time)
     integer_part, decimal_part = str(analysis_end_time).split('.')
@@ -82,44 +122,86 @@ def run_analysis(run_id, nb_cpu_to_use, pvclust, verbose):
 
     if verbose:
         print("--- analysis step done in: %ss ---" %analysis_time)
+    step_telemetry.write(verbose)
 
 
-def analysis_on_group(group_name, groups, config_data, pvclust, nb_cpu_to_use, verbose):
-    """Create reaction dendrogram and extract specific reactions using metabolic networks.
+def load_network_padmet(padmet_path):
+    """Load a padmet of the networks, it is parsed once by worker and kept as a pickle,
+    so a worker analysing several groups does not parse again the organisms shared by these groups.
 
     Args:
-        group_name (str): Name of the group from group_template.tsv.
-        groups (list): All the species inside the group.
-        config_data (dict): Dictionary with all configuration paths.
-        pvclust (boolean): use also pvclust to create reaction dendrogram
-        nb_cpu_to_use (int): number of CPU for multiprocessing
+        padmet_path (str): path to the padmet
+    Returns:
+        padmet.classes.PadmetSpec: a new copy of the padmet (it can be modified)
+    """
+    padmet_stat = os.stat(padmet_path)
+    padmet_key = (padmet_stat.st_size, padmet_stat.st_mtime_ns)
+    if padmet_path not in NETWORK_PADMETS_LOADED or NETWORK_PADMETS_LOADED[padmet_path][0] != padmet_key:
+        NETWORK_PADMETS_LOADED[padmet_path] = (padmet_key, pickle.dumps(PadmetSpec(padmet_path), protocol=pickle.HIGHEST_PROTOCOL))
+    return pickle.loads(NETWORK_PADMETS_LOADED[padmet_path][1])
+
+
+def load_worker_reaction_matrix(matrix_path):
+    """Load the reaction matrix stored by get_reaction_matrix, it is read once by worker for all its groups.
+
+    Args:
+        matrix_path (str): path to the folder of the matrix
+    Returns:
+        ReactionMatrix: the matrix
+    """
+    matrix_stat = os.stat(os.path.join(matrix_path, 'reaction_matrix.npz'))
+    matrix_key = (matrix_stat.st_size, matrix_stat.st_mtime_ns)
+    if matrix_path not in REACTION_MATRICES_LOADED or REACTION_MATRICES_LOADED[matrix_path][0] != matrix_key:
+        REACTION_MATRICES_LOADED[matrix_path] = (matrix_key, load_reaction_matrix(matrix_path))
+    return REACTION_MATRICES_LOADED[matrix_path][1]
+
+
+def create_panmetabolism(all_padmet_path, output, verbose):
+    """Merge the padmets of a group (as padmet_to_padmet) with the padmets already loaded by the worker.
+
+    Args:
+        all_padmet_path (list): paths to the padmets of the group
+        output (str): path to the panmetabolism padmet
         verbose (bool): Verbose.
     """
+    padmet_init = load_network_padmet(all_padmet_path[0])
+    for padmet_update_path in all_padmet_path[1:]:
+        if verbose:
+            print("Updating %s from %s" %(os.path.basename(all_padmet_path[0]), os.path.basename(padmet_update_path)))
+        # updateFromPadmet moves nodes and relations of padmet_update into padmet_init, so each padmet is a new copy.
+        padmet_init.updateFromPadmet(load_network_padmet(padmet_update_path))
+    padmet_init.generateFile(output)
 
-    database_path = config_data['database_path']
-    padmetRef = PadmetRef(database_path)
-    padmet_from_networks_path = config_data['padmet_from_networks_path']
-    analysis_path = config_data['analysis_path']
 
-    all_padmet_path = [os.path.join(padmet_from_networks_path,name+".padmet") for name in groups ]
-    group_analysis_path = analysis_path + '/' + group_name
+def analysis_on_group(group_data):
+    """Create reaction dendrogram and extract specific reactions using metabolic networks.
 
-    if not os.path.isdir(group_analysis_path):
-        if len(groups) == 1:
-            sys.exit('A group must contain more than one member.')
+    The pvclust dendrogram is created by run_analysis after the groups.
 
-        for padmet_path in all_padmet_path:
-            if not os.path.exists(padmet_path):
-                org_name = os.path.splitext(os.path.basename(padmet_path))[0]
-                sys.exit("Padmet file of organism %s from group %s not found in %s" %(org_name, group_name, padmet_from_networks_path))
+    Args:
+        group_data (dict): Name of the group from group_template.tsv (group_name), all the species inside the group (groups),
+            ID of the run (run_id), path to the folder of the reaction matrix (matrix_path) and verbose.
+    """
+    # dendrogram_reactions_distance imports seaborn, scipy and matplotlib, it is only imported by the analysis step.
+    from padmet.utils.exploration import dendrogram_reactions_distance
+
+    group_name = group_data['group_name']
+    groups = group_data['groups']
+    run_context = get_run_context(group_data['run_id'])
+    reaction_matrix = load_worker_reaction_matrix(group_data['matrix_path'])
+    verbose = group_data['verbose']
 
-        # Compare the padmet to create the reactions.tsv file needed to create the reaction dendrogram.
-        compare_padmet.compare_padmet(padmet_path=",".join(all_padmet_path), output=group_analysis_path, padmetRef=padmetRef, verbose=verbose, number_cpu=nb_cpu_to_use)
-        padmet_to_padmet.padmet_to_padmet(",".join(all_padmet_path), group_analysis_path + '/' + group_name + '_panmetabolism.padmet')
-        sbmlGenerator.padmet_to_sbml(padmet=group_analysis_path + '/' + group_name + '_panmetabolism.padmet', output=group_analysis_path + '/' + group_name + '_panmetabolism.sbml', verbose=verbose)
+    database_path = run_context.database_path
+    padmet_from_networks_path = run_context.padmet_from_networks_path
+    analysis_path = run_context.analysis_path
+
+    all_padmet_path = [os.path.join(padmet_from_networks_path,name+".padmet") for name in groups ]
+    group_analysis_path = analysis_path + '/' + group_name
 
-        dendrogram_reactions_distance.reaction_figure_creation(reaction_file=group_analysis_path + '/reactions.tsv', output_folder=group_analysis_path + '/dendrogram_output',
-                                                                padmetRef_file=database_path, pvclust=pvclust, verbose=verbose)
+    # Compare the organisms of the group to create the reactions.tsv file needed to create the reaction dendrogram.
+    reaction_matrix.write_comparison(groups, group_analysis_path, verbose)
+    create_panmetabolism(all_padmet_path, group_analysis_path + '/' + group_name + '_panmetabolism.padmet', verbose)
+    sbmlGenerator.padmet_to_sbml(padmet=group_analysis_path + '/' + group_name + '_panmetabolism.padmet', output=group_analysis_path + '/' + group_name + '_panmetabolism.sbml', verbose=verbose)
 
-    else:
-        print(group_analysis_path + ' already exists. Delete it if you want to relaunch the analysis.')
\ No newline at end of file
+    dendrogram_reactions_distance.reaction_figure_creation(reaction_file=group_analysis_path + '/reactions.tsv', output_folder=group_analysis_path + '/dendrogram_output',
+                                                            padmetRef_file=database_path, pvclust=False, verbose=verbose)
@@ -13,16 +13,26 @@ options:
 
 import csv
 import docopt
+import hashlib
+import io
+import json
+import mmap
 import os
 import time
 
-from padmet.utils.connection import gbk_to_faa, pgdb_to_padmet, sbmlGenerator
+from padmet.utils.connection import pgdb_to_padmet, sbmlGenerator
 
-from aucome.utils import parse_config_file
-from aucome.reconstruction import create_padmet_from_pgdb, create_sbml
+from aucome.utils import get_run_context, create_aucome_pool, file_hash, get_workspace_inventory, StepTelemetry
+from aucome.reconstruction import create_padmet_sbml
 
 from Bio import SeqIO
-from multiprocessing import Pool
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+
+INVALID_CHARACTERS = ['-', '|', '/', '(', ')', '\'', '=', '#', '*',
+                      '.', ':', '!', '+', '[', ']', ',', " "]
+# Genbanks bigger than this size (in bytes) are checked by chunks of this size in parallel.
+GENBANK_CHUNK_SIZE = 64 * 1024 * 1024
 
 
 def command_help():
@@ -46,31 +56,31 @@ def check_parse_args(command_args):
     run_check(run_id, nb_cpu_to_use, verbose, veryverbose)
 
 
-def run_check(run_id, nb_cpu_to_use, verbose, veryverbose):
+def run_check(run_id, nb_cpu_to_use, verbose, veryverbose, aucome_pool=None):
     if verbose:
         print('--- Running check step ---')
     start_time = time.time()
+    step_telemetry = StepTelemetry(run_id, 'check')
 
-    config_data = parse_config_file(run_id)
+    run_context = get_run_context(run_id)
 
-    padmet_from_annotation_path = config_data['padmet_from_annotation_path']
-    study_from_annot_prefix = config_data['study_from_annot_prefix']
-    sbml_from_annotation_path = config_data['sbml_from_annotation_path']
-    database_path = config_data['database_path']
-    pgdb_from_annotation_path = config_data['pgdb_from_annotation_path']
-    studied_organisms_path = config_data['studied_organisms_path']
-    analysis_group_file_path = config_data['analysis_group_file_path']
+    padmet_from_annotation_path = run_context.padmet_from_annotation_path
+    study_from_annot_prefix = run_context.study_from_annot_prefix
+    sbml_from_annotation_path = run_context.sbml_from_annotation_path
+    database_path = run_context.database_path
+    pgdb_from_annotation_path = run_context.pgdb_from_annotation_path
+    studied_organisms_path = run_context.studied_organisms_path
+    analysis_group_file_path = run_context.analysis_group_file_path
+    # Scans of the genbanks already checked in this run (see load_genbank_scan).
+    genbank_scan_cache_path = os.path.join(run_context.cache_path, 'genbank_scan')
 
     #create dict for ortho data
-    all_study_name = set(next(os.walk(studied_organisms_path))[1])
-    all_study_pgdb = dict([(study_name, "{0}/{1}".format(pgdb_from_annotation_path, study_name))
-                          if os.path.isdir("{0}/{1}".format(pgdb_from_annotation_path, study_name))
-                          else (study_name, '')
-                          for study_name in all_study_name])
-    all_study_gbk = dict([(study_name, "{0}/{1}/{1}.gbk".format(studied_organisms_path, study_name))
-                          if os.path.isfile("{0}/{1}/{1}.gbk".format(studied_organisms_path, study_name))
-                          else (study_name, '')
-                          for study_name in all_study_name])
+    # The folders of the run are listed once by the inventory, instead of checking each file of each organism.
+    workspace_inventory = get_workspace_inventory(run_id)
+    all_study_name = workspace_inventory.organisms()
+    all_study_files = dict([(study_name, workspace_inventory.organism_files(study_name)) for study_name in all_study_name])
+    all_study_pgdb = dict([(study_name, all_study_files[study_name]['pgdb']) for study_name in all_study_name])
+    all_study_gbk = dict([(study_name, all_study_files[study_name]['gbk']) for study_name in all_study_name])
 
     # Update group file in analysis
     if not os.path.exists(analysis_group_file_path):
@@ -94,59 +104,41 @@ def run_check(run_id, nb_cpu_to_use, verbose, veryverbose):
                     if group[0] != 'all':
                         group_writer.writerow([group[0], *group[1]])
 
-    aucome_pool = Pool(nb_cpu_to_use)
+    # Without a pool given by the workflow, the step creates its own pool and closes it at the end.
+    close_pool = aucome_pool is None
+    if close_pool:
+        aucome_pool = create_aucome_pool(nb_cpu_to_use)
 
     if verbose:
         print('Checking genbank file.')
-    study_faa_data = []
+    study_data = []
     for study_name in all_study_name:
         faa_path = "{0}/{1}/{1}.faa".format(studied_organisms_path, study_name)
-        tmp_faa_data = {'study_name': study_name, 'faa_path': faa_path, 'gbk_file': all_study_gbk[study_name],
-                        'studied_organisms_path': studied_organisms_path,
-                        'verbose': verbose}
-        study_faa_data.append(tmp_faa_data)
-    aucome_pool.map(check_create_faa, study_faa_data)
-
-    #k = folder_name in studied_org_path, v = path to faa in this folder, faa name should be folder_name.faa
-    all_study_faa = dict([(study_name, "{0}/{1}/{1}.faa".format(studied_organisms_path, study_name))
-                          if os.path.isfile("{0}/{1}/{1}.faa".format(studied_organisms_path, study_name))
-                          else (study_name, '')
-                          for study_name in all_study_name])
-
-    study_padmet_data = []
-    for study_name in all_study_name:
         padmet_file = "{0}/{1}{2}.padmet".format(padmet_from_annotation_path, study_from_annot_prefix, study_name)
-        pgdb_folder = all_study_pgdb[study_name]
-        tmp_padmet_data = {'study_name': study_name, 'pgdb_folder': pgdb_folder, 'verbose': verbose, 
-                           'padmet_file': padmet_file, 'database_path': database_path, 'veryverbose': veryverbose}
-        study_padmet_data.append(tmp_padmet_data)
-    aucome_pool.map(create_padmet_from_pgdb, study_padmet_data)
-
-    all_study_padmet = dict([(study_name, "{0}/{1}{2}.padmet".format(padmet_from_annotation_path, study_from_annot_prefix, study_name))
-                          if os.path.isfile("{0}/{1}{2}.padmet".format(padmet_from_annotation_path, study_from_annot_prefix, study_name))
-                          else (study_name, '')
-                          for study_name in all_study_name])
-
-    study_sbml_data = []
-    for study_name in all_study_padmet:
         sbml_file = "{0}/{1}{2}.sbml".format(sbml_from_annotation_path, study_from_annot_prefix, study_name)
-        padmet_file = all_study_padmet[study_name]
-        tmp_sbml_data = {'sbml_file': sbml_file, 'padmet_file': padmet_file,
-                         'study_name': study_name, 'verbose': verbose, 'veryverbose': veryverbose}
-        study_sbml_data.append(tmp_sbml_data)
-    aucome_pool.map(create_sbml, study_sbml_data)
-
+        tmp_study_data = {'study_name': study_name, 'faa_path': faa_path, 'gbk_file': all_study_gbk[study_name],
+                          'studied_organisms_path': studied_organisms_path, 'pgdb_folder': all_study_pgdb[study_name],
+                          'padmet_file': padmet_file, 'sbml_file': sbml_file, 'database_path': database_path,
+                          'genbank_scan_cache_path': genbank_scan_cache_path, 'verbose': verbose, 'veryverbose': veryverbose}
+        # A large genbank is split in chunks checked by all the workers, before the tasks of the other organisms.
+        if all_study_gbk[study_name] and os.path.getsize(all_study_gbk[study_name]) > GENBANK_CHUNK_SIZE:
+            with step_telemetry.stage('check_large_genbank', study_name):
+                workspace_inventory.add_files(check_create_faa(tmp_study_data, aucome_pool))
+            tmp_study_data['genbank_checked'] = True
+        study_data.append(tmp_study_data)
+    # One task by organism (faa, padmet then sbml), so a slow organism does not stop the others between these stages.
+    organism_results = step_telemetry.map(aucome_pool, 'check_organism', check_organism, [[tmp_study_data] for tmp_study_data in study_data],
+                                          [tmp_study_data['study_name'] for tmp_study_data in study_data])
+    for created_files in organism_results:
+        workspace_inventory.add_files(created_files)
+
+    all_study_files = dict([(study_name, workspace_inventory.organism_files(study_name)) for study_name in all_study_name])
+    #k = folder_name in studied_org_path, v = path to faa in this folder, faa name should be folder_name.faa
+    all_study_faa = dict([(study_name, all_study_files[study_name]['faa']) for study_name in all_study_name])
+    all_study_padmet = dict([(study_name, all_study_files[study_name]['padmet']) for study_name in all_study_name])
     #sbml of study are obtained from annotation, they should be in sbml_from_annotation_path
     #k = study_name (== folder_name in studied_org_path or obtained from sbml name), v = path to sbml, sbml_study_prefi+study_name+.sbml
-    all_study_sbml = dict([(study_name, "{0}/{1}{2}.sbml".format(sbml_from_annotation_path, study_from_annot_prefix, study_name))
-                           if os.path.isfile("{0}/{1}{2}.sbml".format(sbml_from_annotation_path, study_from_annot_prefix, study_name))
-                           else (study_name, '')
-                           for study_name in all_study_name])
-    #PGDB, padmet, sbml
-    all_study_pgdb = dict([(study_name, "{0}/{1}".format(pgdb_from_annotation_path, study_name))
-                          if os.path.isdir("{0}/{1}".format(pgdb_from_annotation_path, study_name))
-                          else (study_name, '')
-                          for study_name in all_study_name])
+    all_study_sbml = dict([(study_name, all_study_files[study_name]['sbml']) for study_name in all_study_name])
 
     if verbose:
         print("Input summary:")
@@ -173,9 +165,10 @@ def run_check(run_id, nb_cpu_to_use, verbose, veryverbose):
                 print("\tSBML: OK")
             else:
                 print("\t[WARNING] No SBML found, should be in {1}/{2}{0}.sbml".format(study_name, sbml_from_annotation_path, study_from_annot_prefix))
-        
-    aucome_pool.close()
-    aucome_pool.join()
+
+    if close_pool:
+        aucome_pool.close()
+        aucome_pool.join()
 
     end_time = (time.time() - start_time)
     integer_part, decimal_part = str(end_time).split('.')
@@ -183,61 +176,144 @@ def run_check(run_id, nb_cpu_to_use, verbose, veryverbose):
 
     if verbose:
         print("--- check step done in: %ss ---" %check_time)
+    step_telemetry.write(verbose)
 
 
-def check_create_faa(tmp_faa_data):
+def check_organism(tmp_study_data):
+    """Check the genbank and create the faa, then create the padmet and the sbml of an organism.
+
+    Args:
+        tmp_study_data (dict): data of the organism used by check_create_faa and create_padmet_sbml
+    Returns:
+        list: paths to the files created for the organism
+    """
+    created_files = []
+    if not tmp_study_data.get('genbank_checked'):
+        created_files.extend(check_create_faa(tmp_study_data))
+    created_files.extend(create_padmet_sbml(tmp_study_data))
+    return created_files
+
+
+def check_create_faa(tmp_faa_data, aucome_pool=None):
     study_name = tmp_faa_data['study_name']
     faa_path = tmp_faa_data['faa_path']
     gbk_file = tmp_faa_data['gbk_file']
     verbose = tmp_faa_data['verbose']
     studied_organisms_path = tmp_faa_data['studied_organisms_path']
-    checking_genbank(study_name, studied_organisms_path, verbose)
+    genbank_scan_cache_path = tmp_faa_data.get('genbank_scan_cache_path')
 
-    #create Faa from gbk if no faa found
+    #create Faa from gbk if no faa found, in the same pass than the check of the genbank
     if not os.path.isfile(faa_path) and gbk_file:
         if verbose:
             print("Creating faa from gbk for %s" %study_name)
-        gbk_to_faa.gbk_to_faa(gbk_file=gbk_file, output=faa_path, verbose=verbose)
+        checking_genbank(study_name, studied_organisms_path, verbose, faa_path, aucome_pool, genbank_scan_cache_path)
+        return [faa_path]
+    else:
+        checking_genbank(study_name, studied_organisms_path, verbose, aucome_pool=aucome_pool, genbank_scan_cache_path=genbank_scan_cache_path)
+        return []
+
+
+def genbank_record_to_faa(record, faa_file, fasta_ids, verbose):
+    """
+    Write the protein sequences of the CDS of a genbank record in a fasta file (like padmet gbk_to_faa).
 
+    Args:
+        record (Bio.SeqRecord.SeqRecord): genbank record
+        faa_file (file object): opened fasta file
+        fasta_ids (dict): k = gene ID already written, v = number of isoforms, shared between the records of a genbank
+        verbose (bool): verbose
+    """
+    write_faa_proteins(genbank_record_proteins(record, verbose), faa_file, fasta_ids)
+
+
+def genbank_record_proteins(record, verbose):
+    """
+    Extract the protein sequences of the CDS of a genbank record.
 
-def checking_genbank(genbank_file_name, studied_organisms_path, verbose):
+    Args:
+        record (Bio.SeqRecord.SeqRecord): genbank record
+        verbose (bool): verbose
+    Returns:
+        list: (gene ID, protein sequence) of each CDS with a locus_tag, the protein sequence is None for a CDS without translation
+    """
+    proteins = []
+    for feature in record.features:
+        if feature.type != 'CDS':
+            continue
+        try:
+            fasta_id = feature.qualifiers['locus_tag'][0]
+            # The translation of a fixed record is a string.
+            translation = feature.qualifiers.get('translation')
+            if translation is not None and not isinstance(translation, str):
+                translation = translation[0]
+            # A CDS without translation is kept, as it counts in the isoform number of its gene with padmet gbk_to_faa.
+            proteins.append((fasta_id, translation))
+            if translation is None and verbose:
+                print("locus without Translation: "+fasta_id)
+        except KeyError:
+            if verbose:
+                print("locus without Translation: "+feature.qualifiers.get('gene',["Unknown"])[0])
+    return proteins
+
+
+def write_faa_proteins(proteins, faa_file, fasta_ids):
+    """
+    Write protein sequences in a fasta file, the second sequence of a gene is written with the ID gene_isoform2.
+    As in padmet gbk_to_faa, a sequence None is not written but it is counted in the isoforms if its gene has already been written.
+
+    Args:
+        proteins (list): (gene ID, protein sequence)
+        faa_file (file object): opened fasta file
+        fasta_ids (dict): k = gene ID already written, v = number of isoforms, shared between the records of a genbank
+    """
+    for fasta_id, translation in proteins:
+        if fasta_id not in fasta_ids:
+            if translation is None:
+                continue
+            fasta_record = SeqRecord(Seq(translation), id=fasta_id, description=fasta_id)
+            fasta_ids[fasta_id] = 1
+        else:
+            fasta_ids[fasta_id] += 1
+            if translation is None:
+                continue
+            isoform_id = fasta_id + '_isoform' + str(fasta_ids[fasta_id])
+            fasta_record = SeqRecord(Seq(translation), id=isoform_id, description=fasta_id)
+        SeqIO.write(fasta_record, faa_file, 'fasta')
+
+
+def checking_genbank(genbank_file_name, studied_organisms_path, verbose, faa_path=None, aucome_pool=None, genbank_scan_cache_path=None):
     """
     Check if there is a special character in the genbank file.
     If yes exit and print an error.
 
     Check gene ID in genbank to find too long gene ID or invalid character in gene ID.
+
+    The check uses a line scan of the genbank (cached in genbank_scan_cache_path, see load_genbank_scan),
+    Biopython is only used to fix the genbank or to create the faa (given by faa_path).
+    With aucome_pool, a large genbank is scanned and converted in faa by chunks in parallel.
     """
-    invalid_characters = ['-', '|', '/', '(', ')', '\'', '=', '#', '*',
-                '.', ':', '!', '+', '[', ']', ',', " "]
-    if any(char in invalid_characters for char in genbank_file_name):
+    if any(char in INVALID_CHARACTERS for char in genbank_file_name):
         print('Error in genbank file name: ' + genbank_file_name)
         print('Rename the file without:',genbank_file_name)
 
     # Path to the genbank file.
     genbank_path = studied_organisms_path + '/' + genbank_file_name + '/' + genbank_file_name + '.gbk'
 
-    fix_dot_protein_seq = None
-    invalid_gene_ids = []
-    too_long_ids = []
-    for record in SeqIO.parse(genbank_path, 'genbank'):
-        for feature in record.features:
-            if 'locus_tag' in feature.qualifiers:
-                locus_tag = feature.qualifiers['locus_tag'][0]
-                if any(char in invalid_characters for char in locus_tag):
-                    if verbose:
-                        invalid_gene_ids.append(feature)
-                if len(locus_tag) >= 40:
-                        too_long_ids.append(feature)
-            if 'translation' in feature.qualifiers:
-                if '.' in feature.qualifiers['translation'][0]:
-                    fix_dot_protein_seq = True
-
-    if len(invalid_gene_ids) > 0:
-        print('Error of gene id in genbank ' + genbank_file_name + ', ' + str(len(invalid_gene_ids)) + ' genes have an invalid characters present: ' + ' '.join(invalid_characters) + '.')
-    if len(too_long_ids) > 0:
-        print('Error of gene id in genbank ' + genbank_file_name + ', ' + str(len(too_long_ids)) + ' genes have a gene id too long.')
-
-    if len(invalid_gene_ids) > 0 or len(too_long_ids) > 0:
+    genbank_scan = load_genbank_scan(genbank_path, verbose, aucome_pool, genbank_scan_cache_path)
+    # Invalid characters are only searched in verbose mode.
+    nb_invalid_gene_ids = genbank_scan['invalid_gene_ids'] if verbose else 0
+    nb_non_utf8_ids = genbank_scan['non_utf8_ids']
+    nb_too_long_ids = genbank_scan['too_long_ids']
+    fix_dot_protein_seq = genbank_scan['fix_dot_protein_seq']
+
+    if nb_invalid_gene_ids > 0:
+        print('Error of gene id in genbank ' + genbank_file_name + ', ' + str(nb_invalid_gene_ids) + ' genes have an invalid characters present: ' + ' '.join(INVALID_CHARACTERS) + '.')
+    if nb_non_utf8_ids > 0:
+        print('Error of gene id in genbank ' + genbank_file_name + ', ' + str(nb_non_utf8_ids) + ' genes have a gene id which is not utf-8.')
+    if nb_too_long_ids > 0:
+        print('Error of gene id in genbank ' + genbank_file_name + ', ' + str(nb_too_long_ids) + ' genes have a gene id too long.')
+
+    if nb_invalid_gene_ids > 0 or nb_non_utf8_ids > 0 or nb_too_long_ids > 0:
         print('Gene ID in ' + genbank_file_name + ' must be renamed.')
         fix_name = True
     else:
@@ -246,8 +322,244 @@ def checking_genbank(genbank_file_name, studied_organisms_path, verbose):
     if fix_dot_protein_seq:
         print('Dot in a protein sequence, Orthofinder will not work for this sequence. Dot will be deleted.')
 
+    genbank_fixed = False
     if fix_name or fix_dot_protein_seq:
-        fix_genbank_file(genbank_file_name, fix_name, fix_dot_protein_seq, studied_organisms_path, verbose)
+        genbank_fixed = fix_genbank_file(genbank_file_name, fix_name, fix_dot_protein_seq, studied_organisms_path, verbose,
+                                         genbank_scan['number_genes'], faa_path)
+
+    if faa_path and not genbank_fixed:
+        genbank_to_faa(genbank_path, faa_path, verbose, aucome_pool)
+
+
+def genbank_to_faa(genbank_path, faa_path, verbose, aucome_pool=None):
+    """
+    Create the faa of a genbank, reading the genbank one record at a time.
+    With aucome_pool, the proteins of the chunks of a large genbank are extracted in parallel and written in the order of the chunks.
+    """
+    fasta_ids = {}
+    with open(faa_path, 'w') as faa_file:
+        if aucome_pool and os.path.getsize(genbank_path) > GENBANK_CHUNK_SIZE:
+            chunk_datas = [{'genbank_path': genbank_path, 'start': start, 'end': end, 'verbose': verbose}
+                           for start, end in genbank_chunks(genbank_path, GENBANK_CHUNK_SIZE)]
+            for chunk_proteins in aucome_pool.imap(genbank_chunk_proteins, chunk_datas):
+                write_faa_proteins(chunk_proteins, faa_file, fasta_ids)
+        else:
+            with open(genbank_path, 'r', encoding='utf-8', errors='surrogateescape') as genbank_file:
+                for record in SeqIO.parse(genbank_file, 'genbank'):
+                    genbank_record_to_faa(record, faa_file, fasta_ids, verbose)
+
+
+def genbank_chunks(genbank_path, chunk_size):
+    """
+    Split a genbank in chunks of about chunk_size bytes, at the beginning of the records (LOCUS lines).
+
+    Args:
+        genbank_path (str): path to the genbank
+        chunk_size (int): size of the chunks in bytes
+    Returns:
+        list: (start, end) byte offsets of the chunks
+    """
+    genbank_size = os.path.getsize(genbank_path)
+    if genbank_size == 0:
+        return [(0, 0)]
+    chunks = []
+    with open(genbank_path, 'rb') as genbank_file:
+        with mmap.mmap(genbank_file.fileno(), 0, access=mmap.ACCESS_READ) as genbank_mmap:
+            start = 0
+            while start < genbank_size:
+                # A record bigger than chunk_size is a chunk.
+                next_locus = genbank_mmap.find(b'\nLOCUS', start + chunk_size)
+                end = next_locus + 1 if next_locus != -1 else genbank_size
+                chunks.append((start, end))
+                start = end
+    return chunks
+
+
+def read_genbank_chunk(genbank_path, start, end):
+    """
+    Read the lines of a chunk of a genbank.
+
+    Args:
+        genbank_path (str): path to the genbank
+        start (int): byte offset of the beginning of the chunk
+        end (int): byte offset of the end of the chunk (None for the end of the file)
+    Returns:
+        generator: lines (bytes) of the chunk
+    """
+    with open(genbank_path, 'rb') as genbank_file:
+        genbank_file.seek(start)
+        remaining_size = end - start if end is not None else None
+        for line in genbank_file:
+            yield line
+            if remaining_size is not None:
+                remaining_size -= len(line)
+                if remaining_size <= 0:
+                    break
+
+
+def genbank_chunk_proteins(chunk_data):
+    """
+    Extract the protein sequences of the records of a chunk of a genbank (see genbank_chunks).
+
+    Args:
+        chunk_data (dict): genbank_path, start and end of the chunk and verbose
+    Returns:
+        list: (gene ID, protein sequence) of each CDS with a locus_tag (see genbank_record_proteins)
+    """
+    chunk_text = b''.join(read_genbank_chunk(chunk_data['genbank_path'], chunk_data['start'], chunk_data['end']))
+    proteins = []
+    # A byte which is not utf-8 (like a latin-1 character in a description) is kept as a surrogate, like in genbank_to_faa.
+    for record in SeqIO.parse(io.StringIO(chunk_text.decode('utf-8', errors='surrogateescape')), 'genbank'):
+        proteins.extend(genbank_record_proteins(record, chunk_data['verbose']))
+    return proteins
+
+
+def scan_genbank(genbank_path, start=0, end=None):
+    """
+    Read the lines of a genbank (without Biopython) to find the issues fixed by fix_genbank_file:
+    invalid characters or length of the locus_tag and dot in the translation.
+
+    Args:
+        genbank_path (str): path to the genbank
+        start (int): byte offset of the beginning of the scanned chunk
+        end (int): byte offset of the end of the scanned chunk (None for the end of the file)
+    Returns:
+        dict: number of locus_tag with invalid characters (invalid_gene_ids), number of locus_tag which are not utf-8 (non_utf8_ids,
+            also counted in invalid_gene_ids), number of locus_tag too long (too_long_ids),
+            if a translation contains a dot (fix_dot_protein_seq), number of gene features (number_genes) and sha256 of the chunk (sha256)
+    """
+    genbank_scan = {'invalid_gene_ids': 0, 'non_utf8_ids': 0, 'too_long_ids': 0, 'fix_dot_protein_seq': False, 'number_genes': 0}
+    invalid_characters = [char.encode() for char in INVALID_CHARACTERS]
+    file_sha = hashlib.sha256()
+    # Qualifier read on several lines: locus_tag or translation.
+    current_qualifier = None
+    qualifier_value = b''
+    feature_has_locus_tag = False
+
+    for line in read_genbank_chunk(genbank_path, start, end):
+        file_sha.update(line)
+        if current_qualifier:
+            value_line = line.strip()
+            qualifier_value += (b' ' if current_qualifier == b'locus_tag' else b'') + value_line
+            if not value_line.endswith(b'"'):
+                continue
+        # Feature key line, like '     gene            1..100'.
+        elif line.startswith(b'     ') and line[5:6] != b' ' and not line[5:6].isdigit():
+            feature_has_locus_tag = False
+            if line[5:21].strip() == b'gene':
+                genbank_scan['number_genes'] += 1
+            continue
+        # Qualifier line, like '                     /locus_tag="g_1"'.
+        elif line.startswith(b'                     /locus_tag=') and not feature_has_locus_tag:
+            current_qualifier = b'locus_tag'
+            qualifier_value = line.strip()[len(b'/locus_tag='):]
+            if qualifier_value.startswith(b'"') and (not qualifier_value.endswith(b'"') or qualifier_value == b'"'):
+                continue
+        elif line.startswith(b'                     /translation='):
+            current_qualifier = b'translation'
+            qualifier_value = line.strip()[len(b'/translation='):]
+            if qualifier_value.startswith(b'"') and (not qualifier_value.endswith(b'"') or qualifier_value == b'"'):
+                continue
+        else:
+            continue
+
+        qualifier_value = qualifier_value.strip(b'"')
+        if current_qualifier == b'locus_tag':
+            feature_has_locus_tag = True
+            try:
+                locus_tag = qualifier_value.decode('utf-8')
+            except UnicodeDecodeError:
+                # A locus_tag which is not utf-8 (like latin-1) is renamed by fix_genbank_file.
+                locus_tag = qualifier_value.decode('utf-8', errors='surrogateescape')
+                genbank_scan['non_utf8_ids'] += 1
+                genbank_scan['invalid_gene_ids'] += 1
+            else:
+                if any(char in qualifier_value for char in invalid_characters):
+                    genbank_scan['invalid_gene_ids'] += 1
+            if len(locus_tag) >= 40:
+                genbank_scan['too_long_ids'] += 1
+        elif b'.' in qualifier_value:
+            genbank_scan['fix_dot_protein_seq'] = True
+        current_qualifier = None
+
+    genbank_scan['sha256'] = file_sha.hexdigest()
+    return genbank_scan
+
+
+def load_genbank_scan(genbank_path, verbose=None, aucome_pool=None, cache_path=None):
+    """
+    Get the scan of a genbank (see scan_genbank) from the cache or scan the genbank.
+    The scan of a genbank is cached in cache_path/<genbank name>.json, it is used if the genbank has the same size
+    and modification time, or the same size and sha256 (the genbank has been copied or touched).
+
+    Args:
+        genbank_path (str): path to the genbank
+        verbose (bool): verbose
+        aucome_pool (multiprocessing.Pool): pool used to scan the chunks of a large genbank
+        cache_path (str): path to the folder of the scans of the run (None to scan the genbank without cache)
+    Returns:
+        dict: scan of the genbank
+    """
+    genbank_stat = os.stat(genbank_path)
+    scan_path = os.path.join(cache_path, os.path.splitext(os.path.basename(genbank_path))[0] + '.json') if cache_path else None
+
+    genbank_scan = None
+    if scan_path and os.path.exists(scan_path):
+        try:
+            with open(scan_path, 'r') as cache_file:
+                cache_data = json.load(cache_file)
+            # A scan without non_utf8_ids (written by an older aucome) is not used, the genbank is scanned again.
+            if cache_data['size'] == genbank_stat.st_size and 'non_utf8_ids' in cache_data['scan']:
+                if cache_data['mtime'] == genbank_stat.st_mtime_ns:
+                    if verbose:
+                        print('Genbank ' + genbank_path + ' already checked.')
+                    return cache_data['scan']
+                # Same content with a new modification time, the cache is updated with it.
+                if cache_data['scan']['sha256'] == file_hash(genbank_path):
+                    if verbose:
+                        print('Genbank ' + genbank_path + ' already checked.')
+                    genbank_scan = cache_data['scan']
+        except (ValueError, KeyError):
+            pass
+
+    if genbank_scan is None and aucome_pool and genbank_stat.st_size > GENBANK_CHUNK_SIZE:
+        chunk_scans = aucome_pool.starmap_async(scan_genbank, [(genbank_path, start, end) for start, end in genbank_chunks(genbank_path, GENBANK_CHUNK_SIZE)])
+        # The sha256 of the whole file is computed while the workers scan the chunks.
+        genbank_sha = file_hash(genbank_path)
+        genbank_scan = {'invalid_gene_ids': 0, 'non_utf8_ids': 0, 'too_long_ids': 0, 'fix_dot_protein_seq': False, 'number_genes': 0}
+        for chunk_scan in chunk_scans.get():
+            genbank_scan['invalid_gene_ids'] += chunk_scan['invalid_gene_ids']
+            genbank_scan['non_utf8_ids'] += chunk_scan['non_utf8_ids']
+            genbank_scan['too_long_ids'] += chunk_scan['too_long_ids']
+            genbank_scan['fix_dot_protein_seq'] = genbank_scan['fix_dot_protein_seq'] or chunk_scan['fix_dot_protein_seq']
+            genbank_scan['number_genes'] += chunk_scan['number_genes']
+        genbank_scan['sha256'] = genbank_sha
+    elif genbank_scan is None:
+        genbank_scan = scan_genbank(genbank_path)
+
+    if scan_path:
+        cache_data = {'size': genbank_stat.st_size, 'mtime': genbank_stat.st_mtime_ns, 'scan': genbank_scan}
+        try:
+            os.makedirs(cache_path, exist_ok=True)
+            tmp_scan_path = scan_path + '.' + str(os.getpid()) + '.tmp'
+            with open(tmp_scan_path, 'w') as cache_file:
+                json.dump(cache_data, cache_file)
+            os.replace(tmp_scan_path, scan_path)
+        except OSError:
+            pass
+
+    return genbank_scan
+
+
+def genbank_new_prefix(record):
+    """
+    Use either the genbank accession or the genus + species of the first record as a prefix for new gene ID.
+    """
+    try:
+        new_prefix = record.annotations['accessions'][0] + '_' + str(record.annotations['sequence_version'])
+    except:
+        new_prefix = record.annotations['organism'].split(' ')[0][0] + '_' + record.annotations['organism'].split(' ')[1]
+    return new_prefix
 
 
 def adapt_gene_id(gene_id, longest_gene_number_length):
@@ -263,63 +575,76 @@ def adapt_gene_id(gene_id, longest_gene_number_length):
     return new_gene_id
 
 
-def fix_genbank_file(genbank_file_name, fix_name, fix_dot_protein_seq, studied_organisms_path, verbose):
+def fix_genbank_file(genbank_file_name, fix_name, fix_dot_protein_seq, studied_organisms_path, verbose,
+                     number_genes_genbanks, faa_path=None):
+    """
+    Rename the gene IDs and/or delete the dots in protein sequences of a genbank.
+    The genbank is read and written one record at a time, the faa (if faa_path is given) and the mapping file are written in the same pass.
+
+    Returns:
+        bool: True if a new genbank has been written
+    """
     # Path to the genbank file.
     genbank_path = studied_organisms_path + '/' + genbank_file_name + '/' + genbank_file_name + '.gbk'
     genbank_path_renamed = studied_organisms_path + '/' + genbank_file_name + '/' + genbank_file_name + '_original.gbk'
 
     if os.path.exists(genbank_path_renamed):
         print(genbank_file_name + ': Renaming has already been made on the data.')
-        return
-
-    # Create records that will be modified according to the issue: location or gene id.
-    new_records = [record for record in SeqIO.parse(genbank_path, 'genbank')]
-
-    # Use either the genbank accession or the genus + species as a prefix for new gene ID.
-    try:
-        new_prefix = new_records[0].annotations['accessions'][0] + '_' + str(new_records[0].annotations['sequence_version'])
-    except:
-        new_prefix = new_records[0].annotations['organism'].split(' ')[0][0] + '_' + new_records[0].annotations['organism'].split(' ')[1]
+        return False
 
-    if fix_name or fix_dot_protein_seq:
-        # Dictionary wtih gene id as key and renamed id as value.
-        feature_id_mappings = {}
+    # Dictionary wtih gene id as key and renamed id as value.
+    feature_id_mappings = {}
 
-        number_genes_genbanks = len([feature for record in SeqIO.parse(genbank_path, 'genbank') for feature in record.features if feature.type == 'gene'])
+    def fix_records(faa_file):
+        # Create records that will be modified according to the issue: location or gene id.
         gene_number = 1
+        fasta_ids = {}
         # Renamed ID: genbank file name + '_' + gene_position_number.
         # Max ID len is 39 for Pathway-Tools.
-        for record in new_records:
-            for feature in record.features:
-                if 'locus_tag' in feature.qualifiers:
-                    if fix_name:
-                        feature_id = feature.qualifiers['locus_tag'][0]
-                        if feature_id not in feature_id_mappings:
-                            new_gene_id = new_prefix + '_' + str(gene_number)
-                            new_feature_id = adapt_gene_id(new_gene_id, len(str(number_genes_genbanks)))
-                            feature_id_mappings[feature_id] = new_feature_id
-                            feature.qualifiers['locus_tag'][0] = new_feature_id
-                            feature.qualifiers['old_locus_tag'] = feature_id
-                            gene_number += 1
-                        else:
-                            feature.qualifiers['locus_tag'][0] = feature_id_mappings[feature_id]
-                            feature.qualifiers['old_locus_tag'] = feature_id
-                    if fix_dot_protein_seq:
-                        if 'translation' in feature.qualifiers:
-                            feature.qualifiers['translation'] = feature.qualifiers['translation'][0].replace('.', '')
-
-        if fix_name:
-            # Create a TSV mapping file with original and renamed ids.
-            mapping_dic_path = studied_organisms_path + '/' + genbank_file_name + '/' + genbank_file_name + '_dict.csv'
-            with open(mapping_dic_path, 'w') as csv_file:
-                writer = csv.writer(csv_file, delimiter='\t')
-                writer.writerow(["original_gene_id", "renamed_gene_id"])
-                for key, value in list(feature_id_mappings.items()):
-                    writer.writerow([key, value])
+        new_prefix = None
+        # The bytes which are not utf-8 are kept as surrogates and written back unchanged in the new genbank.
+        with open(genbank_path, 'r', encoding='utf-8', errors='surrogateescape') as genbank_file:
+            for record in SeqIO.parse(genbank_file, 'genbank'):
+                if new_prefix is None:
+                    new_prefix = genbank_new_prefix(record)
+                for feature in record.features:
+                    if 'locus_tag' in feature.qualifiers:
+                        if fix_name:
+                            feature_id = feature.qualifiers['locus_tag'][0]
+                            if feature_id not in feature_id_mappings:
+                                new_gene_id = new_prefix + '_' + str(gene_number)
+                                new_feature_id = adapt_gene_id(new_gene_id, len(str(number_genes_genbanks)))
+                                feature_id_mappings[feature_id] = new_feature_id
+                                feature.qualifiers['locus_tag'][0] = new_feature_id
+                                feature.qualifiers['old_locus_tag'] = feature_id
+                                gene_number += 1
+                            else:
+                                feature.qualifiers['locus_tag'][0] = feature_id_mappings[feature_id]
+                                feature.qualifiers['old_locus_tag'] = feature_id
+                        if fix_dot_protein_seq:
+                            if 'translation' in feature.qualifiers:
+                                feature.qualifiers['translation'] = feature.qualifiers['translation'][0].replace('.', '')
+                if faa_file:
+                    genbank_record_to_faa(record, faa_file, fasta_ids, verbose)
+                yield record
 
     # Create genbank with renamed id.
     new_genbank_path = studied_organisms_path + '/' + genbank_file_name + '/' + genbank_file_name + '_tmp.gbk'
-    SeqIO.write(new_records, new_genbank_path, 'genbank')
+    with open(new_genbank_path, 'w', encoding='utf-8', errors='surrogateescape') as new_genbank_file:
+        if faa_path:
+            with open(faa_path, 'w') as faa_file:
+                SeqIO.write(fix_records(faa_file), new_genbank_file, 'genbank')
+        else:
+            SeqIO.write(fix_records(None), new_genbank_file, 'genbank')
+
+    if fix_name:
+        # Create a TSV mapping file with original and renamed ids.
+        mapping_dic_path = studied_organisms_path + '/' + genbank_file_name + '/' + genbank_file_name + '_dict.csv'
+        with open(mapping_dic_path, 'w', encoding='utf-8', errors='surrogateescape') as csv_file:
+            writer = csv.writer(csv_file, delimiter='\t')
+            writer.writerow(["original_gene_id", "renamed_gene_id"])
+            for key, value in list(feature_id_mappings.items()):
+                writer.writerow([key, value])
 
     # Save original genbank.
     os.rename(genbank_path, genbank_path_renamed)
@@ -329,3 +654,5 @@ def fix_genbank_file(genbank_file_name, fix_name, fix_dot_protein_seq, studied_o
 
     if verbose:
         print(genbank_file_name + ' ids have been renamed.')
+
+    return True
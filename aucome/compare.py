@@ -13,15 +13,12 @@ options:
 
 import csv
 import docopt
-import matplotlib.pyplot as plt
 import os
-import pandas as pa
+import sys
 import time
 
-from aucome.utils import parse_config_file
-from padmet.classes.padmetRef import PadmetRef
-from padmet.utils.exploration import compare_padmet, dendrogram_reactions_distance
-from supervenn import supervenn
+from aucome.reaction_matrix import get_reaction_matrix
+from aucome.utils import get_run_context, StepTelemetry
 
 
 def command_help():
@@ -57,21 +54,27 @@ def run_compare(run_id, nb_cpu_to_use, verbose):
         nb_cpu_to_use (int): number of CPU for multiprocessing
         verbose (boolean): verbose
     """
+    # Plotting libraries are only imported by the compare step (slow to import).
+    import matplotlib.pyplot as plt
+    from padmet.utils.exploration import dendrogram_reactions_distance
+    from supervenn import supervenn
+
     if verbose:
         print('--- Running compare step ---')
     compare_start_time = time.time()
-    config_data = parse_config_file(run_id)
+    step_telemetry = StepTelemetry(run_id, 'compare')
+    run_context = get_run_context(run_id)
 
-    analysis_path = config_data['analysis_path']
-    analysis_group_file_path = config_data['analysis_group_file_path']
+    analysis_path = run_context.analysis_path
+    analysis_group_file_path = run_context.analysis_group_file_path
     compare_output_path = analysis_path + '/compare_group'
 
-    database_path = config_data['database_path']
-    padmet_from_networks_path = config_data['padmet_from_networks_path']
+    database_path = run_context.database_path
+    padmet_from_networks_path = run_context.padmet_from_networks_path
 
     # Create a dictionary containing the group name and the species inside the group.
     group_data = {}
-    padmets = []
+    all_species = []
     with open(analysis_group_file_path, 'r') as group_file:
         group_reader = csv.reader(group_file, delimiter='\t')
         cluster_reactions = {}
@@ -80,24 +83,21 @@ def run_compare(run_id, nb_cpu_to_use, verbose):
             groups = [species for species in row[1:] if species != '']
             group_data[group_name] = groups
             if group_name != 'all':
-                padmets.extend([padmet_from_networks_path + '/' + species + '.padmet' for species in groups])
-
-    padmets = list(set(padmets))
+                all_species.extend([species for species in groups if species not in all_species])
 
     if not os.path.isdir(compare_output_path):
         os.mkdir(compare_output_path)
 
-    padmetref = PadmetRef(database_path)
-    # Create the reactions.tsv file needed to create dendrogram.
-    padmet_path = ','.join(padmets)
-    compare_padmet.compare_padmet(padmet_path=padmet_path, output=compare_output_path, padmetRef=padmetref, verbose=verbose)
+    with step_telemetry.stage('reaction_matrix'):
+        reaction_matrix = get_reaction_matrix(run_id, nb_cpu_to_use, verbose)
+    for species in all_species:
+        if species not in reaction_matrix.organism_indexes:
+            sys.exit("Padmet file of organism %s not found in %s" %(species, padmet_from_networks_path))
 
-    # Read the reactions.tsv file and remove the column unused.
+    with step_telemetry.stage('compare_padmet'):
+        # Create the reactions.tsv file needed to create dendrogram.
+        reaction_matrix.write_comparison(all_species, compare_output_path, verbose)
     reactions_file = compare_output_path + '/' + 'reactions.tsv'
-    reactions_dataframe = pa.read_csv(reactions_file, sep='\t')
-    columns = [column for column in reactions_dataframe.columns if '(sep=;)' not in column and '_formula' not in column]
-    reactions_dataframe = reactions_dataframe[columns].copy()
-    reactions_dataframe.set_index('reaction', inplace=True)
 
     # For each group, extract the reactions present in its species to create supervenn sets.
     supervenn_sets = []
@@ -105,19 +105,18 @@ def run_compare(run_id, nb_cpu_to_use, verbose):
     for group_name in group_data:
         if group_name != 'all':
             groups = group_data[group_name]
-            reactions_temp = []
-            for species in groups:
-                species_reactions_dataframe = reactions_dataframe[reactions_dataframe[species] == 1]
-                reactions_temp.extend(species_reactions_dataframe.index.tolist())
-            supervenn_sets.append(set(reactions_temp))
+            group_reactions = reaction_matrix.group_reactions(groups)
+            supervenn_sets.append(group_reactions)
             supervenn_labels.append(group_name)
-            cluster_reactions[group_name] = set(reactions_temp)
+            cluster_reactions[group_name] = group_reactions
 
-    supervenn(supervenn_sets, supervenn_labels, chunks_ordering='occurrence', sets_ordering='minimize gaps')
-    plt.savefig(compare_output_path + '/compare_group.png', bbox_inches='tight')
-    plt.clf()
+    with step_telemetry.stage('supervenn'):
+        supervenn(supervenn_sets, supervenn_labels, chunks_ordering='occurrence', sets_ordering='minimize gaps')
+        plt.savefig(compare_output_path + '/compare_group.png', bbox_inches='tight')
+        plt.clf()
 
-    dendrogram_reactions_distance.reaction_figure_creation(reactions_file, os.path.join(compare_output_path, "dendrogram_output"), padmetRef_file=database_path, verbose=verbose)
+    with step_telemetry.stage('dendrogram'):
+        dendrogram_reactions_distance.reaction_figure_creation(reactions_file, os.path.join(compare_output_path, "dendrogram_output"), padmetRef_file=database_path, verbose=verbose)
 
     compare_end_time = (time.time() - compare_start_time)
     integer_part, decimal_part = str(compare_end_time).split('.')
@@ -125,3 +124,4 @@ def run_compare(run_id, nb_cpu_to_use, verbose):
 
     if verbose:
         print("--- compare step done in: %ss ---" %compare_time)
+    step_telemetry.write(verbose)
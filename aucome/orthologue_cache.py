@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Binary cache of the OrthoFinder orthologues files (Orthologues_*/org_A__v__org_B.tsv), shared by the orthology step.
+
+The orthologues files are read once and stored in the orthologue_cache folder of orthofinder_wd_path:
+    manifest.json: path to the Orthologues folder, size and modification time of the orthologues files and the organisms of each file.
+    gene_names.npy, gene_offsets.npy: gene IDs (interned, utf-8 encoded and concatenated) and the offset of each gene ID.
+    pair_indptr.npy: rows of each orthologues file (org_A, org_B) in row_genes.
+    row_genes.npy, row_indptr.npy, orthologue_genes.npy: for each row, a gene of org_A and its orthologue genes of org_B (CSR adjacency).
+The arrays are memory-mapped, so the workers share them without reading the orthologues files.
+The cache is created again if an orthologues file or the OrthoFinder results folder changed.
+"""
+
+import csv
+import json
+import numpy as np
+import os
+import shutil
+
+CACHE_ARRAYS = ['gene_names', 'gene_offsets', 'pair_indptr', 'row_genes', 'row_indptr', 'orthologue_genes']
+
+
+class OrthologueCache:
+    """Orthologues of each pair of organisms of the OrthoFinder results.
+
+    Args:
+        cache_path (str): path to the folder of the cache
+    """
+
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        with open(os.path.join(cache_path, 'manifest.json'), 'r') as manifest_file:
+            self.manifest = json.load(manifest_file)
+        self.pair_indexes = dict([(tuple(org_pair), pair_index) for pair_index, org_pair in enumerate(self.manifest['pairs'])])
+        for array_name in CACHE_ARRAYS:
+            setattr(self, array_name, np.load(os.path.join(cache_path, array_name + '.npy'), mmap_mode='r'))
+        self._gene_ids = None
+
+    def gene_ids(self):
+        """Decode the interned gene IDs.
+
+        Returns:
+            list: gene IDs, the index of a gene ID is its code in row_genes and orthologue_genes
+        """
+        if self._gene_ids is None:
+            gene_names = self.gene_names.tobytes()
+            self._gene_ids = [gene_names[start:end].decode('utf-8')
+                              for start, end in zip(self.gene_offsets[:-1].tolist(), self.gene_offsets[1:].tolist())]
+        return self._gene_ids
+
+    def orthologues(self, org_A, org_B):
+        """Orthologues of the genes of org_A in org_B (as read in org_A__v__org_B.tsv).
+
+        Args:
+            org_A (str): ID of the first organism
+            org_B (str): ID of the second organism
+        Returns:
+            dict: k = gene_id of org_A, v = set of gene orthologue id of org_B (empty if there is no orthologues file)
+        """
+        if (org_A, org_B) not in self.pair_indexes:
+            return {}
+        gene_ids = self.gene_ids()
+        pair_index = self.pair_indexes[(org_A, org_B)]
+        row_start, row_end = int(self.pair_indptr[pair_index]), int(self.pair_indptr[pair_index + 1])
+        row_genes = self.row_genes[row_start:row_end].tolist()
+        row_indptr = self.row_indptr[row_start:row_end + 1].tolist()
+        orthologue_genes = self.orthologue_genes[row_indptr[0]:row_indptr[-1]].tolist()
+        offset = row_indptr[0]
+        return dict([(gene_ids[gene_code], set([gene_ids[orthologue_code] for orthologue_code in orthologue_genes[start - offset:end - offset]]))
+                     for gene_code, start, end in zip(row_genes, row_indptr[:-1], row_indptr[1:])])
+
+
+def read_orthologue_pair(orthologue_file):
+    """
+    Read an OrthoFinder orthologues file org_A__v__org_B.tsv.
+    If a gene of org_A is in several rows, its orthologues are the ones of the last row.
+    Args:
+        orthologue_file (str): path to the orthologues file
+    Returns:
+        tuple: org_A, org_B and dict: k = gene_id of org_A, v = list of gene orthologue id of org_B (in the order of the file)
+    """
+    dict_orthologues = {}
+    with open(orthologue_file, 'r') as csvfile:
+        reader = csv.DictReader(csvfile, delimiter = "\t")
+        orgs = list(reader.fieldnames)
+        orgs.remove('Orthogroup')
+        org_A, org_B = orgs
+        for row in reader:
+            gene_ids_A = [gene_id.split("_isoform")[0] for gene_id in row[org_A].split(", ")]
+            gene_ids_B = list(dict.fromkeys([gene_id.split("_isoform")[0] for gene_id in row[org_B].split(", ")]))
+            for gene_id_A in gene_ids_A:
+                dict_orthologues[gene_id_A] = gene_ids_B
+    return org_A, org_B, dict_orthologues
+
+
+def orthologue_file_stamps(orthodata_path):
+    """
+    Size and modification time of the OrthoFinder orthologues files.
+    Args:
+        orthodata_path (str): path to Orthologues files
+    Returns:
+        dict: k = path to the orthologues file relative to orthodata_path, v = [size, modification time]
+    """
+    orthologue_stamps = {}
+    for _path, _folders, _files in os.walk(orthodata_path):
+        for _file in _files:
+            if '__v__' in _file:
+                orthologue_file = os.path.join(_path, _file)
+                orthologue_stat = os.stat(orthologue_file)
+                orthologue_stamps[os.path.relpath(orthologue_file, orthodata_path)] = [orthologue_stat.st_size, orthologue_stat.st_mtime_ns]
+    return orthologue_stamps
+
+
+def get_orthologue_cache(orthodata_path, cache_path, aucome_pool, verbose=None):
+    """Get the cache of the orthologues files of orthodata_path, it is created if it does not exist or if the orthologues files changed.
+
+    Args:
+        orthodata_path (str): path to Orthologues files
+        cache_path (str): path to the folder of the cache
+        aucome_pool (multiprocessing.Pool): pool used to read the orthologues files in parallel
+        verbose (boolean): verbose
+    Returns:
+        OrthologueCache: the cache
+    """
+    orthologue_stamps = orthologue_file_stamps(orthodata_path)
+    manifest_path = os.path.join(cache_path, 'manifest.json')
+    if os.path.exists(manifest_path):
+        try:
+            with open(manifest_path, 'r') as manifest_file:
+                manifest = json.load(manifest_file)
+            if manifest['orthodata_path'] == os.path.abspath(orthodata_path) and manifest['stamps'] == orthologue_stamps:
+                if verbose:
+                    print('Orthologues already read in ' + cache_path)
+                return OrthologueCache(cache_path)
+        except (ValueError, KeyError):
+            pass
+
+    if verbose:
+        print('Read %s orthologues files in %s' %(len(orthologue_stamps), cache_path))
+
+    gene_codes = {}
+    org_pairs = []
+    pair_indptr = [0]
+    row_genes = []
+    row_indptr = [0]
+    orthologue_genes = []
+    orthologue_files = [os.path.join(orthodata_path, orthologue_file) for orthologue_file in sorted(orthologue_stamps)]
+    for org_A, org_B, gene_orthologues in aucome_pool.imap(read_orthologue_pair, orthologue_files):
+        org_pairs.append([org_A, org_B])
+        for gene_id_A, gene_ids_B in gene_orthologues.items():
+            row_genes.append(gene_codes.setdefault(gene_id_A, len(gene_codes)))
+            orthologue_genes.extend([gene_codes.setdefault(gene_id_B, len(gene_codes)) for gene_id_B in gene_ids_B])
+            row_indptr.append(len(orthologue_genes))
+        pair_indptr.append(len(row_genes))
+
+    encoded_gene_ids = [gene_id.encode('utf-8') for gene_id in gene_codes]
+    gene_offsets = np.zeros(len(encoded_gene_ids) + 1, dtype=np.int64)
+    gene_offsets[1:] = np.cumsum([len(encoded_gene_id) for encoded_gene_id in encoded_gene_ids], dtype=np.int64)
+    cache_arrays = {'gene_names': np.frombuffer(b''.join(encoded_gene_ids), dtype=np.uint8),
+                    'gene_offsets': gene_offsets,
+                    'pair_indptr': np.array(pair_indptr, dtype=np.int64),
+                    'row_genes': np.array(row_genes, dtype=np.int32),
+                    'row_indptr': np.array(row_indptr, dtype=np.int64),
+                    'orthologue_genes': np.array(orthologue_genes, dtype=np.int32)}
+    manifest = {'orthodata_path': os.path.abspath(orthodata_path), 'stamps': orthologue_stamps, 'pairs': org_pairs}
+
+    # Write the cache in a temporary folder then rename it, so a cache is never partially written.
+    tmp_cache_path = cache_path + '.' + str(os.getpid()) + '.tmp'
+    if os.path.exists(tmp_cache_path):
+        shutil.rmtree(tmp_cache_path)
+    os.makedirs(tmp_cache_path)
+    for array_name, cache_array in cache_arrays.items():
+        np.save(os.path.join(tmp_cache_path, array_name + '.npy'), cache_array)
+    with open(os.path.join(tmp_cache_path, 'manifest.json'), 'w') as manifest_file:
+        json.dump(manifest, manifest_file)
+    if os.path.exists(cache_path):
+        shutil.rmtree(cache_path)
+    os.rename(tmp_cache_path, cache_path)
+
+    return OrthologueCache(cache_path)
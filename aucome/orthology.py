@@ -2,7 +2,7 @@
 # -*- coding: utf-8 -*-
 """
 usage:
-     aucome orthology --run=ID [--sequence_search_prg=STR] [--cpu=INT] [-v] [--vv] [--filtering] [--threshold=FLOAT] [--union] [--intersection]
+     aucome orthology --run=ID [--sequence_search_prg=STR] [--cpu=INT] [-v] [--vv] [--filtering] [--threshold=FLOAT] [--union] [--intersection] [--sbml]
      
 options:
      --run=ID    Pathname to the comparison workspace.
@@ -15,23 +15,32 @@ options:
      --threshold=FLOAT     Threshold of the filter to limit propagation to use with the --filtering argument.
     --union          Use the union filter between five threshold values [0.01, 0.05, 0.1, 0.15, 0.2] to limit propagation, to use with the --filtering argument.
     --intersection   Use the intersection filter between five threshold values [0.01, 0.05, 0.1, 0.15, 0.2] to limit propagation, to use with the --filtering argument.
+    --sbml    Also write the SBML files of the reactions propagated from each model (in 1_sbml_orthology).
 """
 
 import csv
 import docopt
+import libsbml
+import numpy as np
 import os
+import pickle
+import re
 import subprocess
 import shutil
 import sys
 import time
 
-from padmet.classes import PadmetSpec
+from padmet.classes import Node, PadmetSpec, Relation
+from padmet.utils import gbr, sbmlPlugin
 from padmet.utils.exploration import convert_sbml_db
 from padmet.utils.connection import extract_orthofinder
-from padmet.utils.connection import sbml_to_padmet, sbmlGenerator
+from padmet.utils.connection import sbml_to_padmet
 
-from aucome.utils import parse_config_file
-from multiprocessing import Pool
+from aucome.orthologue_cache import get_orthologue_cache, OrthologueCache
+from aucome.utils import get_run_context, load_padmet_ref, create_aucome_pool, file_hash, get_workspace_inventory, RelationIndex, StepTelemetry
+
+# Models of the store already loaded by this worker, k = path to the pickle of the model, v = ((size, mtime), reactions and species of the model).
+MODEL_STORE_LOADED = {}
 
 
 def command_help():
@@ -49,6 +58,7 @@ def orthology_parse_args(command_args):
     threshold = args['--threshold']
     union = args['--union']
     intersection = args['--intersection']
+    sbml = args['--sbml']
     filtering_threshold_list = []
     
     if filtering:
@@ -77,31 +87,39 @@ def orthology_parse_args(command_args):
     if veryverbose and not verbose:
         verbose = veryverbose
 
-    run_orthology(run_id, sequence_search_prg, nb_cpu_to_use, filtering_threshold_list, union, intersection, verbose, veryverbose)
+    run_orthology(run_id, sequence_search_prg, nb_cpu_to_use, filtering_threshold_list, union, intersection, verbose, veryverbose, sbml=sbml)
 
 
-def run_orthology(run_id, sequence_search_prg, nb_cpu_to_use, filtering_threshold_list, union, intersection, verbose, veryverbose=None):
+def run_orthology(run_id, sequence_search_prg, nb_cpu_to_use, filtering_threshold_list, union, intersection, verbose, veryverbose=None, aucome_pool=None,
+                  sbml=None):
     print('--- Running orthology step ---')
     orthology_start_time = time.time()
-    aucome_pool = Pool(nb_cpu_to_use)
-    config_data = parse_config_file(run_id)
-
-    orthofinder_wd_path = config_data['orthofinder_wd_path']
-    orthofinder_bin_path = config_data['orthofinder_bin_path']
-    orthofinder_sbml_path = config_data['orthofinder_sbml_path']
-    orthofinder_padmet_path = config_data['orthofinder_padmet_path']
-    orthofinder_filtered_path = config_data['orthofinder_filtered_path']
-    studied_organisms_path = config_data['studied_organisms_path']
-    padmet_from_annotation_path = config_data['padmet_from_annotation_path']
-    database_path = config_data['database_path']
-
-    all_study_name = set(next(os.walk(studied_organisms_path))[1])
+    step_telemetry = StepTelemetry(run_id, 'orthology')
+    run_context = get_run_context(run_id)
+    close_pool = aucome_pool is None
+    if close_pool:
+        # Load the padmet of reference before creating the pool, so the forked workers share it.
+        if os.path.exists(run_context.database_path):
+            load_padmet_ref(run_context.database_path, verbose, run_context.cache_path)
+        aucome_pool = create_aucome_pool(nb_cpu_to_use)
+
+    orthofinder_wd_path = run_context.orthofinder_wd_path
+    orthofinder_bin_path = run_context.orthofinder_bin_path
+    orthofinder_sbml_path = run_context.orthofinder_sbml_path
+    orthofinder_padmet_path = run_context.orthofinder_padmet_path
+    orthofinder_filtered_path = run_context.orthofinder_filtered_path
+    padmet_from_annotation_path = run_context.padmet_from_annotation_path
+    database_path = run_context.database_path
+
+    workspace_inventory = get_workspace_inventory(run_id)
+    all_study_name = workspace_inventory.organisms()
     
-    all_study_faa = dict([(study_name, "{0}/{1}/{1}.faa".format(studied_organisms_path, study_name))
-                          if os.path.isfile("{0}/{1}/{1}.faa".format(studied_organisms_path, study_name))
-                          else (study_name, '')
+    all_study_faa = dict([(study_name, workspace_inventory.organism_files(study_name)['faa'])
                           for study_name in all_study_name])
 
+    # Finish or clean the replacement of the OrthoFinder results of a previous run stopped during it.
+    recover_orthofinder_results(orthofinder_wd_path, verbose)
+
     #check if Orthofinder already run, if yes, get the last workdir.
     try:
     #    if orthogroups:
@@ -113,22 +131,39 @@ def run_orthology(run_id, sequence_search_prg, nb_cpu_to_use, filtering_threshol
             print("Unable to find file Orthogroups.tsv in {0}, need to run Orthofinder...".format(orthofinder_wd_path))
         orthodata_path = None
 
+    # k = species, v = set of species whose orthologues with this species changed since the previous OrthoFinder run.
+    dict_study_changed_models = {}
+
     # If there is already an orthofinder result, check if all the species are in it.
     if orthodata_path:
         wd_orthodata_path = max(["%s/%s" %(x[0], 'WorkingDirectory') for x in os.walk(orthofinder_wd_path) if 'WorkingDirectory' in x[1]])
 
-        input_fasta = [fasta_name for fasta_name in all_study_faa]
-        already_analysed_fasta = [fasta_name.replace('.faa', '') for fasta_name in os.listdir(orthofinder_wd_path) if fasta_name != 'OrthoFinder']
+        input_fasta = set(all_study_faa)
+        # The proteomes given to OrthoFinder are copied in orthofinder_wd_path, a species is analysed if it is also in the OrthoFinder results
+        # (its proteome can be copied before the results of a run stopped before the end are replaced).
+        result_species = set([folder_name.replace('Orthologues_', '') for folder_name in next(os.walk(orthodata_path))[1]
+                              if folder_name.startswith('Orthologues_')])
+        already_analysed_fasta = set([fasta_name[:-len('.faa')] for fasta_name in os.listdir(orthofinder_wd_path)
+                                      if fasta_name.endswith('.faa') and os.path.isfile(os.path.join(orthofinder_wd_path, fasta_name))
+                                      and fasta_name[:-len('.faa')] in result_species])
+
+        removed_fasta = already_analysed_fasta - input_fasta
+        if removed_fasta:
+            print('Species in the OrthoFinder results but not in the studied organisms: ' + ','.join(sorted(removed_fasta))
+                  + ', delete ' + orthofinder_wd_path + ' to run OrthoFinder without them.')
 
         # If there is missing species, rerun OrthoFinder to add the missing species.
-        if len(already_analysed_fasta) != len(input_fasta):
-            fasta_to_adds = set(input_fasta) - set(already_analysed_fasta)
+        fasta_to_adds = input_fasta - already_analysed_fasta
+        if fasta_to_adds:
             tmp_folder = orthofinder_wd_path + '/tmp/'
             os.mkdir(tmp_folder)
 
             print('There is missing species in orthofinder: ' + ','.join(list(fasta_to_adds)))
             print('Rerun OrthoFinder on them using the old results from '+ orthofinder_wd_path)
 
+            # Fingerprints of the old orthologues, to find the orthologue relations changed by the new species.
+            old_orthologue_hashes = orthologue_pair_hashes(orthodata_path)
+
             for name, faa_path in list(all_study_faa.items()):
                 if name in fasta_to_adds:
                     if not os.path.isfile("{0}/{1}.faa".format(tmp_folder, name)):
@@ -144,7 +179,8 @@ def run_orthology(run_id, sequence_search_prg, nb_cpu_to_use, filtering_threshol
             cmds = [orthofinder_bin_path, "-b", wd_orthodata_path, "-f", tmp_folder,
                     "-t", str(nb_cpu_to_use), "-S", sequence_search_prg]
                        
-            subprocess.call(cmds)
+            with step_telemetry.stage('orthofinder'):
+                subprocess.call(cmds)
             end_time = (time.time() - start_time)
             integer_part, decimal_part = str(end_time).split('.')
             end_time = ".".join([integer_part, decimal_part[:3]])
@@ -157,30 +193,45 @@ def run_orthology(run_id, sequence_search_prg, nb_cpu_to_use, filtering_threshol
             shutil.rmtree(tmp_folder)
 
             # Replace the old OrthoFinder results folder with the new one.
+            # The new results are inside the old results folder, so they are first moved next to it.
+            # Renames are used instead of copies, the results folder is never partially written.
             new_orthofidner_path = max(["%s/%s" %(x[0], 'OrthoFinder') for x in os.walk(wd_orthodata_path) if 'OrthoFinder' in x[1]])
 
             orthofinder_tmp = orthofinder_wd_path + '/OrthoFinder_tmp'
+            orthofinder_old = orthofinder_wd_path + '/OrthoFinder_old'
 
-            shutil.copytree(new_orthofidner_path, orthofinder_tmp)
-            shutil.rmtree(orthofinder_result_path)
-            shutil.copytree(orthofinder_tmp, orthofinder_result_path)
-            shutil.rmtree(orthofinder_tmp)
+            os.rename(new_orthofidner_path, orthofinder_tmp)
+            os.rename(orthofinder_result_path, orthofinder_old)
+            os.rename(orthofinder_tmp, orthofinder_result_path)
+            shutil.rmtree(orthofinder_old)
 
             #if orthogroups:
             #    orthodata_path = max(["%s/%s" %(x[0], 'Orthogroups/Orthogroups.tsv') for x in os.walk(orthofinder_wd_path) if 'Orthogroups' in x[1]])
             #else:
             orthodata_path = max(["%s/%s" %(x[0], 'Orthologues') for x in os.walk(orthofinder_wd_path) if 'Orthologues' in x[1]])
 
-            # Clean sbml/padmet/padmet filtered to recreate them with the new data.
-            for sbml_folder in os.listdir(orthofinder_sbml_path):
-                shutil.rmtree(orthofinder_sbml_path + '/' + sbml_folder)
-
-            for padmet_folder in os.listdir(orthofinder_padmet_path):
-                os.remove(orthofinder_padmet_path + '/' + padmet_folder)
-
+            # Find the orthologue relations changed by the new species.
+            new_orthologue_hashes = orthologue_pair_hashes(orthodata_path)
+            for org_pair in set(old_orthologue_hashes).union(set(new_orthologue_hashes)):
+                if old_orthologue_hashes.get(org_pair) != new_orthologue_hashes.get(org_pair):
+                    model_id, study_id = org_pair
+                    if study_id not in dict_study_changed_models:
+                        dict_study_changed_models[study_id] = set()
+                    dict_study_changed_models[study_id].add(model_id)
+
+            # Clean the padmets of the species with changed orthologues to recreate them with the new data.
+            for study_id in dict_study_changed_models:
+                study_padmet = os.path.join(orthofinder_padmet_path, study_id + '.padmet')
+                if os.path.exists(study_padmet):
+                    os.remove(study_padmet)
+
+            # The filtering uses the propagation in all the species, all the filtered padmets are recreated.
             for filtered_padmet_folder in os.listdir(orthofinder_filtered_path):
                 os.remove(orthofinder_filtered_path + '/' + filtered_padmet_folder)
 
+            if verbose:
+                print('Species with changed orthologues: ' + ','.join(sorted(dict_study_changed_models)))
+
     # If there is no OrthoFinder results folder run OrthoFinder on all the fasta.
     elif not orthodata_path:
         for name, faa_path in list(all_study_faa.items()):
@@ -197,7 +248,8 @@ def run_orthology(run_id, sequence_search_prg, nb_cpu_to_use, filtering_threshol
 
         start_time = time.time()
         cmds = [orthofinder_bin_path, "-f", orthofinder_wd_path, "-t", str(nb_cpu_to_use), "-S", sequence_search_prg]
-        subprocess.call(cmds)
+        with step_telemetry.stage('orthofinder'):
+            subprocess.call(cmds)
         end_time = (time.time() - start_time)
         integer_part, decimal_part = str(end_time).split('.')
         end_time = ".".join([integer_part, decimal_part[:3]])
@@ -217,66 +269,62 @@ def run_orthology(run_id, sequence_search_prg, nb_cpu_to_use, filtering_threshol
     if verbose:
         print("Parsing Orthofinder output %s" %orthodata_path)
 
-    if verbose:
-        print("Start sbml creation...")
-    all_dict_data = []
-    for study_name in all_study_name:
-        output_sbml = os.path.join(orthofinder_sbml_path, study_name)
-        if os.path.exists(output_sbml):
-            print(output_sbml + " already exists, delete it if you want to relaunch ortholog creation.")
-        else:
-            dict_data = {'sbml': run_id, 'orthodata_path': orthodata_path,
-                         'study_name': study_name, 'verbose': verbose,
-                         'veryverbose': veryverbose, 'output': output_sbml}
-            all_dict_data.append(dict_data)
-
-    start_time = time.time()
-    aucome_pool.map(orthogroup_to_sbml, all_dict_data)
-    end_time = (time.time() - start_time)
-    integer_part, decimal_part = str(end_time).split('.')
-    end_time = ".".join([integer_part, decimal_part[:3]])
-    if verbose:
-        print("Orthofinder output parsed in: %ss" %end_time)
-    """
-    #check database, mapping to metacyc ???
-    data_convert_sbml_db = []
-    for dict_data in all_dict_data:
-        tmp_dict_data = {'sbml': orthology_based_path + '/' + study_name, 
-                         'mnx_rxn_path': mnx_rxn_path, 'mnx_cpd_path': mnx_cpd_path, 'verbose': verbose}
-        data_convert_sbml_db.append(tmp_dict_data)
-        
-    aucome_pool.map(_convert_sbml_db, data_convert_sbml_db)
-    """
-
     if verbose:
         if len(filtering_threshold_list)>0 :
             print("Start padmet creation and filtering...")
         else:
             print("Start padmet creation...")
 
-    multiprocessing_datas = []
-    update_padmet_datas = []
-    for sbml in os.listdir(orthofinder_sbml_path):
-        input_pwt_padmet = padmet_from_annotation_path + '/output_pathwaytools_' + sbml + '.padmet'
-        output_padmet = orthofinder_padmet_path + '/' + sbml + '.padmet'
+    orthologue_cache_path = os.path.join(orthofinder_wd_path, 'orthologue_cache')
+    model_store_path = os.path.join(os.path.dirname(orthodata_path), 'Orthologues_models')
+    # Species of the OrthoFinder results (one Orthologues_<species> folder by species) and their sbml used as model.
+    model_ids = sorted([folder_name.replace('Orthologues_', '') for folder_name in next(os.walk(orthodata_path))[1]
+                        if folder_name.startswith('Orthologues_')])
+    all_model_sbml = extract_orthofinder.get_sbml_files(run_id, workflow="aucome", verbose=veryverbose)
+    organism_datas = []
+    organism_names = []
+    for study_name in all_study_name:
+        # The sbml of the orthologue reactions are only written if asked (the padmet is created without them).
+        output_sbml = os.path.join(orthofinder_sbml_path, study_name)
+        if not sbml:
+            output_sbml = None
+        elif os.path.exists(output_sbml) and study_name not in dict_study_changed_models:
+            print(output_sbml + " already exists, delete it if you want to relaunch ortholog creation.")
+            output_sbml = None
+
+        input_pwt_padmet = padmet_from_annotation_path + '/output_pathwaytools_' + study_name + '.padmet'
+        output_padmet = orthofinder_padmet_path + '/' + study_name + '.padmet'
         if os.path.exists(output_padmet):
             print(output_padmet + " already exists, delete it if you want to relaunch ortholog creation.")
-        else:
-            multiprocessing_datas.append([sbml, orthofinder_sbml_path, input_pwt_padmet,
-                            database_path, output_padmet, orthodata_path,
-                            orthofinder_filtered_path, filtering_threshold_list, verbose, veryverbose])
-            update_padmet_datas.append([sbml, orthodata_path, output_padmet, verbose])
+            output_padmet = None
+
+        if output_sbml or output_padmet:
+            organism_data = {'study_name': study_name, 'model_ids': model_ids, 'all_model_sbml': all_model_sbml, 'model_store_path': model_store_path,
+                             'orthologue_cache_path': orthologue_cache_path,
+                             'input_pwt_padmet': input_pwt_padmet, 'database_path': database_path,
+                             'output_padmet': output_padmet, 'output_sbml': output_sbml,
+                             'verbose': verbose, 'veryverbose': veryverbose}
+            organism_datas.append([organism_data])
+            organism_names.append(study_name)
 
     start_time = time.time()
-    aucome_pool.starmap(orthology_to_padmet, multiprocessing_datas)
+    # The orthologues and the reactions of the models are shared by the species, they are read before the species tasks.
+    if organism_datas:
+        if verbose:
+            print("Reading the orthologues...")
+        with step_telemetry.stage('orthologue_cache'):
+            get_orthologue_cache(orthodata_path, orthologue_cache_path, aucome_pool, veryverbose)
+        if verbose:
+            print("Reading the sbml of the models...")
+        with step_telemetry.stage('model_store'):
+            create_model_store(all_model_sbml, model_ids, model_store_path, aucome_pool)
 
-    # Add the orthologs to the padmets.
-    if verbose:
-        print("Updating padmets...")
-    aucome_pool.starmap(addOrthologyInPadmet, update_padmet_datas)
+    # One task by species: its padmet (and sbml) are created from the orthologues with all the models.
+    step_telemetry.map(aucome_pool, 'orthology_organism', orthology_organism, organism_datas, organism_names)
 
     if len(filtering_threshold_list)>0:
-        filter_propagation(orthofinder_padmet_path, orthofinder_filtered_path, aucome_pool, filtering_threshold_list, union, intersection, verbose)
+        with step_telemetry.stage('filtering'):
+            filter_propagation(orthofinder_padmet_path, orthofinder_filtered_path, aucome_pool, filtering_threshold_list, union, intersection, verbose)
    
     end_time = (time.time() - start_time)
     integer_part, decimal_part = str(end_time).split('.')
@@ -284,8 +332,13 @@ def run_orthology(run_id, sequence_search_prg, nb_cpu_to_use, filtering_threshol
     if verbose:
         print("Padmet created in: %ss" %end_time)
 
-    aucome_pool.close()
-    aucome_pool.join()
+    # The orthology outputs have been written by the workers and by OrthoFinder.
+    for output_path in [orthofinder_wd_path, orthofinder_sbml_path, orthofinder_padmet_path, orthofinder_filtered_path]:
+        workspace_inventory.refresh(output_path)
+
+    if close_pool:
+        aucome_pool.close()
+        aucome_pool.join()
 
     orthology_end_time = (time.time() - orthology_start_time)
     integer_part, decimal_part = str(orthology_end_time).split('.')
@@ -293,6 +346,40 @@ def run_orthology(run_id, sequence_search_prg, nb_cpu_to_use, filtering_threshol
 
     if verbose:
         print("--- orthology step done in: %ss ---" %orthology_time)
+    step_telemetry.write(verbose)
+
+
+def recover_orthofinder_results(orthofinder_wd_path, verbose=None):
+    """
+    Finish the replacement of the OrthoFinder results (OrthoFinder by OrthoFinder_tmp, the old results being moved to OrthoFinder_old)
+    if a previous run stopped during it, and delete the proteomes folder (tmp) of an OrthoFinder run stopped before its end.
+    OrthoFinder_tmp is only created from the complete results of OrthoFinder, so it replaces the results.
+    Args:
+        orthofinder_wd_path (str): path to the OrthoFinder working directory
+        verbose (bool): verbose
+    """
+    orthofinder_result_path = os.path.join(orthofinder_wd_path, 'OrthoFinder')
+    orthofinder_tmp = os.path.join(orthofinder_wd_path, 'OrthoFinder_tmp')
+    orthofinder_old = os.path.join(orthofinder_wd_path, 'OrthoFinder_old')
+    tmp_folder = os.path.join(orthofinder_wd_path, 'tmp')
+
+    if os.path.isdir(orthofinder_tmp):
+        if verbose:
+            print('Replace the OrthoFinder results with ' + orthofinder_tmp + ' (from a previous run stopped before the end).')
+        if os.path.isdir(orthofinder_result_path):
+            if os.path.isdir(orthofinder_old):
+                shutil.rmtree(orthofinder_old)
+            os.rename(orthofinder_result_path, orthofinder_old)
+        os.rename(orthofinder_tmp, orthofinder_result_path)
+    if os.path.isdir(orthofinder_old):
+        if verbose:
+            print('Delete the old OrthoFinder results ' + orthofinder_old)
+        shutil.rmtree(orthofinder_old)
+    # The proteomes of this folder have not been copied in orthofinder_wd_path, so these species will be added again.
+    if os.path.isdir(tmp_folder):
+        if verbose:
+            print('Delete the proteomes of a previous OrthoFinder run stopped before the end ' + tmp_folder)
+        shutil.rmtree(tmp_folder)
 
 
 def _convert_sbml_db(data_convert_sbml_db):
@@ -314,116 +401,373 @@ def _convert_sbml_db(data_convert_sbml_db):
                 convert_sbml_db.map_sbml(sbml_file, "reaction", "metacyc", dict_file, verbose=verbose, mnx_reac_file=mnx_rxn_path, mnx_chem_file=mnx_cpd_path)
 
 
-def orthogroup_to_sbml(dict_data):
+def orthology_organism(organism_data):
     """
-    dict_orthogroup: global var
+    Run the orthology step of a species. For each model sharing orthologues with the species,
+    the reactions of the model with orthologue genes are added in the padmet of the species
+    (with the orthologues of each gene) and written in a sbml if asked.
+    The padmet is created from the annotation padmet and written once, without intermediate sbml and padmet files.
+    Args:
+        organism_data (dict): ID of the species (study_name), IDs of the species of the OrthoFinder results (model_ids),
+            sbml of the models (all_model_sbml), path to the reactions of the models read once (model_store_path),
+            path to the cache of the orthologues (orthologue_cache_path),
+            annotation padmet of the species (input_pwt_padmet), path to the database (database_path),
+            path to the output padmet, None if it already exists (output_padmet),
+            path to the output sbml folder, None if the sbml are not written (output_sbml), verbose and veryverbose
     """
-    #dict_data = {'study_name':'', 'o_compare_name': '', sbml_template':'', 'output':''}
-    sbml = dict_data['sbml']
-    orthodata_path = dict_data['orthodata_path']
-    study_name = dict_data['study_name']
-    output = dict_data['output']
-    verbose = dict_data['verbose']
-    veryverbose = dict_data['veryverbose']
-    #orthogroups = dict_data['orthogroups']
+    study_name = organism_data['study_name']
+    orthologue_cache = OrthologueCache(organism_data['orthologue_cache_path'])
+    all_model_sbml = organism_data['all_model_sbml']
+    model_store_path = organism_data['model_store_path']
+    input_pwt_padmet = organism_data['input_pwt_padmet']
+    database_path = organism_data['database_path']
+    output_padmet = organism_data['output_padmet']
+    output_sbml = organism_data['output_sbml']
+    verbose = organism_data['verbose']
+    veryverbose = organism_data['veryverbose']
+
+    if output_padmet:
+        if verbose:
+            print('Create padmet from orthologues for ' + study_name)
+        padmetRef = load_padmet_ref(database_path, veryverbose)
+        if os.path.isfile(input_pwt_padmet):
+            padmet = PadmetSpec(input_pwt_padmet)
+        else:
+            padmet = sbml_to_padmet.instantiate_padmet("PadmetSpec", database_path, study_name, verbose=veryverbose)
 
-    if verbose:
-        print('Create sbml for ' + study_name)
+    if output_sbml:
+        if verbose:
+            print('Create sbml for ' + study_name)
+        if not os.path.exists(output_sbml):
+            os.makedirs(output_sbml)
+
+    for model_id in organism_data['model_ids']:
+        if model_id == study_name:
+            continue
+        source_id = "OUTPUT_ORTHOFINDER_FROM_{0}".format(model_id).upper()
+        if output_sbml:
+            model_output_sbml = os.path.join(output_sbml, "output_orthofinder_from_{0}.sbml".format(model_id))
+            if os.path.exists(model_output_sbml):
+                os.remove(model_output_sbml)
+
+        if (model_id, study_name) not in orthologue_cache.pair_indexes:
+            continue
+        model_record = load_model_store(model_id, model_store_path)
+        if model_record is None:
+            continue
+        # k = gene of the model, v = set of orthologue genes of the species.
+        dict_model_orthologues = orthologue_cache.orthologues(model_id, study_name)
+        dict_rxn_ga = orthologue_reactions(study_name, model_id, model_record, dict_model_orthologues, veryverbose)
+        if not dict_rxn_ga:
+            continue
+
+        if output_padmet:
+            add_orthologue_model_in_padmet(padmet, padmetRef, model_record, dict_rxn_ga, source_id,
+                                           orthologue_cache.orthologues(study_name, model_id), veryverbose)
+        if output_sbml:
+            write_orthologue_sbml(all_model_sbml[model_id], dict_rxn_ga, model_output_sbml)
+
+    if output_padmet:
+        padmet.generateFile(output_padmet)
+
+
+def create_model_store(all_model_sbml, model_ids, model_store_path, aucome_pool):
+    """
+    Read the sbml of each model once and store its reactions (with their gene association) for the orthology of all the species.
+    For each model a pickle file (named with the model ID) is written in model_store_path,
+    it contains the dictionary created by read_model_sbml.
+    Args:
+        all_model_sbml (dict): k = model ID, v = path to the sbml of the model
+        model_ids (list): IDs of the species of the OrthoFinder results
+        model_store_path (str): path to the output store folder
+        aucome_pool (multiprocessing.Pool): pool used to read the sbml in parallel
+    """
+    if os.path.exists(model_store_path):
+        shutil.rmtree(model_store_path)
+    os.makedirs(model_store_path)
 
-    if veryverbose:
-        extract_orthofinder_verbose = veryverbose
-    else:
-        extract_orthofinder_verbose = False
+    multiprocessing_datas = []
+    for model_id in model_ids:
+        if model_id in all_model_sbml:
+            model_store_file = os.path.join(model_store_path, model_id + '.pkl')
+            multiprocessing_datas.append([all_model_sbml[model_id], model_store_file])
 
-    all_model_sbml = extract_orthofinder.get_sbml_files(sbml, workflow="aucome", verbose=extract_orthofinder_verbose)
-    #if orthogroups:
-    #    extract_orthofinder.orthogroups_to_sbml(orthodata_path, all_model_sbml, output, study_name, extract_orthofinder_verbose)
-    #else:
-    extract_orthofinder.orthologue_to_sbml(orthodata_path, all_model_sbml, output, study_name, extract_orthofinder_verbose)
+    aucome_pool.starmap(mp_create_model_store, multiprocessing_datas)
 
 
-def orthology_to_padmet(sbml, orthofinder_sbml_path, input_pwt_padmet,
-                         database_path, output_padmet, orthodata_path,
-                         orthofinder_filtered_path, filtering_threshold_list,
-                        verbose, veryverbose):
-    source_tool = "ORTHOFINDER"
-    source_category = "ORTHOLOGY"
+def mp_create_model_store(sbml_file, model_store_file):
+    with open(model_store_file, 'wb') as store_file:
+        pickle.dump(read_model_sbml(sbml_file), store_file, protocol=pickle.HIGHEST_PROTOCOL)
 
-    if verbose:
-        print('Create padmet from sbml for ' + sbml)
-    if veryverbose:
-        sbml_padmet_verbose = veryverbose
-    else:
-        sbml_padmet_verbose = False
 
-    sbml_to_padmet.sbml_to_padmetSpec(orthofinder_sbml_path + '/' + sbml,
-                                      input_pwt_padmet,
-                                      padmetRef_file=database_path,
-                                      output=output_padmet,
-                                      source_tool=source_tool,
-                                      source_category=source_category,
-                                      verbose=sbml_padmet_verbose)
+def read_model_sbml(sbml_file):
+    """
+    Read the reactions and the species of a model sbml.
+    The gene association of each reaction is split in subsets of genes (ex: gene-a and gene-b) with gbr.
+    Args:
+        sbml_file (str): path to the sbml of the model
+    Returns:
+        dict: reactions: list of dict (id, name, reversible, reactants and products as list of (species ID, stoichiometry),
+            notes, formula and ga_subsets, None if there is no gene association),
+            species: k = species ID, v = dict (name, compartment)
+    """
+    reader = libsbml.SBMLReader()
+    document = reader.readSBML(sbml_file)
+    for i in range(document.getNumErrors()):
+        print(document.getError(i).getMessage())
+    model = document.getModel()
+
+    model_species = {}
+    for species in model.getListOfSpecies():
+        if species.boundary_condition:
+            cpd_compart = "C-BOUNDARY"
+        else:
+            cpd_compart = species.getCompartment()
+            if cpd_compart is None:
+                cpd_compart = "c"
+        model_species[species.id] = {'name': species.getName(), 'compartment': cpd_compart}
+
+    model_reactions = []
+    for rxn in model.getListOfReactions():
+        notes = sbmlPlugin.parseNotes(rxn)
+        ga = notes.get("GENE_ASSOCIATION", [None])[0]
+        if ga:
+            ga_for_gbr = re.sub(r" or " , "|", ga)
+            ga_for_gbr = re.sub(r" and " , "&", ga_for_gbr)
+            ga_for_gbr = re.sub(r"\s" , "", ga_for_gbr)
+            if re.findall(r"\||&", ga_for_gbr):
+                ga_subsets = [list(subset) for subset in gbr.compile_input(ga_for_gbr)]
+            else:
+                ga_for_gbr = re.sub(r"\(|\)" , "", ga_for_gbr)
+                ga_subsets = [[ga_for_gbr]]
+        else:
+            ga_subsets = None
+        model_reactions.append({'id': rxn.id, 'name': rxn.getName(), 'reversible': rxn.getReversible(),
+                                'reactants': [(reactant.getSpecies(), reactant.getStoichiometry()) for reactant in rxn.getListOfReactants()],
+                                'products': [(product.getSpecies(), product.getStoichiometry()) for product in rxn.getListOfProducts()],
+                                'notes': notes, 'formula': sbmlPlugin.extractFormula(rxn), 'ga_subsets': ga_subsets})
+
+    return {'reactions': model_reactions, 'species': model_species}
+
+
+def load_model_store(model_id, model_store_path):
+    """
+    Load the reactions of a model from the store created by create_model_store.
+    A model is read once by worker, so a worker creating the padmets of several species does not read it again.
+    Args:
+        model_id (str): ID of the model
+        model_store_path (str): path to the store folder
+    Returns:
+        dict: reactions and species of the model (from read_model_sbml), None if the model is not in the store
+    """
+    model_store_file = os.path.join(model_store_path, model_id + '.pkl')
+    if not os.path.exists(model_store_file):
+        return None
+    model_store_stat = os.stat(model_store_file)
+    model_store_key = (model_store_stat.st_size, model_store_stat.st_mtime_ns)
+    if model_store_file not in MODEL_STORE_LOADED or MODEL_STORE_LOADED[model_store_file][0] != model_store_key:
+        with open(model_store_file, 'rb') as store_file:
+            MODEL_STORE_LOADED[model_store_file] = (model_store_key, pickle.load(store_file))
+    return MODEL_STORE_LOADED[model_store_file][1]
+
+
+def orthologue_reactions(study_id, model_id, model_record, dict_model_orthologues, verbose):
+    """
+    Find the reactions of a model with orthologues in the species (as extract_orthofinder.dict_data_to_sbml).
+    The genes of each reaction are replaced by their orthologues in the species: a subset of genes (ex: gene-a and gene-b)
+    is kept if all its genes have orthologues.
+    Args:
+        study_id (str): ID of the species
+        model_id (str): ID of the model
+        model_record (dict): reactions and species of the model (from load_model_store)
+        dict_model_orthologues (dict): k = gene of the model, v = set of orthologue genes of the species
+        verbose (bool): verbose
+    Returns:
+        dict: k = reaction ID, v = gene association with the genes of the species, empty if there is no such reaction
+    """
+    if not dict_model_orthologues:
+        if verbose:
+            print("\t{0} and {1} don't share any ortholgue".format(study_id, model_id))
+        return {}
+
+    dict_rxn_ga = {}
+    for rxn in model_record['reactions']:
+        if not rxn['ga_subsets']:
+            continue
+        study_ga_subsets = []
+        for to_compare_subset in rxn['ga_subsets']:
+            study_subset = set()
+            for gene in to_compare_subset:
+                if gene in dict_model_orthologues:
+                    study_subset.update(dict_model_orthologues[gene])
+                else:
+                    study_subset = set()
+                    break
+            if study_subset:
+                study_ga_subsets.append(study_subset)
+        if study_ga_subsets:
+            dict_rxn_ga[rxn['id']] = " or ".join(["("+" and ".join(subset)+")" for subset in study_ga_subsets])
+
+    if not dict_rxn_ga and verbose:
+        print("\tNo reaction added from {0} to {1} because of missing orthologues".format(model_id, study_id))
 
+    return dict_rxn_ga
 
-def addOrthologyInPadmet(study_id, orthodata_path, output_padmet, verbose):
+
+def write_orthologue_sbml(sbml_template, dict_rxn_ga, output_sbml):
+    """
+    Write the sbml of the reactions of a model with orthologues, with the gene association of the species in the notes
+    (same sbml as extract_orthofinder.dict_data_to_sbml).
+    Args:
+        sbml_template (str): path to the sbml of the model
+        dict_rxn_ga (dict): k = reaction ID, v = gene association with the genes of the species (from orthologue_reactions)
+        output_sbml (str): path to the output sbml
+    """
+    reader = libsbml.SBMLReader()
+    document_to_compare = reader.readSBML(sbml_template)
+    model_to_compare = document_to_compare.getModel()
+
+    rxn_id_to_remove = set([rxn.id for rxn in model_to_compare.getListOfReactions()]).difference(dict_rxn_ga)
+    for rxn_id in rxn_id_to_remove:
+        model_to_compare.removeReaction(rxn_id)
+    cpd_id_to_preserve = set()
+    for rxn_id, study_ga in dict_rxn_ga.items():
+        rxn = model_to_compare.getElementBySId(rxn_id)
+        notes_in_dict = sbmlPlugin.parseNotes(rxn)
+        notes_in_dict["GENE_ASSOCIATION"] = [study_ga]
+        notes = "<body xmlns=\"http://www.w3.org/1999/xhtml\">"
+        for k, v_list in notes_in_dict.items():
+            for v in v_list:
+                notes += "<p>"+k+": "+v+"</p>"
+        notes += "</body>"
+        rxn.setNotes(notes)
+        cpd_id_to_preserve.update([product.getSpecies() for product in rxn.getListOfProducts()])
+        cpd_id_to_preserve.update([reactant.getSpecies() for reactant in rxn.getListOfReactants()])
+    for cpd_id in [cpd.id for cpd in model_to_compare.getListOfSpecies()]:
+        if cpd_id not in cpd_id_to_preserve:
+            model_to_compare.removeSpecies(cpd_id)
+
+    model_to_compare.setId(os.path.splitext(os.path.basename(output_sbml))[0])
+    libsbml.writeSBMLToFile(document_to_compare, output_sbml)
+
+
+def orthologue_reaction_notes(rxn, study_ga):
+    """
+    Notes of a reaction of a model with the gene association of the species,
+    as they are read (with sbmlPlugin.parseNotes) in the sbml written by write_orthologue_sbml.
+    Args:
+        rxn (dict): reaction of the model (from read_model_sbml)
+        study_ga (str): gene association with the genes of the species
+    Returns:
+        dict: k = note key, v = list of values
+    """
+    notes = dict(rxn['notes'])
+    notes["GENE_ASSOCIATION"] = [study_ga]
+    # The notes are written as "key: value" and the values read by parseNotes keep the space after ":".
+    return {k: [" " + v for v in v_list] for k, v_list in notes.items()}
+
+
+def add_orthologue_model_in_padmet(padmet, padmetRef, model_record, dict_rxn_ga, source_id, dict_study_orthologues, verbose):
+    """
+    Add the reactions of a model with orthologues (from orthologue_reactions) in a padmet, as padmet.updateFromSbml
+    (with the ORTHOFINDER tool and the ORTHOLOGY category) would do with the sbml of write_orthologue_sbml.
+    The nodes are added directly in padmet.dicOfNode (padmet.createNode searches the list of all the node IDs).
+    The orthologue genes of the model are added in the SOURCE:ASSIGNMENT of the gene-reaction relations
+    (OUTPUT_ORTHOFINDER_FROM_MODEL:gene_1;gene_2).
+    Args:
+        padmet (padmet.classes.PadmetSpec): padmet of the species
+        padmetRef (padmet.classes.PadmetRef): padmet of reference, None if there is no database
+        model_record (dict): reactions and species of the model (from load_model_store)
+        dict_rxn_ga (dict): k = reaction ID, v = gene association with the genes of the species
+        source_id (str): source of the reactions (OUTPUT_ORTHOFINDER_FROM_MODEL)
+        dict_study_orthologues (dict): k = gene of the species, v = set of orthologue genes of the model
+        verbose (bool): verbose
+    """
+    model_species = model_record['species']
+    for rxn in model_record['reactions']:
+        if rxn['id'] not in dict_rxn_ga:
+            continue
+        rxn_idOrigin = rxn['id']
+        rxn_cname = rxn['name']
+        rxn_idRef = sbmlPlugin.convert_from_coded_id(rxn_idOrigin)[0]
+
+        if rxn_idRef in padmet.dicOfNode:
+            if verbose:
+                print("\t%s already in padmet" % rxn_idRef)
+        elif padmetRef is not None and rxn_idRef in padmetRef.dicOfNode:
+            if verbose:
+                print("\tCopy %s from padmetRef" % rxn_idRef)
+            padmet.copyNode(padmetRef, rxn_idRef)
+        else:
+            if verbose:
+                print("\tCreating new reaction %s" % rxn_idRef)
+            reaction_dir = "REVERSIBLE" if rxn['reversible'] else "LEFT-TO-RIGHT"
+            if rxn_cname:
+                padmet.dicOfNode[rxn_idRef] = Node("reaction", rxn_idRef, {"DIRECTION": [reaction_dir], "COMMON-NAME": [rxn_cname]})
+            else:
+                padmet.dicOfNode[rxn_idRef] = Node("reaction", rxn_idRef, {"DIRECTION": [reaction_dir]})
+            for relation_type, species_references in [("consumes", rxn['reactants']), ("produces", rxn['products'])]:
+                for species_id, stoichiometry in species_references:
+                    cpd_id = sbmlPlugin.convert_from_coded_id(species_id)[0]
+                    cpd_rlt = Relation(rxn_idRef, relation_type, cpd_id,
+                                       {"STOICHIOMETRY": [stoichiometry], "COMPARTMENT": [model_species[species_id]['compartment']]})
+                    if cpd_id not in padmet.dicOfNode:
+                        if padmetRef is not None and cpd_id in padmetRef.dicOfNode:
+                            padmet._copyNodeExtend(padmetRef, cpd_id)
+                        else:
+                            cpd_cname = model_species[species_id]['name']
+                            if cpd_cname:
+                                padmet.dicOfNode[cpd_id] = Node("compound", cpd_id, {"COMMON-NAME": [cpd_cname]})
+                            else:
+                                padmet.dicOfNode[cpd_id] = Node("compound", cpd_id)
+                    padmet._addRelation(cpd_rlt)
+
+        notes = orthologue_reaction_notes(rxn, dict_rxn_ga[rxn_idOrigin])
+        suppData_id = rxn_idRef + "_SuppData_" + source_id
+        if suppData_id not in padmet.dicOfNode:
+            suppData = {"SOURCE": [source_id], "ORIGIN_ID": [str(rxn_idOrigin)]}
+            if rxn_cname:
+                suppData["NAME"] = [rxn_cname]
+            suppData["REVERSIBLE"] = [str(rxn['reversible'])]
+            suppData["FORMULA"] = [rxn['formula']]
+            suppData.update(notes)
+            padmet.dicOfNode[suppData_id] = Node("suppData", suppData_id, suppData)
+            padmet._addRelation(Relation(rxn_idRef, "has_suppData", suppData_id))
+
+        reconstructionData_id = rxn_idRef + "_reconstructionData_" + source_id
+        if reconstructionData_id not in padmet.dicOfNode:
+            reconstructionData = {"SOURCE": [source_id], "TOOL": ["ORTHOFINDER"], "CATEGORY": ["ORTHOLOGY"]}
+            padmet.dicOfNode[reconstructionData_id] = Node("reconstructionData", reconstructionData_id, reconstructionData)
+            padmet._addRelation(Relation(rxn_idRef, "has_reconstructionData", reconstructionData_id))
+
+        for gene_id in sbmlPlugin.parseGeneAssoc(notes["GENE_ASSOCIATION"][0]):
+            if gene_id not in padmet.dicOfNode:
+                padmet.dicOfNode[gene_id] = Node("gene", gene_id)
+            # The orthologue genes of the model are directly added to the source.
+            gene_source = "%s:%s" %(source_id, ";".join(dict_study_orthologues[gene_id]))
+            linked_rlts = [rlt for rlt in padmet.dicOfRelationIn[rxn_idRef] if rlt.type == "is_linked_to" and rlt.id_out == gene_id]
+            if linked_rlts:
+                linked_rlts[0].misc.setdefault("SOURCE:ASSIGNMENT", []).append(gene_source)
+            else:
+                padmet._addRelation(Relation(rxn_idRef, "is_linked_to", gene_id, {"SOURCE:ASSIGNMENT": [gene_source]}))
+
+
+def orthologue_pair_hashes(orthodata_path):
     """
-    Add orthologs information to a padmet file.
+    Compute the sha256 of each OrthoFinder orthologues file.
     Args:
-        study_id (str): ID of the species which padmet will be analyzed
         orthodata_path (str): path to Orthologues files
-        output_padmet (str): path to the output padmet file
-        verbose (boolean): verbose
-    """
-    # Read orthologs files and create a dictionary containing orthologs
-    # infomations.
-    all_orgs = set()
-    all_orthologue_files = []
-    # Process of orthologues.
+    Returns:
+        dict: k = (org_A, org_B) from the file org_A__v__org_B.tsv, v = sha256 of the file
+    """
+    orthologue_hashes = {}
     for _path, _folders, _files in os.walk(orthodata_path):
-        for _folder in _folders:
-            all_orgs.add(_folder.replace("Orthologues_","").lower())
         for _file in _files:
             _filename = os.path.splitext(_file)[0]
-            if _filename.startswith(study_id):
-                all_orthologue_files.append(os.path.join(_path,_file))
-        dict_orthologues = {}
-
-    for org in all_orgs:
-        dict_orthologues[org] = dict()
-
-    #dict_orthologue: k = org_id, v = dict: k = gene_id, v = dict: k = org_id, v = set of gene orthologue id
-    for orthologue_file in [i for i in all_orthologue_files if "__v__" in i]:
-        with open(orthologue_file, 'r') as csvfile:
-            reader = csv.DictReader(csvfile, delimiter = "\t")
-            orgs = list(reader.fieldnames)
-            orgs.remove('Orthogroup')
-            org_A, org_B = orgs
-            for row in reader:
-                gene_ids_A = [gene_id.split("_isoform")[0] for gene_id in row[org_A].split(", ")]
-                gene_ids_B = [gene_id.split("_isoform")[0] for gene_id in row[org_B].split(", ")]
-                for gene_id_A in gene_ids_A:
-                    if gene_id_A not in dict_orthologues[org_A.lower()].keys():
-                        dict_orthologues[org_A.lower()][gene_id_A] = dict()
-                    dict_orthologues[org_A.lower()][gene_id_A][org_B.lower()] = set(gene_ids_B)
-
-    padmet_file = os.path.basename(output_padmet)
-    if verbose:
-        print("%s..."%padmet_file)
-    org_id = os.path.splitext(padmet_file)[0]
-
-    org_id = org_id.lower()
-    padmet = PadmetSpec(output_padmet)
-    for linked_rlt in [rlt for rlt in padmet.getAllRelation() if rlt.type == "is_linked_to"]:
-        gene_id = linked_rlt.id_out
-        for index, src in enumerate(linked_rlt.misc["SOURCE:ASSIGNMENT"]):
-            if 'GENOME:' not in src:
-                ortho_org_id = src.replace("OUTPUT_ORTHOFINDER_FROM_","").split(':')[0]
-                ortho_org_id_low = ortho_org_id.lower()
-                org_id_orthologues = dict_orthologues[org_id][gene_id]
-                ortho_genes_id = ";".join(org_id_orthologues[ortho_org_id_low])
-                new_src = "OUTPUT_ORTHOFINDER_FROM_%s:%s"%(ortho_org_id, ortho_genes_id)
-                linked_rlt.misc["SOURCE:ASSIGNMENT"][index] = new_src
-    padmet.generateFile(output_padmet)
+            if '__v__' in _filename:
+                org_A, org_B = _filename.split('__v__')
+                orthologue_hashes[(org_A, org_B)] = file_hash(os.path.join(_path, _file))
+    return orthologue_hashes
 
 
 def filter_propagation(padmet_folder, output_folder, aucome_pool, filtering_threshold_list, union=None, intersection=None, verbose=None):
@@ -433,128 +777,326 @@ def filter_propagation(padmet_folder, output_folder, aucome_pool, filtering_thre
 
     if verbose:
         print("Extracting all the relations gene-reaction...")
-    dict_rxn_orgs_genes, dict_rxn_ec = extractRGL(padmet_folder, aucome_pool)
+    gene_links, dict_rxn_ec = extractRGL(padmet_folder, aucome_pool)
     if verbose:
         print("Extracting all the gene propagations...")
-    dict_rxn_org_gene_propagation = extractPropagation(dict_rxn_orgs_genes)
+    propagation = extractPropagation(gene_links)
     if verbose:
         print("Writing the file propagation_to_remove...")
-    dict_rxn_org_gene_propag_to_remove = extractPropagationToRemove(dict_rxn_org_gene_propagation, output=propagation_to_remove_file, orthology_threshold_list=filtering_threshold_list, union=union, intersection=intersection)
+    propagation_to_remove = extractPropagationToRemove(propagation, output=propagation_to_remove_file, orthology_threshold_list=filtering_threshold_list, union=union, intersection=intersection)
     if verbose:
         print("Cleaning the Padmet files and writing the reactions_to_remove_file file...")
-    cleanPadmet(dict_rxn_org_gene_propag_to_remove, dict_rxn_ec, padmet_folder,
+    cleanPadmet(propagation_to_remove, dict_rxn_ec, gene_links, padmet_folder,
                 padmet_output_folder, reactions_to_remove_file, aucome_pool)
 
 
-def spontaneous_result_dict(first_dict, second_dict):
-    for rxn_id in second_dict:
-        if rxn_id not in first_dict:
-            first_dict[rxn_id] = dict()
-        for org_id in second_dict[rxn_id]:
-            if org_id not in first_dict[rxn_id]:
-                first_dict[rxn_id][org_id] = dict()
-            for gene_id in second_dict[rxn_id][org_id]:
-                if gene_id not in first_dict[rxn_id][org_id]:
-                    first_dict[rxn_id][org_id][gene_id] = second_dict[rxn_id][org_id][gene_id]
+def intern_ids(element_ids, id_list, id_codes):
+    """
+    Give an integer code to each ID, the IDs not seen before get a new code.
+    Args:
+        element_ids (list): IDs to convert
+        id_list (list): IDs by code (updated with the new IDs)
+        id_codes (dict): k = ID, v = code (updated with the new IDs)
+    Returns:
+        numpy.ndarray: codes of element_ids
+    """
+    codes = np.empty(len(element_ids), dtype=np.int32)
+    for index, element_id in enumerate(element_ids):
+        code = id_codes.get(element_id)
+        if code is None:
+            code = len(id_list)
+            id_codes[element_id] = code
+            id_list.append(element_id)
+        codes[index] = code
+    return codes
+
 
 def extractRGL(padmet_folder, aucome_pool):
     """
     extract reactions genes relations.
-    It reads all Padmet files in padmet_folder, then it creates three
-    dictionaries: dict_rnx_orgs_genes, dict_rnx_ec, dict_org_genes.
-    dict_rxn_org_gene: reaction & organism & assigned genes & orthologuous genes.
-    dict_rxn_ec[rxn_id] = ec, simple dictionary
-    return dict {rxn_id:{org_id:{'FROM-PTOOL': bool, gene_id:set of sources (ex ortho_org_id:ortho_genes)}}}
+    It reads all Padmet files in padmet_folder and stores the relations in columnar arrays,
+    with an integer code for each organism, reaction, gene and GENOME source:
+        - org_rxn (org_rxn_org, org_rxn_rxn): reactions of each organism,
+        - link (link_org, link_rxn, link_gene, link_from_ptool): gene-reaction relations (is_linked_to),
+        link_from_ptool is True if the relation has a GENOME source,
+        - source (source_org, source_text): sources of each relation, from source_offsets[link] to source_offsets[link+1],
+        source_org is the organism of an OUTPUT_ORTHOFINDER_FROM source (-1 for a GENOME source, stored in source_text),
+        - edge (edge_gene): orthologous genes of each source, from edge_offsets[source] to edge_offsets[source+1].
+    The arrays are in the order of the padmet files and of their reactions and relations,
+    padmet_org_codes and padmet_link_offsets give the organism and the first relation of each padmet file.
+    return gene_links (dict of IDs lists and numpy arrays) and dict_rxn_ec[rxn_id] = ec
     """
-    dict_rxn_orgs_genes = {}
+    gene_links = {'padmet_files': [], 'org_ids': [], 'rxn_ids': [], 'gene_ids': [], 'source_texts': []}
+    id_codes = {'org_ids': {}, 'rxn_ids': {}, 'gene_ids': {}, 'source_texts': {}}
+    columns = {column: [] for column in ['org_rxn_org', 'org_rxn_rxn', 'link_org', 'link_rxn', 'link_gene', 'link_from_ptool',
+                                         'source_org', 'source_text', 'edge_gene']}
+    padmet_org_codes = []
+    padmet_link_offsets = [0]
+    source_offsets = [np.zeros(1, dtype=np.int64)]
+    edge_offsets = [np.zeros(1, dtype=np.int64)]
+    nb_links, nb_sources, nb_edges = 0, 0, 0
     dict_rxn_ec = {}
     multiprocessing_datas = []
     for padmet_file in next(os.walk(padmet_folder))[2]:
         multiprocessing_datas.append([padmet_file, padmet_folder])
 
-    multiprocessing_results = aucome_pool.starmap(mp_extractRGL, multiprocessing_datas)
-
-    for multiprocessing_result in multiprocessing_results:
-        spontaneous_result_dict(dict_rxn_orgs_genes, multiprocessing_result[0])
-        dict_rxn_ec.update(multiprocessing_result[1])
+    # The results are merged one by one (imap), so the IDs of all the organisms are not in memory at the same time.
+    multiprocessing_results = aucome_pool.imap(mp_extractRGL, multiprocessing_datas)
+
+    for multiprocessing_data, org_gene_links in zip(multiprocessing_datas, multiprocessing_results):
+        org_id = os.path.splitext(multiprocessing_data[0])[0].upper()
+        org_code = intern_ids([org_id], gene_links['org_ids'], id_codes['org_ids'])[0]
+        gene_links['padmet_files'].append(multiprocessing_data[0])
+        padmet_org_codes.append(org_code)
+        # Convert the codes of the organism into the codes of all the organisms (-1 stays -1 with the appended -1).
+        rxn_codes = intern_ids(org_gene_links['rxn_ids'], gene_links['rxn_ids'], id_codes['rxn_ids'])
+        gene_codes = intern_ids(org_gene_links['gene_ids'], gene_links['gene_ids'], id_codes['gene_ids'])
+        ortho_org_codes = np.append(intern_ids(org_gene_links['ortho_org_ids'], gene_links['org_ids'], id_codes['org_ids']), -1)
+        source_text_codes = np.append(intern_ids(org_gene_links['source_texts'], gene_links['source_texts'], id_codes['source_texts']), -1)
+
+        columns['org_rxn_org'].append(np.full(len(rxn_codes), org_code, dtype=np.int32))
+        columns['org_rxn_rxn'].append(rxn_codes)
+        columns['link_org'].append(np.full(len(org_gene_links['link_rxn']), org_code, dtype=np.int32))
+        columns['link_rxn'].append(rxn_codes[org_gene_links['link_rxn']])
+        columns['link_gene'].append(gene_codes[org_gene_links['link_gene']])
+        columns['link_from_ptool'].append(org_gene_links['link_from_ptool'])
+        columns['source_org'].append(ortho_org_codes[org_gene_links['source_org']])
+        columns['source_text'].append(source_text_codes[org_gene_links['source_text']])
+        columns['edge_gene'].append(gene_codes[org_gene_links['edge_gene']])
+        source_offsets.append(org_gene_links['source_offsets'][1:] + nb_sources)
+        edge_offsets.append(org_gene_links['edge_offsets'][1:] + nb_edges)
+        nb_links += len(org_gene_links['link_rxn'])
+        nb_sources += len(org_gene_links['source_org'])
+        nb_edges += len(org_gene_links['edge_gene'])
+        padmet_link_offsets.append(nb_links)
+        dict_rxn_ec.update(org_gene_links['rxn_ec'])
+
+    # Each column is concatenated then its arrays by organism are freed.
+    for column in list(columns):
+        column_arrays = columns.pop(column)
+        if column == 'link_from_ptool':
+            gene_links[column] = np.concatenate(column_arrays) if column_arrays else np.zeros(0, dtype=bool)
+        else:
+            gene_links[column] = np.concatenate(column_arrays) if column_arrays else np.zeros(0, dtype=np.int32)
+        del column_arrays
+    gene_links['source_offsets'] = np.concatenate(source_offsets)
+    gene_links['edge_offsets'] = np.concatenate(edge_offsets)
+    gene_links['padmet_org_codes'] = np.array(padmet_org_codes, dtype=np.int32)
+    gene_links['padmet_link_offsets'] = np.array(padmet_link_offsets, dtype=np.int64)
 
-    return dict_rxn_orgs_genes, dict_rxn_ec
+    return gene_links, dict_rxn_ec
 
 
-def mp_extractRGL(padmet_file, padmet_folder):
-    padmet_path = os.path.join(padmet_folder, padmet_file)
-    org_id = os.path.splitext(padmet_file)[0].upper()
-    padmet = PadmetSpec(padmet_path)
-    dict_rxn_orgs_genes = {}
+def read_padmet_gene_links(padmet_path):
+    """
+    Read the reactions and the gene-reaction relations (is_linked_to) of a padmet file.
+    The file is read line by line, only the reaction nodes and the is_linked_to relations
+    are kept, so it is much lighter than loading it with PadmetSpec.
+    Args:
+        padmet_path (str): path to the padmet file
+    Returns:
+        dict: k = rxn_id, v = dict: k = gene_id, v = list of SOURCE:ASSIGNMENT (in the same order as in the file)
+        dict: k = rxn_id, v = EC-NUMBER of the reaction
+    """
+    dict_rxn_genes = {}
     dict_rxn_ec = {}
-    for node in padmet.dicOfNode.values():
-        if node.type == "reaction":
-            rxn_id = node.id
-            if rxn_id not in dict_rxn_orgs_genes:
-                dict_rxn_orgs_genes[rxn_id] = dict()
-
-            if org_id not in dict_rxn_orgs_genes[rxn_id]:
-                dict_rxn_orgs_genes[rxn_id][org_id] = dict()
-            if 'EC-NUMBER' in node.misc:
-                dict_rxn_ec[rxn_id] = node.misc['EC-NUMBER'][0]
-            #rxn_id = "PHOSGLYPHOS-RXN"
+    gene_links = []
+    section = None
+    with open(padmet_path, 'r', encoding='utf8') as padmet_file:
+        for line in padmet_file:
+            line = line.rstrip('\n')
+            if not line:
+                continue
+            if line in ['Data Base informations', 'Policy', 'Nodes', 'Relations']:
+                section = line
+                continue
+            if section == 'Nodes':
+                data = line.split('\t')
+                if data[0] == 'reaction':
+                    rxn_id = data[1]
+                    dict_rxn_genes[rxn_id] = dict()
+                    for index in range(2, len(data)-1, 2):
+                        if data[index] == 'EC-NUMBER':
+                            dict_rxn_ec[rxn_id] = data[index+1]
+                            break
+            elif section == 'Relations':
+                data = line.split('\t')
+                if data[1] == 'is_linked_to':
+                    sources = [data[index+1] for index in range(3, len(data)-1, 2) if data[index] == 'SOURCE:ASSIGNMENT']
+                    gene_links.append((data[0], data[2], sources))
+
+    for rxn_id, gene_id, sources in gene_links:
+        if rxn_id in dict_rxn_genes:
+            dict_rxn_genes[rxn_id][gene_id] = sources
+
+    return dict_rxn_genes, dict_rxn_ec
+
+
+def mp_extractRGL(multiprocessing_data):
+    """
+    Extract the gene-reaction relations of one padmet as columnar arrays (see extractRGL).
+    The codes are local to this organism, extractRGL converts them into the codes of all the organisms.
+    Args:
+        multiprocessing_data (list): name of the padmet file and path to the padmet folder
+    """
+    padmet_file, padmet_folder = multiprocessing_data
+    padmet_path = os.path.join(padmet_folder, padmet_file)
+    dict_rxn_genes, dict_rxn_ec = read_padmet_gene_links(padmet_path)
+    gene_codes, ortho_org_codes, source_text_codes = {}, {}, {}
+    link_rxn, link_gene, link_from_ptool = [], [], []
+    source_org, source_text, source_offsets = [], [], [0]
+    edge_gene, edge_offsets = [], [0]
+    for rxn_code, rxn_genes in enumerate(dict_rxn_genes.values()):
+        for gene_id, sources in rxn_genes.items():
+            link_rxn.append(rxn_code)
+            link_gene.append(gene_codes.setdefault(gene_id, len(gene_codes)))
             from_ptool = False
-            for is_linked_rlt in [rlt for rlt in padmet.dicOfRelationIn[rxn_id] if rlt.type == "is_linked_to"]:
-                gene_id = is_linked_rlt.id_out
-                all_sources = {src.replace("OUTPUT_ORTHOFINDER_FROM_","")  for src in is_linked_rlt.misc["SOURCE:ASSIGNMENT"]}
-                if any (src for src in all_sources if src.startswith("GENOME")):
+            # A source found twice in a relation is kept once.
+            for src in dict.fromkeys([src.replace("OUTPUT_ORTHOFINDER_FROM_","") for src in sources]):
+                if src.startswith("GENOME"):
                     from_ptool = True
-                dict_rxn_orgs_genes[rxn_id][org_id][gene_id] = all_sources
-            dict_rxn_orgs_genes[rxn_id][org_id]["FROM-PTOOL"] = from_ptool
-
-    return dict_rxn_orgs_genes, dict_rxn_ec
-
-
-def extractPropagation(dict_rxn_orgs_genes):
-    """
-    Propagations are extracted from Padmet networks. Then propagations
-    are split bewteen two groups. Those who are orthologues to gene-reaction
-    associations that come from Pathway Tools, and those whose associations
-    do not come from Pathway Tools.
-    """
-    dict_rxn_org_gene_propagation = {}
-    for rxn_id, rxn_data in dict_rxn_orgs_genes.items():
-        dict_rxn_org_gene_propagation[rxn_id] = dict()
-        for org_id, org_data in rxn_data.items():
-            if org_id not in dict_rxn_org_gene_propagation[rxn_id].keys():
-                dict_rxn_org_gene_propagation[rxn_id][org_id] = dict()
-            #because of genes without gene link sources
-            if len(org_data.keys()) > 1:
-                for gene_id, gene_data in org_data.items():
-                    if gene_id != "FROM-PTOOL":
-                        gene_id = gene_id
-                        if any (src for src in gene_data if src.startswith("GENOME")):
-                            is_from_ptool = True
-                        else:
-                            is_from_ptool = False
-                        for src in gene_data:
-                            if not src.startswith("GENOME:"):
-                                ortho_org_id, ortho_genes_ids = src.split(":")
-                                ortho_genes_ids = ortho_genes_ids.split(";")
-                                if ortho_org_id not in dict_rxn_org_gene_propagation[rxn_id].keys():
-                                    dict_rxn_org_gene_propagation[rxn_id][ortho_org_id] = dict()
-                                for ortho_gene_id in ortho_genes_ids:
-                                    if gene_id in dict_rxn_org_gene_propagation[rxn_id][org_id]:
-                                        dict_rxn_org_gene_propagation[rxn_id][org_id][gene_id]["propagation_from_ptool"].add((ortho_org_id, ortho_gene_id))
-                                    else:
-                                        dict_rxn_org_gene_propagation[rxn_id][org_id][gene_id] = {"propagation_to_ptool":set(),"propagation_to_not_ptool":set(), "propagation_from_ptool": set([(ortho_org_id, ortho_gene_id)])}
-
-                                    if ortho_gene_id not in dict_rxn_org_gene_propagation[rxn_id][ortho_org_id].keys():
-                                        dict_rxn_org_gene_propagation[rxn_id][ortho_org_id][ortho_gene_id] = {"propagation_to_ptool":set(),"propagation_to_not_ptool":set(), "propagation_from_ptool": set()}
-                                    if is_from_ptool:
-                                        dict_rxn_org_gene_propagation[rxn_id][ortho_org_id][ortho_gene_id]["propagation_to_ptool"].add((org_id, gene_id))
-                                    else:
-                                        dict_rxn_org_gene_propagation[rxn_id][ortho_org_id][ortho_gene_id]["propagation_to_not_ptool"].add((org_id, gene_id))
-
-    return dict_rxn_org_gene_propagation
-
-
-def extractPropagationToRemove(dict_rxn_org_gene_propagation, output,
+                if src.startswith("GENOME:"):
+                    source_org.append(-1)
+                    source_text.append(source_text_codes.setdefault(src, len(source_text_codes)))
+                else:
+                    ortho_org_id, ortho_genes_ids = src.split(":")
+                    source_org.append(ortho_org_codes.setdefault(ortho_org_id, len(ortho_org_codes)))
+                    source_text.append(-1)
+                    for ortho_gene_id in ortho_genes_ids.split(";"):
+                        edge_gene.append(gene_codes.setdefault(ortho_gene_id, len(gene_codes)))
+                edge_offsets.append(len(edge_gene))
+            source_offsets.append(len(source_org))
+            link_from_ptool.append(from_ptool)
+
+    org_gene_links = {'rxn_ids': list(dict_rxn_genes), 'gene_ids': list(gene_codes), 'ortho_org_ids': list(ortho_org_codes),
+                      'source_texts': list(source_text_codes), 'rxn_ec': dict_rxn_ec,
+                      'link_rxn': np.array(link_rxn, dtype=np.int32), 'link_gene': np.array(link_gene, dtype=np.int32),
+                      'link_from_ptool': np.array(link_from_ptool, dtype=bool),
+                      'source_org': np.array(source_org, dtype=np.int32), 'source_text': np.array(source_text, dtype=np.int32),
+                      'source_offsets': np.array(source_offsets, dtype=np.int64),
+                      'edge_gene': np.array(edge_gene, dtype=np.int32), 'edge_offsets': np.array(edge_offsets, dtype=np.int64)}
+
+    return org_gene_links
+
+
+def extractPropagation(gene_links):
+    """
+    Propagations are extracted from the gene-reaction relations of extractRGL.
+    A propagation (an edge) goes from a gene-reaction association of an organism to the orthologous gene of
+    another organism found in its sources. Propagations are split bewteen two groups: those coming from
+    gene-reaction associations from Pathway Tools, and those whose associations do not come from Pathway Tools.
+    One row by gene-reaction association receiving propagations (reaction, organism, gene), with the number of
+    organisms propagating to it from Pathway Tools and not from Pathway Tools. The associations receiving no
+    propagation are not kept, they can not be removed by the filter.
+    The edges are processed by organism receiving the propagations, so the temporary arrays stay small.
+    The rows are in the order in which the previous nested dictionaries were filled,
+    so the same propagations are written in propagation_to_remove.tsv.
+    Reactions found in only one organism are skipped as they have no propagation.
+    return dict with the list of reaction, organism and gene ids and the numpy arrays of codes and counts.
+    """
+    nb_orgs = len(gene_links['org_ids'])
+    nb_genes = len(gene_links['gene_ids'])
+    link_org = gene_links['link_org']
+    link_rxn = gene_links['link_rxn']
+    link_gene = gene_links['link_gene']
+    link_from_ptool = gene_links['link_from_ptool']
+    source_org = gene_links['source_org']
+    source_offsets = gene_links['source_offsets']
+    edge_offsets = gene_links['edge_offsets']
+    edge_gene = gene_links['edge_gene']
+    source_link = np.repeat(np.arange(len(link_org), dtype=np.int32), np.diff(source_offsets))
+
+    # Number of organisms having the reaction or receiving a propagation for it, minus one.
+    org_rxn_keys = gene_links['org_rxn_rxn'].astype(np.int64)*nb_orgs + gene_links['org_rxn_org']
+    ortho_sources = source_org >= 0
+    rxn_org_keys = np.unique(np.concatenate([org_rxn_keys, link_rxn[source_link[ortho_sources]].astype(np.int64)*nb_orgs + source_org[ortho_sources]]))
+    nb_org_prop = np.bincount(rxn_org_keys // nb_orgs, minlength=len(gene_links['rxn_ids'])) - 1
+    del ortho_sources, rxn_org_keys
+
+    # Order of the rows: the dictionaries were filled padmet by padmet (the order of the edges), for a reaction
+    # the organism of the padmet was inserted before its edges, then for each edge: the organism receiving
+    # the propagation, the gene propagating and the gene receiving the propagation.
+    # Positions: 4*edge+1, 4*edge+2 and 4*edge+3 for the edges and 4*(first edge of the padmet) for its organism,
+    # multiplied by the number of padmets to order the organisms of the padmets without edges with the padmet index.
+    nb_padmets = len(gene_links['padmet_org_codes'])
+    padmet_edge_offsets = edge_offsets[source_offsets[gene_links['padmet_link_offsets'][:-1]]]
+    padmet_indexes = np.zeros(nb_orgs, dtype=np.int64)
+    padmet_indexes[gene_links['padmet_org_codes']] = np.arange(nb_padmets)
+    org_rxn_padmets = padmet_indexes[gene_links['org_rxn_org']]
+    org_rxn_keys, first_org_rxns = np.unique(org_rxn_keys, return_index=True)
+    org_rxn_positions = (4*padmet_edge_offsets[org_rxn_padmets[first_org_rxns]]*nb_padmets + org_rxn_padmets[first_org_rxns])
+    del org_rxn_padmets, first_org_rxns
+    # The gene of a relation is inserted at the first edge of the relation.
+    link_first_edges = edge_offsets[source_offsets[:-1]]
+    links_with_edges = np.flatnonzero(edge_offsets[source_offsets[1:]] > link_first_edges)
+    link_keys, first_links = np.unique((link_rxn[links_with_edges].astype(np.int64)*nb_orgs + link_org[links_with_edges])*nb_genes
+                                       + link_gene[links_with_edges], return_index=True)
+    link_positions = (4*link_first_edges[links_with_edges[first_links]] + 2)*nb_padmets
+    del link_first_edges, links_with_edges, first_links
+
+    # The sources grouped by organism receiving the propagations.
+    source_order = np.argsort(source_org, kind='stable')
+    org_source_offsets = np.searchsorted(source_org[source_order], np.arange(nb_orgs+1))
+    org_rows = []
+    for org_code in range(nb_orgs):
+        org_sources = source_order[org_source_offsets[org_code]:org_source_offsets[org_code+1]]
+        source_nb_edges = edge_offsets[org_sources+1] - edge_offsets[org_sources]
+        if not source_nb_edges.sum():
+            continue
+        # Edges of these sources, in the order of the padmets.
+        edge_sources = np.repeat(org_sources, source_nb_edges)
+        org_edges = np.repeat(edge_offsets[org_sources] - np.cumsum(source_nb_edges) + source_nb_edges, source_nb_edges) + np.arange(source_nb_edges.sum())
+        edge_links = source_link[edge_sources]
+        edge_rxn = link_rxn[edge_links].astype(np.int64)
+        row_keys, first_edges, edge_rows = np.unique(edge_rxn*nb_genes + edge_gene[org_edges], return_index=True, return_inverse=True)
+        nb_rows = len(row_keys)
+        row_rxn_codes = row_keys // nb_genes
+        row_gene_codes = row_keys % nb_genes
+
+        # Number of organisms propagating to each row (from Pathway Tools or not).
+        row_edge_orgs = edge_rows*nb_orgs + link_org[edge_links]
+        edge_from_ptool = link_from_ptool[edge_links]
+        nb_orgs_to_ptool = np.bincount(np.unique(row_edge_orgs[edge_from_ptool]) // nb_orgs, minlength=nb_rows)
+        nb_orgs_to_not_ptool = np.bincount(np.unique(row_edge_orgs[~edge_from_ptool]) // nb_orgs, minlength=nb_rows)
+
+        # Position of the organism in the reaction: its padmet or its first propagation for the reaction.
+        row_org_keys = row_rxn_codes*nb_orgs + org_code
+        rxns, first_rxn_edges = np.unique(edge_rxn, return_index=True)
+        row_org_positions = (4*org_edges[first_rxn_edges[np.searchsorted(rxns, row_rxn_codes)]] + 1)*nb_padmets
+        org_rxn_rows = np.minimum(np.searchsorted(org_rxn_keys, row_org_keys), len(org_rxn_keys)-1)
+        row_has_org_rxn = org_rxn_keys[org_rxn_rows] == row_org_keys
+        row_org_positions[row_has_org_rxn] = np.minimum(row_org_positions[row_has_org_rxn], org_rxn_positions[org_rxn_rows[row_has_org_rxn]])
+
+        # Position of the gene in the organism: its first propagation to or from it.
+        row_gene_positions = (4*org_edges[first_edges] + 3)*nb_padmets
+        row_link_keys = row_org_keys*nb_genes + row_gene_codes
+        link_rows = np.minimum(np.searchsorted(link_keys, row_link_keys), len(link_keys)-1)
+        row_has_link = link_keys[link_rows] == row_link_keys
+        row_gene_positions[row_has_link] = np.minimum(row_gene_positions[row_has_link], link_positions[link_rows[row_has_link]])
+
+        org_rows.append((row_rxn_codes, np.full(nb_rows, org_code, dtype=np.int64), row_gene_codes, row_org_positions, row_gene_positions,
+                         nb_orgs_to_ptool, nb_orgs_to_not_ptool))
+
+    if org_rows:
+        row_columns = [np.concatenate(column_arrays) for column_arrays in zip(*org_rows)]
+    else:
+        row_columns = [np.zeros(0, dtype=np.int64) for column_index in range(7)]
+    del org_rows
+    row_rxn_codes, row_org_codes, row_gene_codes, row_org_positions, row_gene_positions, nb_orgs_to_ptool, nb_orgs_to_not_ptool = row_columns
+
+    row_order = np.lexsort((row_gene_positions, row_org_positions, row_rxn_codes))
+    row_order = row_order[nb_org_prop[row_rxn_codes[row_order]] > 0]
+
+    propagation = {'rxn_ids': gene_links['rxn_ids'], 'org_ids': gene_links['org_ids'], 'gene_ids': gene_links['gene_ids'],
+                   'rxn_codes': row_rxn_codes[row_order], 'org_codes': row_org_codes[row_order], 'gene_codes': row_gene_codes[row_order],
+                   'nb_org_prop': nb_org_prop[row_rxn_codes[row_order]],
+                   'nb_orgs_to_ptool': nb_orgs_to_ptool[row_order],
+                   'nb_orgs_to_not_ptool': nb_orgs_to_not_ptool[row_order]}
+
+    return propagation
+
+
+def extractPropagationToRemove(propagation, output,
                                ptool_threshold=0,
                                orthology_threshold_list=[0.05], union=None,
                                intersection=None):
@@ -562,147 +1104,142 @@ def extractPropagationToRemove(dict_rxn_org_gene_propagation, output,
     Using ptool_threshold and orthology_threshold, this function select the 
     propagations to remove. These propagation are written in 
     propagation_to_remove.tsv.
+    All the thresholds are tested at once on the numpy arrays of extractPropagation (one line by threshold).
+    return dict with the reaction, organism and gene codes of the propagations to remove.
     """
     header = ["reaction_id", "org_id", "gene_id"]
-    dict_rxn_org_gene_propag_to_remove = dict()
     maximum = 5
+    nb_org_prop = propagation['nb_org_prop']
+
+    # At this moment filter is as 20/N with 0.05
+    orthology_thresholds = np.array(orthology_threshold_list, dtype=float).reshape(-1, 1)
+    inverse_orthology_thresholds = 1/orthology_thresholds
+    not_ptool_thresholds = np.round(np.maximum(inverse_orthology_thresholds/nb_org_prop, orthology_thresholds*nb_org_prop), 0)
+    ptool_filter = propagation['nb_orgs_to_ptool'] <= ptool_threshold
+    threshold_filters = ptool_filter & (propagation['nb_orgs_to_not_ptool'] >= not_ptool_thresholds)
+    if intersection:
+        rows_to_remove = np.flatnonzero(threshold_filters.sum(axis=0) == maximum)
+    else:
+        rows_to_remove = np.flatnonzero(threshold_filters.any(axis=0))
+
+    propagation_to_remove = {'rxn_ids': propagation['rxn_ids'], 'org_ids': propagation['org_ids'], 'gene_ids': propagation['gene_ids'],
+                             'rxn_codes': propagation['rxn_codes'][rows_to_remove],
+                             'org_codes': propagation['org_codes'][rows_to_remove],
+                             'gene_codes': propagation['gene_codes'][rows_to_remove]}
+
+    # As in the previous versions, one line by reaction: its first propagation to remove.
     with open(output, 'w') as csvfile:
         writer = csv.DictWriter(csvfile, header, delimiter="\t")
         writer.writeheader()
-        for rxn_id ,rxn_data in dict_rxn_org_gene_propagation.items():
-            nb_org_prop = len(rxn_data.keys())-1
-            if nb_org_prop:
-                for org_id, org_data in rxn_data.items():
-                    gene_ids_to_remove = set()
-                    gene_id_tmp = ""
-                    for gene_id, gene_data in org_data.items():
-                        count = 0
-                        # At this moment filter is as 20/N with 0.05
-                        for orthology_threshold in orthology_threshold_list:
-                            inverse_orthology_threshold = 1/orthology_threshold
-                            not_ptool_threshold = round(max(inverse_orthology_threshold/nb_org_prop, orthology_threshold*nb_org_prop),0)
-                            if len({i[0] for i in gene_data["propagation_to_ptool"]}) <= ptool_threshold:
-                                if len({i[0] for i in gene_data["propagation_to_not_ptool"]}) >= not_ptool_threshold:                                    
-                                    if intersection:
-                                        count+=1 
-                                        gene_id_tmp = gene_id
-                                    elif not gene_id in gene_ids_to_remove:
-                                        gene_ids_to_remove.add(gene_id)
-                                        dict_rxn_org_gene_propag_to_remove = remove_gene(gene_ids_to_remove, dict_rxn_org_gene_propag_to_remove, rxn_id, org_id, writer)
-                        if intersection and count == maximum:
-                            gene_ids_to_remove.add(gene_id)
-                            dict_rxn_org_gene_propag_to_remove = remove_gene(gene_ids_to_remove, dict_rxn_org_gene_propag_to_remove, rxn_id, org_id, writer)
-    return dict_rxn_org_gene_propag_to_remove
-
-
-# This function is called in extractPropagationToRemove().
-def remove_gene(gene_ids_to_remove, dict_rxn_org_gene_propag_to_remove, rxn_id,
-                org_id, writer):
-    if gene_ids_to_remove:
-        genes_ids = ";".join(gene_ids_to_remove)
-        if rxn_id in dict_rxn_org_gene_propag_to_remove:
-            dict_rxn_org_gene_propag_to_remove[rxn_id][org_id] = gene_ids_to_remove
-        else:
-            dict_rxn_org_gene_propag_to_remove[rxn_id] = {org_id: gene_ids_to_remove}
-            line = {"reaction_id": rxn_id, "org_id": org_id, "gene_id": genes_ids}
-            writer.writerow(line)
-    return dict_rxn_org_gene_propag_to_remove
-
-
-def spontaneous_dict_org_rxn_clean(dict_org_rxn_clean, tmp_dict_org_rxn_clean,
-                             dict_rxn_org_gene_propag_to_remove):
-    for org_id in tmp_dict_org_rxn_clean:
-        if org_id not in dict_org_rxn_clean:
-            dict_org_rxn_clean[org_id] = dict()
-        for rxn_id in tmp_dict_org_rxn_clean[org_id]:
-            if rxn_id in dict_rxn_org_gene_propag_to_remove.keys():
-                if rxn_id not in dict_org_rxn_clean[org_id]:
-                    dict_org_rxn_clean[org_id][rxn_id] = dict()
-                for gene_id in tmp_dict_org_rxn_clean[org_id][rxn_id]:
-                    if gene_id not in dict_org_rxn_clean[org_id][rxn_id]:
-                        dict_org_rxn_clean[org_id][rxn_id][gene_id] = tmp_dict_org_rxn_clean[org_id][rxn_id][gene_id]
-
-
-def create_dict_org_rxn_clean(padmet_file, padmet_folder,
-                              dict_rxn_org_gene_propag_to_remove):
-    padmet_path = os.path.join(padmet_folder, padmet_file)
-    org_id = os.path.splitext(padmet_file)[0].upper()
-    padmet = PadmetSpec(padmet_path)
+        previous_rxn_code = None
+        for rxn_code, org_code, gene_code in zip(propagation_to_remove['rxn_codes'].tolist(), propagation_to_remove['org_codes'].tolist(),
+                                                 propagation_to_remove['gene_codes'].tolist()):
+            if rxn_code != previous_rxn_code:
+                line = {"reaction_id": propagation['rxn_ids'][rxn_code], "org_id": propagation['org_ids'][org_code],
+                        "gene_id": propagation['gene_ids'][gene_code]}
+                writer.writerow(line)
+                previous_rxn_code = rxn_code
+    return propagation_to_remove
+
+
+def create_dict_org_rxn_clean(propagation_to_remove, gene_links):
+    """
+    Compute the new sources of the gene-reaction relations of the reactions having propagations to remove
+    from the data extracted by extractRGL (the padmets are not read again).
+    return dict {org_id: {rxn_id: {gene_id: list of new sources}}}, the organisms and reactions in the order of the padmets.
+    """
+    nb_orgs = len(gene_links['org_ids'])
+    nb_genes = len(gene_links['gene_ids'])
+    org_ids = gene_links['org_ids']
+    rxn_ids = gene_links['rxn_ids']
+    gene_ids = gene_links['gene_ids']
+    removed_keys = set(((propagation_to_remove['rxn_codes'].astype(np.int64)*nb_orgs + propagation_to_remove['org_codes'])*nb_genes
+                        + propagation_to_remove['gene_codes']).tolist())
+    removed_rxn_orgs = set((propagation_to_remove['rxn_codes'].astype(np.int64)*nb_orgs + propagation_to_remove['org_codes']).tolist())
+    removed_rxns = np.zeros(len(rxn_ids), dtype=bool)
+    removed_rxns[propagation_to_remove['rxn_codes']] = True
+
     dict_org_rxn_clean = dict()
-    dict_org_rxn_clean[org_id] = dict()
-    for rxn_id in [node.id for node in padmet.dicOfNode.values() if node.type == "reaction" and node.id in dict_rxn_org_gene_propag_to_remove.keys()]:
-        dict_org_rxn_clean[org_id][rxn_id] = dict()
-        for is_linked_rlt in [rlt for rlt in padmet.dicOfRelationIn[rxn_id] if rlt.type == "is_linked_to"]:
-            gene_id = is_linked_rlt.id_out
-            all_sources = {src.replace("OUTPUT_ORTHOFINDER_FROM_","")  for src in is_linked_rlt.misc["SOURCE:ASSIGNMENT"]}
-            new_sources = set()
-            for src in all_sources:
-                if src.startswith("GENOME:"):
-                    new_sources.add(src)
-                else:
-                    ortho_org_id, ortho_genes_ids = src.split(":")
-                    ortho_genes_ids = set(ortho_genes_ids.split(";"))
-                    if ortho_org_id not in dict_rxn_org_gene_propag_to_remove[rxn_id].keys():
-                        new_sources.add(src)
-                    else:
-                        new_ortho_genes_ids = set()
-                        for ortho_gene_id in ortho_genes_ids:
-                            if ortho_gene_id not in dict_rxn_org_gene_propag_to_remove[rxn_id][ortho_org_id]:
-                                new_ortho_genes_ids.add(ortho_gene_id)
-                        if new_ortho_genes_ids:
-                            new_src = "%s:%s"%(ortho_org_id, ";".join(new_ortho_genes_ids))
-                            new_sources.add(new_src)
-            dict_org_rxn_clean[org_id][rxn_id][gene_id] = new_sources
+    for org_code in gene_links['padmet_org_codes'].tolist():
+        dict_org_rxn_clean[org_ids[org_code]] = dict()
+    org_rxn_to_clean = np.flatnonzero(removed_rxns[gene_links['org_rxn_rxn']])
+    for org_code, rxn_code in zip(gene_links['org_rxn_org'][org_rxn_to_clean].tolist(), gene_links['org_rxn_rxn'][org_rxn_to_clean].tolist()):
+        dict_org_rxn_clean[org_ids[org_code]][rxn_ids[rxn_code]] = dict()
+
+    source_offsets = gene_links['source_offsets']
+    edge_offsets = gene_links['edge_offsets']
+    source_org = gene_links['source_org']
+    edge_gene = gene_links['edge_gene']
+    for link in np.flatnonzero(removed_rxns[gene_links['link_rxn']]).tolist():
+        org_code = int(gene_links['link_org'][link])
+        rxn_code = int(gene_links['link_rxn'][link])
+        new_sources = []
+        for source in range(source_offsets[link], source_offsets[link+1]):
+            ortho_org_code = int(source_org[source])
+            ortho_gene_codes = edge_gene[edge_offsets[source]:edge_offsets[source+1]].tolist()
+            if ortho_org_code == -1:
+                new_src = gene_links['source_texts'][gene_links['source_text'][source]]
+            elif rxn_code*nb_orgs + ortho_org_code not in removed_rxn_orgs:
+                new_src = "%s:%s"%(org_ids[ortho_org_code], ";".join([gene_ids[gene_code] for gene_code in ortho_gene_codes]))
+            else:
+                rxn_org_key = (rxn_code*nb_orgs + ortho_org_code)*nb_genes
+                new_ortho_genes_ids = dict.fromkeys([gene_ids[gene_code] for gene_code in ortho_gene_codes
+                                                     if rxn_org_key + gene_code not in removed_keys])
+                new_src = "%s:%s"%(org_ids[ortho_org_code], ";".join(new_ortho_genes_ids)) if new_ortho_genes_ids else None
+            if new_src and new_src not in new_sources:
+                new_sources.append(new_src)
+        dict_org_rxn_clean[org_ids[org_code]][rxn_ids[rxn_code]][gene_ids[gene_links['link_gene'][link]]] = new_sources
 
     return dict_org_rxn_clean
 
 
 # This function is called in the cleanPadmet() function. 
-def delete_propagation(padmet_file, padmet_folder, dict_org_rxn_clean,
+def delete_propagation(padmet_file, padmet_folder, org_rxn_clean,
                        output_folder):
     padmet_path = os.path.join(padmet_folder, padmet_file)
     org_id = os.path.splitext(padmet_file)[0].upper()
-    padmet = PadmetSpec(padmet_path)
     output = os.path.join(output_folder, padmet_file)
     nb_rxn_removed = 0
-    for rxn_id, rxn_data in dict_org_rxn_clean[org_id].items():
+    # Nothing to clean, no need to load the padmet.
+    if not org_rxn_clean:
+        print("Removing %s in %s"%(nb_rxn_removed, org_id))
+        shutil.copyfile(padmet_path, output)
+        return
+    padmet = PadmetSpec(padmet_path)
+    # The gene-reaction relations are indexed once, instead of searching the relations of the gene for each change.
+    relation_index = RelationIndex(padmet, ['is_linked_to'])
+    for rxn_id, rxn_data in org_rxn_clean.items():
         if any(rxn_data.keys()):
             if not any(rxn_data.values()):
                 nb_rxn_removed += 1
-                padmet.delNode(rxn_id)
+                relation_index.delete_node(rxn_id)
             else:
                 for gene_id, gene_data in rxn_data.items():
-                    is_linked_rlt = [rlt for rlt in padmet.dicOfRelationOut[gene_id] if rlt.id_in == rxn_id and rlt.id_out == gene_id][0]
+                    is_linked_rlt = relation_index.get(rxn_id, gene_id, 'is_linked_to')
                     if not gene_data:
                         #remove relation
-                        padmet._delRelation(is_linked_rlt)
+                        relation_index.delete(is_linked_rlt)
                     else:
                         #update relation.misc[src:assgn], /!\ MAJ et source edition
                         is_linked_rlt.misc["SOURCE:ASSIGNMENT"] = ["OUTPUT_ORTHOFINDER_FROM_%s"%src for src in gene_data]
+    relation_index.flush()
     print("Removing %s in %s"%(nb_rxn_removed, org_id))
     padmet.generateFile(output)
 
 
-def cleanPadmet(dict_rxn_org_gene_propag_to_remove, dict_rxn_ec, padmet_folder,
+def cleanPadmet(propagation_to_remove, dict_rxn_ec, gene_links, padmet_folder,
                 output_folder, reactions_to_remove_file, aucome_pool):
     """
     It cleans the Padmet files and it writes the reactions_to_remove_file file.
     """
-    dict_org_rxn_clean = dict()
-    create_multiprocessing_datas = []
-    for padmet_file in next(os.walk(padmet_folder))[2]:
-        create_multiprocessing_datas.append([padmet_file, padmet_folder, dict_rxn_org_gene_propag_to_remove])
-
-    multiprocessing_results = aucome_pool.starmap(create_dict_org_rxn_clean, create_multiprocessing_datas)
-
-    for multiprocessing_result in multiprocessing_results:
-        spontaneous_dict_org_rxn_clean(dict_org_rxn_clean, multiprocessing_result, dict_rxn_org_gene_propag_to_remove)
-
-    remove_multiprocessing_datas = []
-    for padmet_file in next(os.walk(padmet_folder))[2]:
-        remove_multiprocessing_datas.append([padmet_file, padmet_folder, dict_org_rxn_clean, output_folder])
+    dict_org_rxn_clean = create_dict_org_rxn_clean(propagation_to_remove, gene_links)
+    # Work units are split by organism: each worker receives only the new sources of the relations of its organism.
+    multiprocessing_datas = []
+    for padmet_file in gene_links['padmet_files']:
+        org_id = os.path.splitext(padmet_file)[0].upper()
+        multiprocessing_datas.append([padmet_file, padmet_folder, dict_org_rxn_clean[org_id], output_folder])
 
-    aucome_pool.starmap(delete_propagation, remove_multiprocessing_datas)
+    aucome_pool.starmap(delete_propagation, multiprocessing_datas)
 
     with open(reactions_to_remove_file, 'w') as csvfile:
         header = ["org_id","reaction_id", "ec-number", "gene_id"]
@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Organism x reaction presence matrix of the metabolic networks (padmet_from_networks_path), shared by the analysis and compare steps.
+
+The padmet of each organism is read once (as compare_padmet does) and the matrix is stored in the cache folder of the run
+(not in the analysis folder, where each group has its own folder):
+    reaction_matrix/reaction_matrix.npz: organisms, reactions, presence matrix (bits packed by organism) and the size and modification time of the padmets.
+    reaction_matrix/<organism>.pkl: genes, reactions (genes associated and formula), pathways and metabolites of the organism.
+Only the padmets modified since the matrix was stored are read again.
+The reactions.tsv, genes.tsv, pathways.tsv and metabolites.tsv files of a group are written from the matrix, without reading its padmets.
+"""
+
+import csv
+import numpy as np
+import os
+import pickle
+
+from aucome.utils import get_run_context, create_aucome_pool, get_workspace_inventory, load_padmet_ref
+
+
+class ReactionMatrix:
+    """Presence of the reactions in the organisms.
+
+    Args:
+        matrix_path (str): path to the folder of the matrix
+        organisms (list): organism names (rows of the matrix)
+        reactions (list): reaction IDs (columns of the matrix)
+        presence (numpy.ndarray): boolean matrix, presence[i, j] is True if the reaction j is in the organism i
+        padmet_stamps (dict): k = organism, v = (size, modification time) of its padmet when it was read
+        database_stamp (tuple): (size, modification time) of the padmet of reference used to compute the pathway completion rates
+    """
+
+    def __init__(self, matrix_path, organisms, reactions, presence, padmet_stamps, database_stamp):
+        self.matrix_path = matrix_path
+        self.organisms = list(organisms)
+        self.organism_indexes = dict([(organism, organism_index) for organism_index, organism in enumerate(self.organisms)])
+        self.reactions = np.array(reactions, dtype=str)
+        self.presence = presence
+        self.padmet_stamps = padmet_stamps
+        self.database_stamp = database_stamp
+
+    def group_presence(self, organisms):
+        """Slice the matrix for a group of organisms.
+
+        Args:
+            organisms (list): organism names
+        Returns:
+            numpy.ndarray: reaction IDs present in at least one organism of the group
+            numpy.ndarray: presence matrix of the group (rows = organisms, columns = the reactions returned)
+        """
+        group_matrix = self.presence[[self.organism_indexes[organism] for organism in organisms]]
+        group_reactions = group_matrix.any(axis=0)
+        return self.reactions[group_reactions], group_matrix[:, group_reactions]
+
+    def group_reactions(self, organisms):
+        """Reactions present in at least one organism of a group.
+
+        Args:
+            organisms (list): organism names
+        Returns:
+            set: reaction IDs
+        """
+        return set(self.group_presence(organisms)[0].tolist())
+
+    def organism_elements(self, organism):
+        """Load the genes, reactions, pathways and metabolites of an organism (see compare_padmet.extract_information_padmet).
+
+        Args:
+            organism (str): organism name
+        Returns:
+            tuple: dict_genes, dict_rxns, dict_pwys, dict_cpds of the organism
+        """
+        with open(os.path.join(self.matrix_path, organism + '.pkl'), 'rb') as organism_file:
+            return pickle.load(organism_file)
+
+    def write_comparison(self, organisms, output_folder, verbose=None):
+        """Write the files of compare_padmet (genes.tsv, reactions.tsv, pathways.tsv and metabolites.tsv) for a group of organisms.
+
+        Args:
+            organisms (list): organism names
+            output_folder (str): path to the output folder
+            verbose (boolean): verbose
+        """
+        if not os.path.exists(output_folder):
+            os.makedirs(output_folder)
+
+        dict_genes, dict_pwys, dict_cpds = {}, {}, {}
+        organism_rxns = {}
+        for organism in organisms:
+            tmp_dict_genes, tmp_dict_rxns, tmp_dict_pwys, tmp_dict_cpds = self.organism_elements(organism)
+            merge_organism_elements(dict_genes, tmp_dict_genes)
+            merge_organism_elements(dict_pwys, tmp_dict_pwys)
+            merge_organism_elements(dict_cpds, tmp_dict_cpds)
+            organism_rxns[organism] = tmp_dict_rxns
+
+        #gene file header: gene_id, base_file_1, base_file_n, base_file_1_rxn_assoc (sep=;), base_file_n_rxn_assoc (sep=;)
+        genes_file = os.path.join(output_folder, 'genes.tsv')
+        if verbose:
+            print('creating %s' %genes_file)
+        with open(genes_file, 'w') as csvfile:
+            fieldnames = ['gene'] + organisms + [organism + '_rxn_assoc (sep=;)' for organism in organisms]
+            writer = csv.DictWriter(csvfile, fieldnames=fieldnames, delimiter='\t')
+            writer.writeheader()
+            for gene_id, dic_organism_rxn_assoc in dict_genes.items():
+                dict_row = {'gene': gene_id}
+                for organism, rxn_assoc in dic_organism_rxn_assoc.items():
+                    dict_row.update({organism: 1, organism + '_rxn_assoc (sep=;)': rxn_assoc})
+                writer.writerow(dict_row)
+
+        #reactions file header: rxn_id, base_file_1, base_file_n, base_file_1_genes_assoc (sep=;), base_file_n_genes_assoc (sep=;), base_file_1_formula, base_file_n_formula
+        # The presence columns come from the matrix, the genes associated and the formulas from the organism data.
+        rxns_file = os.path.join(output_folder, 'reactions.tsv')
+        if verbose:
+            print('creating %s' %rxns_file)
+        group_reactions, group_matrix = self.group_presence(organisms)
+        with open(rxns_file, 'w') as csvfile:
+            fieldnames = ['reaction'] + organisms + [organism + '_genes_assoc (sep=;)' for organism in organisms] + [organism + '_formula' for organism in organisms]
+            writer = csv.DictWriter(csvfile, fieldnames=fieldnames, delimiter='\t')
+            writer.writeheader()
+            for rxn_index, rxn_id in enumerate(group_reactions.tolist()):
+                dict_row = {'reaction': rxn_id}
+                for organism_index, organism in enumerate(organisms):
+                    if group_matrix[organism_index, rxn_index]:
+                        rxn_data = organism_rxns[organism][rxn_id][organism]
+                        dict_row.update({organism: 1, organism + '_genes_assoc (sep=;)': rxn_data['genes_associated'], organism + '_formula': rxn_data['formula']})
+                    else:
+                        dict_row[organism] = 0
+                writer.writerow(dict_row)
+
+        #pathways file header: pwy, base_file_1_rate, base_file_n_rate, base_file_1_rxn_assoc (sep=;), base_file_n_rxn_assoc (sep=;)
+        pwys_file = os.path.join(output_folder, 'pathways.tsv')
+        if verbose:
+            print('creating %s' %pwys_file)
+        with open(pwys_file, 'w') as csvfile:
+            fieldnames = ['pathway'] + [organism + '_completion_rate' for organism in organisms] + [organism + '_rxn_assoc (sep=;)' for organism in organisms]
+            writer = csv.DictWriter(csvfile, fieldnames=fieldnames, delimiter='\t')
+            writer.writeheader()
+            for pwy_id, dict_organism_data in dict_pwys.items():
+                dict_row = {'pathway': pwy_id}
+                for organism, pwy_data in dict_organism_data.items():
+                    dict_row.update({organism + '_completion_rate': pwy_data['ratio'], organism + '_rxn_assoc (sep=;)': pwy_data['rxn_associated']})
+                writer.writerow(dict_row)
+
+        #metabolites file header: cpd, base_file_1, base_file_n
+        cpds_file = os.path.join(output_folder, 'metabolites.tsv')
+        if verbose:
+            print('creating %s' %cpds_file)
+        with open(cpds_file, 'w') as csvfile:
+            fieldnames = ['metabolite'] + [organism + '_rxn_consume' for organism in organisms] + [organism + '_rxn_produce' for organism in organisms]
+            writer = csv.DictWriter(csvfile, fieldnames=fieldnames, delimiter='\t')
+            writer.writeheader()
+            for cpd_id, dict_organism_data in dict_cpds.items():
+                dict_row = {'metabolite': cpd_id}
+                for organism, cpd_data in dict_organism_data.items():
+                    dict_row.update({organism + '_rxn_consume': cpd_data['rxn_consume'], organism + '_rxn_produce': cpd_data['rxn_produce']})
+                writer.writerow(dict_row)
+
+    def save(self):
+        """Write the matrix in reaction_matrix.npz (the presence bits are packed by organism)."""
+        matrix_file = os.path.join(self.matrix_path, 'reaction_matrix.npz')
+        # Write in a temporary file then rename it, so an interrupted step never leaves a partial matrix.
+        tmp_matrix_file = matrix_file + '.' + str(os.getpid()) + '.tmp.npz'
+        np.savez(tmp_matrix_file,
+                 organisms=np.array(self.organisms, dtype=str),
+                 reactions=self.reactions,
+                 presence=np.packbits(self.presence, axis=1),
+                 padmet_stamps=np.array([self.padmet_stamps[organism] for organism in self.organisms], dtype=np.int64).reshape(-1, 2),
+                 database_stamp=np.array(self.database_stamp, dtype=np.int64))
+        os.replace(tmp_matrix_file, matrix_file)
+
+
+def merge_organism_elements(element_dict, tmp_dict):
+    """Add the elements of an organism to the elements of the group (as compare_padmet.merge_dicts).
+
+    Args:
+        element_dict (dict): k = element ID, v = dict: k = organism, v = data of the element in the organism
+        tmp_dict (dict): elements of an organism, same structure
+    """
+    for element_id, organism_data in tmp_dict.items():
+        if element_id in element_dict:
+            element_dict[element_id].update(organism_data)
+        else:
+            element_dict[element_id] = dict(organism_data)
+
+
+def load_reaction_matrix(matrix_path):
+    """Load the matrix stored in a folder.
+
+    Args:
+        matrix_path (str): path to the folder of the matrix
+    Returns:
+        ReactionMatrix: the matrix, None if there is no (readable) matrix
+    """
+    matrix_file = os.path.join(matrix_path, 'reaction_matrix.npz')
+    if not os.path.exists(matrix_file):
+        return None
+    try:
+        with np.load(matrix_file) as matrix_data:
+            organisms = matrix_data['organisms'].tolist()
+            reactions = matrix_data['reactions']
+            presence = np.unpackbits(matrix_data['presence'], axis=1, count=len(reactions)).astype(bool)
+            padmet_stamps = dict([(organism, tuple(padmet_stamp)) for organism, padmet_stamp in zip(organisms, matrix_data['padmet_stamps'].tolist())])
+            database_stamp = tuple(matrix_data['database_stamp'].tolist())
+    except (OSError, KeyError, ValueError):
+        return None
+    return ReactionMatrix(matrix_path, organisms, reactions, presence, padmet_stamps, database_stamp)
+
+
+def extract_organism_elements(organism_data):
+    """Read the padmet of an organism and save its genes, reactions, pathways and metabolites in the folder of the matrix.
+
+    Args:
+        organism_data (dict): organism name, path to its padmet, path to the padmet of reference and path to the folder of the matrix
+    Returns:
+        list: reaction IDs of the organism
+    """
+    from padmet.utils.exploration import compare_padmet
+
+    organism = organism_data['organism']
+    padmet_file = organism_data['padmet_file']
+    matrix_path = organism_data['matrix_path']
+    # The padmet of reference is loaded by the main process before creating the pool, so the forked workers reuse it.
+    padmetRef = load_padmet_ref(organism_data['database_path'])
+
+    organism_elements = compare_padmet.extract_information_padmet(padmet_file, padmetRef, False)
+
+    organism_file = os.path.join(matrix_path, organism + '.pkl')
+    tmp_organism_file = organism_file + '.' + str(os.getpid()) + '.tmp'
+    with open(tmp_organism_file, 'wb') as output_file:
+        pickle.dump(organism_elements, output_file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_organism_file, organism_file)
+
+    return list(organism_elements[1])
+
+
+def get_reaction_matrix(run_id, nb_cpu_to_use, verbose=None, aucome_pool=None):
+    """Get the reaction matrix of the padmets in padmet_from_networks_path, updated with the padmets modified since it was stored.
+
+    Args:
+        run_id (str): ID of the run
+        nb_cpu_to_use (int): number of CPU for multiprocessing
+        verbose (boolean): verbose
+        aucome_pool (multiprocessing.Pool): pool of workers (if None a pool is created)
+    Returns:
+        ReactionMatrix: the matrix
+    """
+    run_context = get_run_context(run_id)
+    padmet_from_networks_path = run_context.padmet_from_networks_path
+    database_path = run_context.database_path
+    matrix_path = os.path.join(run_context.cache_path, 'reaction_matrix')
+    workspace_inventory = get_workspace_inventory(run_id)
+
+    padmet_stamps = {}
+    for padmet_filename, entry_type in workspace_inventory.list_folder(padmet_from_networks_path).items():
+        if entry_type == 'file' and padmet_filename.endswith('.padmet'):
+            padmet_stat = os.stat(os.path.join(padmet_from_networks_path, padmet_filename))
+            padmet_stamps[padmet_filename[:-len('.padmet')]] = (padmet_stat.st_size, padmet_stat.st_mtime_ns)
+    database_stat = os.stat(database_path)
+    database_stamp = (database_stat.st_size, database_stat.st_mtime_ns)
+
+    if not os.path.isdir(matrix_path):
+        os.makedirs(matrix_path)
+
+    # Keep the rows of the organisms whose padmet has not changed since the matrix was stored.
+    organism_reactions = {}
+    stored_matrix = load_reaction_matrix(matrix_path)
+    if stored_matrix is not None and stored_matrix.database_stamp == database_stamp:
+        for organism, organism_index in stored_matrix.organism_indexes.items():
+            if padmet_stamps.get(organism) == stored_matrix.padmet_stamps[organism] and os.path.exists(os.path.join(matrix_path, organism + '.pkl')):
+                organism_reactions[organism] = stored_matrix.reactions[stored_matrix.presence[organism_index]].tolist()
+
+    organisms = sorted(padmet_stamps)
+    organisms_to_extract = [organism for organism in organisms if organism not in organism_reactions]
+    if organisms_to_extract:
+        if verbose:
+            print('Read %s padmets for the reaction matrix' %len(organisms_to_extract))
+        load_padmet_ref(database_path, verbose, run_context.cache_path)
+        close_pool = aucome_pool is None
+        if close_pool:
+            aucome_pool = create_aucome_pool(nb_cpu_to_use)
+        organism_datas = [{'organism': organism, 'padmet_file': os.path.join(padmet_from_networks_path, organism + '.padmet'),
+                           'database_path': database_path, 'matrix_path': matrix_path}
+                          for organism in organisms_to_extract]
+        for organism, reactions in zip(organisms_to_extract, aucome_pool.imap(extract_organism_elements, organism_datas)):
+            organism_reactions[organism] = reactions
+        if close_pool:
+            aucome_pool.close()
+            aucome_pool.join()
+
+    reactions = sorted(set([rxn_id for organism in organisms for rxn_id in organism_reactions[organism]]))
+    reaction_indexes = dict([(rxn_id, rxn_index) for rxn_index, rxn_id in enumerate(reactions)])
+    presence = np.zeros((len(organisms), len(reactions)), dtype=bool)
+    for organism_index, organism in enumerate(organisms):
+        presence[organism_index, [reaction_indexes[rxn_id] for rxn_id in organism_reactions[organism]]] = True
+
+    reaction_matrix = ReactionMatrix(matrix_path, organisms, reactions, presence, padmet_stamps, database_stamp)
+    if organisms_to_extract or stored_matrix is None or stored_matrix.organisms != organisms:
+        reaction_matrix.save()
+        # Remove the data of the organisms without padmet.
+        for matrix_filename in os.listdir(matrix_path):
+            if matrix_filename.endswith('.pkl') and matrix_filename[:-len('.pkl')] not in padmet_stamps:
+                os.remove(os.path.join(matrix_path, matrix_filename))
+
+    return reaction_matrix
@@ -13,14 +13,12 @@ options:
 
 import docopt
 import logging
-import mpwt
 import os
 import time
 
 from padmet.utils.connection import pgdb_to_padmet, sbmlGenerator
 
-from aucome.utils import parse_config_file
-from multiprocessing import Pool
+from aucome.utils import get_run_context, create_aucome_pool, get_workspace_inventory, StepTelemetry
 
 logger = logging.getLogger('aucome')
 logger.setLevel(logging.CRITICAL)
@@ -48,38 +46,45 @@ def reconstruction_parse_args(command_args):
     run_reconstruction(run_id, nb_cpu_to_use, verbose, veryverbose)
 
 
-def run_reconstruction(run_id, nb_cpu_to_use, verbose, veryverbose=None):
+def run_reconstruction(run_id, nb_cpu_to_use, verbose, veryverbose=None, aucome_pool=None):
     if verbose:
         logger.setLevel(logging.DEBUG)
         logging.getLogger("mpwt").setLevel(logging.DEBUG)
         print('--- Running reconstruction step ---')
     start_time = time.time()
-    config_data = parse_config_file(run_id)
-
-    pgdb_from_annotation_path = config_data['pgdb_from_annotation_path']
-    studied_organisms_path = config_data['studied_organisms_path']
-    log_path = config_data['log_path']
+    step_telemetry = StepTelemetry(run_id, 'reconstruction')
+    # mpwt is only needed to run Pathway Tools, it is not imported by the other steps using this module.
+    import mpwt
+    run_context = get_run_context(run_id)
 
+    pgdb_from_annotation_path = run_context.pgdb_from_annotation_path
+    studied_organisms_path = run_context.studied_organisms_path
+    log_path = run_context.log_path
+    workspace_inventory = get_workspace_inventory(run_id)
 
     taxon_file = None
-    if 'taxon_id.tsv' in set(next(os.walk(config_data['studied_organisms_path']))[2]):
+    if workspace_inventory.is_file(studied_organisms_path + '/taxon_id.tsv'):
         taxon_file = True
 
-    mpwt.multiprocess_pwt(input_folder=studied_organisms_path,
-                            output_folder=pgdb_from_annotation_path,
-                            patho_inference=True,
-                            flat_creation=True,
-                            dat_extraction=True,
-                            number_cpu=nb_cpu_to_use,
-                            patho_log=log_path,
-                            taxon_file=taxon_file,
-                            verbose=verbose)
-
-    if os.listdir(pgdb_from_annotation_path) == []:
+    with step_telemetry.stage('pathway_tools'):
+        mpwt.multiprocess_pwt(input_folder=studied_organisms_path,
+                                output_folder=pgdb_from_annotation_path,
+                                patho_inference=True,
+                                flat_creation=True,
+                                dat_extraction=True,
+                                number_cpu=nb_cpu_to_use,
+                                patho_log=log_path,
+                                taxon_file=taxon_file,
+                                verbose=verbose)
+
+    # The PGDBs have been created by Pathway Tools.
+    workspace_inventory.refresh(pgdb_from_annotation_path)
+    if workspace_inventory.list_folder(pgdb_from_annotation_path) == {}:
         print('Pathway-Tools inference failed!')
+        step_telemetry.write(verbose)
         return
 
-    create_padmet_sbml_from_pgdb(run_id, nb_cpu_to_use, verbose, veryverbose)
+    create_padmet_sbml_from_pgdb(run_id, nb_cpu_to_use, verbose, veryverbose, aucome_pool, step_telemetry)
 
     end_time = (time.time() - start_time)
     integer_part, decimal_part = str(end_time).split('.')
@@ -87,47 +92,70 @@ def run_reconstruction(run_id, nb_cpu_to_use, verbose, veryverbose=None):
 
     if verbose:
         print("--- reconstruction step done in: %ss ---" %reconstruction_time)
+    step_telemetry.write(verbose)
 
-def create_padmet_sbml_from_pgdb(run_id, nb_cpu_to_use, verbose, veryverbose):
-    config_data = parse_config_file(run_id)
+def create_padmet_sbml_from_pgdb(run_id, nb_cpu_to_use, verbose, veryverbose, aucome_pool=None, step_telemetry=None):
+    run_context = get_run_context(run_id)
+    # Without the telemetry of the reconstruction step, the tasks are measured but not reported.
+    if step_telemetry is None:
+        step_telemetry = StepTelemetry(run_id, 'reconstruction')
 
-    padmet_from_annotation_path = config_data['padmet_from_annotation_path']
-    study_from_annot_prefix = config_data['study_from_annot_prefix']
-    sbml_from_annotation_path = config_data['sbml_from_annotation_path']
-    database_path = config_data['database_path']
-    pgdb_from_annotation_path = config_data['pgdb_from_annotation_path']
+    padmet_from_annotation_path = run_context.padmet_from_annotation_path
+    study_from_annot_prefix = run_context.study_from_annot_prefix
+    sbml_from_annotation_path = run_context.sbml_from_annotation_path
+    database_path = run_context.database_path
 
-    aucome_pool = Pool(nb_cpu_to_use)
+    close_pool = aucome_pool is None
+    if close_pool:
+        aucome_pool = create_aucome_pool(nb_cpu_to_use)
 
-    all_study_name = set(next(os.walk(config_data['studied_organisms_path']))[1])
+    workspace_inventory = get_workspace_inventory(run_id)
+    all_study_name = workspace_inventory.organisms()
 
-    all_study_pgdb = dict([(study_name, "{0}/{1}".format(pgdb_from_annotation_path, study_name))
-                        if os.path.isdir("{0}/{1}".format(pgdb_from_annotation_path, study_name))
-                        else (study_name, '')
+    all_study_pgdb = dict([(study_name, workspace_inventory.organism_files(study_name)['pgdb'])
                         for study_name in all_study_name])
 
     study_padmet_data = []
     for study_name in all_study_name:
         padmet_file = "{0}/{1}{2}.padmet".format(padmet_from_annotation_path, study_from_annot_prefix, study_name)
+        sbml_file = "{0}/{1}{2}.sbml".format(sbml_from_annotation_path, study_from_annot_prefix, study_name)
         pgdb_folder = all_study_pgdb[study_name]
         tmp_padmet_data = {'study_name': study_name, 'pgdb_folder': pgdb_folder, 'veryverbose': veryverbose,
-                            'verbose': verbose, 'padmet_file': padmet_file, 'database_path': database_path}
+                            'verbose': verbose, 'padmet_file': padmet_file, 'sbml_file': sbml_file, 'database_path': database_path}
         study_padmet_data.append(tmp_padmet_data)
-    aucome_pool.map(create_padmet_from_pgdb, study_padmet_data)
+    # One task by organism (padmet then sbml), so an organism does not wait for the padmet of the others to create its sbml.
+    organism_results = step_telemetry.map(aucome_pool, 'padmet_sbml', create_padmet_sbml, [[tmp_padmet_data] for tmp_padmet_data in study_padmet_data],
+                                          [tmp_padmet_data['study_name'] for tmp_padmet_data in study_padmet_data])
+    for created_files in organism_results:
+        workspace_inventory.add_files(created_files)
 
-    all_study_padmet = dict([(study_name, "{0}/{1}{2}.padmet".format(padmet_from_annotation_path, study_from_annot_prefix, study_name))
-                            if os.path.isfile("{0}/{1}{2}.padmet".format(padmet_from_annotation_path, study_from_annot_prefix, study_name))
-                            else (study_name, '')
-                            for study_name in all_study_name])
+    if close_pool:
+        aucome_pool.close()
+        aucome_pool.join()
 
-    study_sbml_data = []
-    for study_name in all_study_padmet:
-        sbml_file = "{0}/{1}{2}.sbml".format(sbml_from_annotation_path, study_from_annot_prefix, study_name)
-        padmet_file = all_study_padmet[study_name]
-        tmp_sbml_data = {'sbml_file': sbml_file, 'padmet_file': padmet_file,
-                         'study_name': study_name, 'verbose': verbose, 'veryverbose': veryverbose}
-        study_sbml_data.append(tmp_sbml_data)
-    aucome_pool.map(create_sbml, study_sbml_data)
+
+def create_padmet_sbml(tmp_study_data):
+    """Create the padmet from the PGDB and the sbml from the padmet of an organism.
+
+    Args:
+        tmp_study_data (dict): data of the organism used by create_padmet_from_pgdb and create_sbml
+    Returns:
+        list: paths to the padmet and sbml files created
+    """
+    padmet_created = create_padmet_from_pgdb(tmp_study_data)
+
+    padmet_file = tmp_study_data['padmet_file'] if os.path.isfile(tmp_study_data['padmet_file']) else ''
+    tmp_sbml_data = {'sbml_file': tmp_study_data['sbml_file'], 'padmet_file': padmet_file,
+                     'study_name': tmp_study_data['study_name'], 'verbose': tmp_study_data['verbose'],
+                     'veryverbose': tmp_study_data['veryverbose']}
+    sbml_created = create_sbml(tmp_sbml_data)
+
+    created_files = []
+    if padmet_created and padmet_file:
+        created_files.append(padmet_file)
+    if sbml_created:
+        created_files.append(tmp_study_data['sbml_file'])
+    return created_files
 
 
 def create_padmet_from_pgdb(tmp_padmet_data):
@@ -142,6 +170,8 @@ def create_padmet_from_pgdb(tmp_padmet_data):
         if verbose:
             print("Creating padmet from pgdb for %s" %study_name)
         pgdb_to_padmet.from_pgdb_to_padmet(pgdb_folder=pgdb_folder, padmetRef_file=database_path, source="genome", extract_gene=True, no_orphan=True, verbose=veryverbose, output_file=padmet_file)
+        return True
+    return False
 
 
 def create_sbml(tmp_sbml_data):
@@ -155,3 +185,5 @@ def create_sbml(tmp_sbml_data):
         if verbose:
             print("Creating sbml from padmet for %s" %study_name)
         sbmlGenerator.padmet_to_sbml(padmet=padmet_file, output=sbml_file, sbml_lvl=3, verbose=veryverbose)
+        return True
+    return False
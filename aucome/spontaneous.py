@@ -19,9 +19,8 @@ import time
 
 from shutil import copyfile
 from padmet.utils.connection import sbml_to_padmet, sbmlGenerator, padmet_to_padmet
-from padmet.classes import PadmetRef, PadmetSpec
-from aucome.utils import parse_config_file
-from multiprocessing import Pool
+from padmet.classes import PadmetSpec
+from aucome.utils import get_run_context, load_padmet_ref, create_aucome_pool, get_workspace_inventory, StepTelemetry
 
 
 def command_help():
@@ -45,29 +44,30 @@ def spontaneous_parse_args(command_args):
     run_spontaneous(run_id, nb_cpu_to_use, verbose, veryverbose)
 
 
-def run_spontaneous(run_id, nb_cpu_to_use, verbose, veryverbose=None):
+def run_spontaneous(run_id, nb_cpu_to_use, verbose, veryverbose=None, aucome_pool=None):
     if verbose:
         print('--- Running spontaneous step ---')
     spontaneous_start_time = time.time()
-    aucome_pool = Pool(nb_cpu_to_use)
+    step_telemetry = StepTelemetry(run_id, 'spontaneous')
 
-    config_data = parse_config_file(run_id)
+    run_context = get_run_context(run_id)
 
-    padmet_from_annotation_path = config_data['padmet_from_annotation_path']
-    padmet_from_networks_path = config_data['padmet_from_networks_path']
-    sbml_from_networks_path = config_data['sbml_from_networks_path']
-    database_path = config_data['database_path']
+    padmet_from_annotation_path = run_context.padmet_from_annotation_path
+    padmet_from_networks_path = run_context.padmet_from_networks_path
+    sbml_from_networks_path = run_context.sbml_from_networks_path
+    database_path = run_context.database_path
 
-    structural_padmets_path = config_data['structural_padmets_path']
-    orthofinder_filtered_path = config_data['orthofinder_filtered_path']
-    orthofinder_padmet_path = config_data['orthofinder_padmet_path']
-    padmet_from_annotation_path = config_data['padmet_from_annotation_path']
-    networks_path = config_data['networks_path']
+    structural_padmets_path = run_context.structural_padmets_path
+    orthofinder_filtered_path = run_context.orthofinder_filtered_path
+    orthofinder_padmet_path = run_context.orthofinder_padmet_path
+    padmet_from_annotation_path = run_context.padmet_from_annotation_path
+    networks_path = run_context.networks_path
 
-    structural_padmets = [padmet for padmet in os.listdir(structural_padmets_path) if padmet.endswith('.padmet')]
-    orthofinder_filtered_padmets = [padmet for padmet in os.listdir(orthofinder_filtered_path) if padmet.endswith('.padmet')]
-    orthofinder_padmets = [padmet for padmet in os.listdir(orthofinder_padmet_path) if padmet.endswith('.padmet')]
-    pathway_tools_padmets = [padmet for padmet in os.listdir(padmet_from_annotation_path) if padmet.endswith('.padmet')]
+    workspace_inventory = get_workspace_inventory(run_id)
+    structural_padmets = [padmet for padmet in workspace_inventory.list_folder(structural_padmets_path) if padmet.endswith('.padmet')]
+    orthofinder_filtered_padmets = [padmet for padmet in workspace_inventory.list_folder(orthofinder_filtered_path) if padmet.endswith('.padmet')]
+    orthofinder_padmets = [padmet for padmet in workspace_inventory.list_folder(orthofinder_padmet_path) if padmet.endswith('.padmet')]
+    pathway_tools_padmets = [padmet for padmet in workspace_inventory.list_folder(padmet_from_annotation_path) if padmet.endswith('.padmet')]
 
     if len(structural_padmets) > 0:
         padmets = [(padmet, structural_padmets_path + '/' + padmet) for padmet in structural_padmets]
@@ -80,19 +80,33 @@ def run_spontaneous(run_id, nb_cpu_to_use, verbose, veryverbose=None):
     else:
         sys.exit('No padmets have been created, run reconstruction or workflow.')
 
+    # Load the padmet of reference before creating the Pool, so it is shared with the workers.
+    # With the pool of the workflow, the padmet of reference has been loaded before the creation of the pool.
+    with step_telemetry.stage('spontaneous_index'):
+        padmetRef = load_padmet_ref(database_path, verbose, run_context.cache_path)
+        spontaneous_index = create_spontaneous_index(padmetRef)
+    close_pool = aucome_pool is None
+    if close_pool:
+        aucome_pool = create_aucome_pool(nb_cpu_to_use)
+
     study_draft_data = []
     for study_name, padmet_path in padmets:
         tmp_study_data = {'padmet_path': padmet_path, 'study_padmet': study_name, 'padmet_from_networks_path': padmet_from_networks_path,
                             'sbml_from_networks_path': sbml_from_networks_path, 'database_path': database_path,
-                            'verbose': verbose, 'veryverbose': veryverbose}
+                            'spontaneous_index': spontaneous_index, 'verbose': verbose, 'veryverbose': veryverbose}
         study_draft_data.append(tmp_study_data)
-    aucome_pool.map(create_output, study_draft_data)
+    step_telemetry.map(aucome_pool, 'spontaneous_organism', create_output, [[tmp_study_data] for tmp_study_data in study_draft_data],
+                       [tmp_study_data['study_padmet'].replace('.padmet', '').replace('output_pathwaytools_', '') for tmp_study_data in study_draft_data],
+                       chunksize=None)
 
-    aucome_pool.close()
-    aucome_pool.join()
+    if close_pool:
+        aucome_pool.close()
+        aucome_pool.join()
 
-    padmet_to_padmet.padmet_to_padmet(padmet_from_networks_path, networks_path + '/panmetabolism.padmet', verbose=veryverbose)
-    sbmlGenerator.padmet_to_sbml(padmet=networks_path + '/panmetabolism.padmet', output=networks_path + '/panmetabolism.sbml', verbose=veryverbose)
+    with step_telemetry.stage('panmetabolism'):
+        padmet_to_padmet.padmet_to_padmet(padmet_from_networks_path, networks_path + '/panmetabolism.padmet', verbose=veryverbose)
+        sbmlGenerator.padmet_to_sbml(padmet=networks_path + '/panmetabolism.padmet', output=networks_path + '/panmetabolism.sbml', verbose=veryverbose)
+    workspace_inventory.refresh(networks_path)
 
     spontaneous_end_time = (time.time() - spontaneous_start_time)
     integer_part, decimal_part = str(spontaneous_end_time).split('.')
@@ -100,21 +114,56 @@ def run_spontaneous(run_id, nb_cpu_to_use, verbose, veryverbose=None):
 
     if verbose:
         print("--- spontaneous step done in: %ss ---" %spontaneous_time)
+    step_telemetry.write(verbose)
+
+
+def create_spontaneous_index(padmetRef):
+    """
+    Index the spontaneous reactions of the padmet of reference.
+    It is created once by run and used for all the species.
+    return dict with:
+        'spontaneous_reactions': set of spontaneous reaction ids
+        'reaction_pathways': k = spontaneous reaction id, v = set of pathways containing it
+        'pathway_reactions': k = pathway id, v = set of reactions of the pathway in the padmet of reference
+    """
+    all_spontaneous_rxns = set([node.id for node in list(padmetRef.dicOfNode.values()) if node.type == "reaction" and "SPONTANEOUS" in node.misc])
+
+    dict_rxn_pwys = {}
+    dict_pwy_rxns = {}
+    for spontaneous_rxn_id in all_spontaneous_rxns:
+        in_pwys = set([rlt.id_out for rlt in padmetRef.dicOfRelationIn.get(spontaneous_rxn_id, []) if rlt.type == "is_in_pathway"])
+        dict_rxn_pwys[spontaneous_rxn_id] = in_pwys
+        for pwy_id in in_pwys:
+            if pwy_id not in dict_pwy_rxns:
+                dict_pwy_rxns[pwy_id] = set([rlt.id_in for rlt in padmetRef.dicOfRelationOut.get(pwy_id,[]) if rlt.type == "is_in_pathway"])
 
+    spontaneous_index = {'spontaneous_reactions': all_spontaneous_rxns,
+                         'reaction_pathways': dict_rxn_pwys,
+                         'pathway_reactions': dict_pwy_rxns}
 
-def add_spontaneous_reactions(padmet_path, padmet_ref_path, output_padmet_path, only_complete_pathways=True):
+    return spontaneous_index
+
+
+def add_spontaneous_reactions(padmet_path, padmet_ref_path, output_padmet_path, only_complete_pathways=True, spontaneous_index=None):
     number_spontaneous_reactions = 0
 
     padmetSpec = PadmetSpec(padmet_path)
-    padmetRef = PadmetRef(padmet_ref_path)
+    padmetRef = load_padmet_ref(padmet_ref_path)
 
-    all_spontaneous_rxns = set([node.id for node in list(padmetRef.dicOfNode.values()) if node.type == "reaction" and "SPONTANEOUS" in node.misc])
+    if spontaneous_index is None:
+        spontaneous_index = create_spontaneous_index(padmetRef)
+    all_spontaneous_rxns = spontaneous_index['spontaneous_reactions']
+
+    # dicOfNode is updated by copyNode, so checking the reaction in it is the same as
+    # rebuilding the set of reactions of padmetSpec after each copy.
+    def is_reaction_in_spec(rxn_id):
+        return rxn_id in padmetSpec.dicOfNode and padmetSpec.dicOfNode[rxn_id].type == "reaction"
 
     for spontaneous_rxn_id in all_spontaneous_rxns:
-        in_pwys = set([rlt.id_out for rlt in padmetRef.dicOfRelationIn.get(spontaneous_rxn_id,None) if rlt.type == "is_in_pathway"])
+        in_pwys = spontaneous_index['reaction_pathways'][spontaneous_rxn_id]
         for pwy_id in in_pwys:
-            if pwy_id in padmetSpec.dicOfNode.keys():
-                padmet_ref_in_rxns = set([rlt.id_in for rlt in padmetRef.dicOfRelationOut.get(pwy_id,[]) if rlt.type == "is_in_pathway"])
+            if pwy_id in padmetSpec.dicOfNode:
+                padmet_ref_in_rxns = spontaneous_index['pathway_reactions'][pwy_id]
                 padmet_spec_in_rxns = set([rlt.id_in for rlt in padmetSpec.dicOfRelationOut.get(pwy_id,[]) if rlt.type == "is_in_pathway"])
 
                 if only_complete_pathways:
@@ -123,11 +172,11 @@ def add_spontaneous_reactions(padmet_path, padmet_ref_path, output_padmet_path,
                     if difference_rxns != set():
                         if difference_rxns.issubset(all_spontaneous_rxns):
                             for difference_rxn in difference_rxns:
-                                if difference_rxn not in set([node.id for node in list(padmetSpec.dicOfNode.values()) if node.type == "reaction"]):
+                                if not is_reaction_in_spec(difference_rxn):
                                     padmetSpec.copyNode(padmetRef, difference_rxn)
                                     number_spontaneous_reactions += 1
                 else:
-                    if spontaneous_rxn_id not in set([node.id for node in list(padmetSpec.dicOfNode.values()) if node.type == "reaction"]):
+                    if not is_reaction_in_spec(spontaneous_rxn_id):
                         padmetSpec.copyNode(padmetRef, spontaneous_rxn_id)
                         number_spontaneous_reactions += 1
 
@@ -144,11 +193,12 @@ def create_output(tmp_study_data):
     padmet_from_networks_path = tmp_study_data['padmet_from_networks_path']
     sbml_from_networks_path = tmp_study_data['sbml_from_networks_path']
     padmet_ref_path = tmp_study_data['database_path']
+    spontaneous_index = tmp_study_data['spontaneous_index']
 
     if not os.path.exists(padmet_from_networks_path + '/' + study_padmet + '.padmet'):
         if verbose:
             print('Create ' + study_padmet +' from ' + padmet_path + ' to ' + padmet_from_networks_path)
-        add_spontaneous_reactions(padmet_path, padmet_ref_path, padmet_from_networks_path + '/' + study_padmet + '.padmet')
+        add_spontaneous_reactions(padmet_path, padmet_ref_path, padmet_from_networks_path + '/' + study_padmet + '.padmet', spontaneous_index=spontaneous_index)
     else:
         print('There is already a padmet for ' + study_padmet + ' ' + padmet_from_networks_path + '.')
 
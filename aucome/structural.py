@@ -16,7 +16,7 @@ import time
 
 from padmet.utils.exploration import prot2genome
 
-from aucome.utils import parse_config_file
+from aucome.utils import get_run_context, get_workspace_inventory, StepTelemetry
 
 
 def command_help():
@@ -41,15 +41,20 @@ def run_structural(run_id, keep_tmp, nb_cpu_to_use, verbose):
     if verbose:
         print('--- Running structural check step ---')
     structural_start_time = time.time()
+    step_telemetry = StepTelemetry(run_id, 'structural')
 
-    config_data = parse_config_file(run_id)
-    database_path = config_data['database_path']
+    run_context = get_run_context(run_id)
+    database_path = run_context.database_path
 
-    prot2genome.fromAucome(run_id, nb_cpu_to_use, database_path, blastp=True, tblastn=True, exonerate=True, keep_tmp=keep_tmp, debug=False)
+    with step_telemetry.stage('prot2genome'):
+        prot2genome.fromAucome(run_id, nb_cpu_to_use, database_path, blastp=True, tblastn=True, exonerate=True, keep_tmp=keep_tmp, debug=False)
+    # prot2genome writes in several folders of the run.
+    get_workspace_inventory(run_id).refresh()
 
     structural_end_time = (time.time() - structural_start_time)
     integer_part, decimal_part = str(structural_end_time).split('.')
     structural_time = ".".join([integer_part, decimal_part[:3]])
 
     if verbose:
-        print("--- structural step done in: %ss ---" %structural_time)
\ No newline at end of file
+        print("--- structural step done in: %ss ---" %structural_time)
+    step_telemetry.write(verbose)
@@ -5,11 +5,85 @@ Some utils function.
 """
 
 import configparser
+import contextlib
+import csv
+import hashlib
+import importlib
+import json
 import os
+import pickle
+import resource
 import sys
+import time
 
+from multiprocessing import Pool
+from typing import NamedTuple
+import padmet
+from padmet.classes import PadmetRef
 
-def parse_config_file(run_id):
+import aucome
+
+# Padmet of reference already loaded in this process, k = path to the padmet, v = (size, mtime, PadmetRef).
+# As the Pool workers are forked, a padmet loaded by the main process before creating the Pool is shared with them.
+PADMET_REF_LOADED = {}
+# Configurations of the runs used by this process, k = absolute path of the run, v = RunContext.
+RUN_CONTEXTS = {}
+# Columns of the telemetry csv report.
+TELEMETRY_FIELDS = ['step', 'stage', 'task', 'status', 'start_time', 'wall_time', 'cpu_time', 'peak_rss_kb', 'rss_delta_kb',
+                    'lifetime_peak_rss_kb', 'lifetime_peak_children_rss_kb']
+# Peak resident memory of this process before each reset of the peak (see reset_peak_rss).
+PEAK_RSS_BEFORE_RESETS = []
+# Inventories of the runs used by this process, k = absolute path of the run, v = WorkspaceInventory.
+WORKSPACE_INVENTORIES = {}
+# Modules used by the tasks of the steps, imported by each worker of the aucome pool (see init_aucome_worker).
+WORKER_MODULES = ['Bio.SeqIO', 'padmet.classes', 'padmet.utils.connection.extract_orthofinder',
+                  'padmet.utils.connection.sbml_to_padmet', 'padmet.utils.connection.sbmlGenerator']
+
+
+class RunContext(NamedTuple):
+    """Configuration of a run (paths from config.txt), created once by run with get_run_context.
+
+    It is immutable and without instance dict, so it is cheap to send to the workers (or inherited by the forked workers).
+    """
+    run_id: str
+    database_path: str
+    studied_organisms_path: str
+    orthology_based_path: str
+    orthofinder_wd_path: str
+    orthofinder_sbml_path: str
+    orthofinder_padmet_path: str
+    orthofinder_filtered_path: str
+    annotation_based_path: str
+    pgdb_from_annotation_path: str
+    padmet_from_annotation_path: str
+    sbml_from_annotation_path: str
+    log_path: str
+    analysis_path: str
+    analysis_group_file_path: str
+    cache_path: str
+    networks_path: str
+    padmet_from_networks_path: str
+    sbml_from_networks_path: str
+    structural_path: str
+    structural_specifics_reactions_path: str
+    structural_blast_results_path: str
+    structural_reactions_to_add_path: str
+    structural_padmets_path: str
+    structural_blast_results_analysis_path: str
+    structural_blast_results_tmp_path: str
+    structural_blast_results_reactions_sequences_path: str
+    orthofinder_bin_path: str
+    study_from_annot_prefix: str
+
+
+def read_run_context(run_id):
+    """Read the config.txt of a run.
+
+    Args:
+        run_id (str): path to the run
+    Returns:
+        RunContext: configuration of the run
+    """
     config_file_path = "{0}/config.txt".format(run_id)
 
     if not os.path.exists(config_file_path):
@@ -18,45 +92,610 @@ def parse_config_file(run_id):
     config = configparser.ConfigParser()
     config.read(config_file_path)
 
-    #DATABASE_PATHS
-    database_path = config.get('DATABASE_PATHS','database_ref_path')
-    #PATHS_IN_RUN
-    studied_organisms_path = "{0}/{1}".format(run_id, config.get('PATHS_IN_RUN','studied_organisms_path'))
-    orthology_based_path = "{0}/{1}".format(run_id, config.get('PATHS_IN_RUN','orthology_based_path'))
-    orthofinder_wd_path = "{0}/{1}".format(run_id, config.get('PATHS_IN_RUN','orthofinder_wd_path'))
-    orthofinder_sbml_path = "{0}/{1}".format(run_id, config.get('PATHS_IN_RUN','orthofinder_sbml_path'))
-    orthofinder_padmet_path = "{0}/{1}".format(run_id, config.get('PATHS_IN_RUN','orthofinder_padmet_path'))
-    orthofinder_filtered_path = "{0}/{1}".format(run_id, config.get('PATHS_IN_RUN','orthofinder_filtered_path'))
-    annotation_based_path = "{0}/{1}".format(run_id, config.get('PATHS_IN_RUN','annotation_based_path'))
-    pgdb_from_annotation_path = "{0}/{1}".format(run_id, config.get('PATHS_IN_RUN','pgdb_from_annotation_path'))
-    padmet_from_annotation_path = "{0}/{1}".format(run_id, config.get('PATHS_IN_RUN','padmet_from_annotation_path'))
-    sbml_from_annotation_path = "{0}/{1}".format(run_id, config.get('PATHS_IN_RUN','sbml_from_annotation_path'))
-    log_path = "{0}/{1}".format(run_id, config.get('PATHS_IN_RUN','log_path'))
-    analysis_path = "{0}/{1}".format(run_id, config.get('PATHS_IN_RUN','analysis_path'))
-    analysis_group_file_path = "{0}/{1}".format(run_id, config.get('PATHS_IN_RUN','analysis_group_file_path'))
-    networks_path = "{0}/{1}".format(run_id, config.get('PATHS_IN_RUN','networks_path'))
-    padmet_from_networks_path = "{0}/{1}".format(run_id, config.get('PATHS_IN_RUN','padmet_from_networks_path'))
-    sbml_from_networks_path = "{0}/{1}".format(run_id, config.get('PATHS_IN_RUN','sbml_from_networks_path'))
-    structural_path = "{0}/{1}".format(run_id, config.get('PATHS_IN_RUN','structural_path'))
-    structural_padmets_path = "{0}/{1}".format(run_id, config.get('PATHS_IN_RUN','structural_padmets_path'))
-
-    #TOOL_PATHS
-    orthofinder_bin_path = config.get('TOOL_PATHS','orthofinder_bin_path')
-    #VAR
-    study_from_annot_prefix = config.get('VAR','study_from_annot_prefix')
-
-    config_data = {'database_path': database_path,
-                    'studied_organisms_path': studied_organisms_path,
-                    'orthology_based_path': orthology_based_path, 'orthofinder_wd_path': orthofinder_wd_path,
-                    'orthofinder_sbml_path': orthofinder_sbml_path, 'orthofinder_padmet_path': orthofinder_padmet_path,
-                    'orthofinder_filtered_path': orthofinder_filtered_path,
-                    'annotation_based_path': annotation_based_path, 'pgdb_from_annotation_path': pgdb_from_annotation_path,
-                    'padmet_from_annotation_path': padmet_from_annotation_path, 'sbml_from_annotation_path': sbml_from_annotation_path,
-                    'sbml_from_annotation_path': sbml_from_annotation_path, 'log_path': log_path,
-                    'networks_path': networks_path, 'orthofinder_bin_path': orthofinder_bin_path,
-                    'structural_path': structural_path, 'structural_padmets_path': structural_padmets_path,
-                    'study_from_annot_prefix': study_from_annot_prefix, 'analysis_path': analysis_path,
-                    'padmet_from_networks_path': padmet_from_networks_path, 'sbml_from_networks_path': sbml_from_networks_path,
-                    'analysis_group_file_path': analysis_group_file_path}
+    def run_path(option, fallback=None):
+        return "{0}/{1}".format(run_id, config.get('PATHS_IN_RUN', option, fallback=fallback))
+
+    # Structural paths of a config.txt created by an older version of aucome.
+    structural_path = config.get('PATHS_IN_RUN', 'structural_path')
+    structural_blast_results_path = config.get('PATHS_IN_RUN', 'structural_blast_results_path', fallback=structural_path + '/1_blast_results')
+
+    run_context = RunContext(run_id=run_id,
+                    #DATABASE_PATHS
+                    database_path=config.get('DATABASE_PATHS','database_ref_path'),
+                    #PATHS_IN_RUN
+                    studied_organisms_path=run_path('studied_organisms_path'),
+                    orthology_based_path=run_path('orthology_based_path'),
+                    orthofinder_wd_path=run_path('orthofinder_wd_path'),
+                    orthofinder_sbml_path=run_path('orthofinder_sbml_path'),
+                    orthofinder_padmet_path=run_path('orthofinder_padmet_path'),
+                    orthofinder_filtered_path=run_path('orthofinder_filtered_path'),
+                    annotation_based_path=run_path('annotation_based_path'),
+                    pgdb_from_annotation_path=run_path('pgdb_from_annotation_path'),
+                    padmet_from_annotation_path=run_path('padmet_from_annotation_path'),
+                    sbml_from_annotation_path=run_path('sbml_from_annotation_path'),
+                    log_path=run_path('log_path'),
+                    analysis_path=run_path('analysis_path'),
+                    analysis_group_file_path=run_path('analysis_group_file_path'),
+                    cache_path=run_path('cache_path', '/cache'),
+                    networks_path=run_path('networks_path'),
+                    padmet_from_networks_path=run_path('padmet_from_networks_path'),
+                    sbml_from_networks_path=run_path('sbml_from_networks_path'),
+                    structural_path=run_path('structural_path'),
+                    structural_specifics_reactions_path=run_path('structural_specifics_reactions_path', structural_path + '/0_specifics_reactions'),
+                    structural_blast_results_path=run_path('structural_blast_results_path', structural_blast_results_path),
+                    structural_reactions_to_add_path=run_path('structural_reactions_to_add_path', structural_path + '/2_reactions_to_add'),
+                    structural_padmets_path=run_path('structural_padmets_path'),
+                    structural_blast_results_analysis_path=run_path('structural_blast_results_analysis_path', structural_blast_results_path + '/analysis'),
+                    structural_blast_results_tmp_path=run_path('structural_blast_results_tmp_path', structural_blast_results_path + '/tmp'),
+                    structural_blast_results_reactions_sequences_path=run_path('structural_blast_results_reactions_sequences_path', structural_blast_results_path + '/reactions_sequences'),
+                    #TOOL_PATHS
+                    orthofinder_bin_path=config.get('TOOL_PATHS','orthofinder_bin_path'),
+                    #VAR
+                    study_from_annot_prefix=config.get('VAR','study_from_annot_prefix'))
+
+    return run_context
+
+
+def get_run_context(run_id):
+    """Get the configuration of a run, config.txt is read once by process and run.
+    The steps of the workflow and the workers forked after share the same RunContext.
 
+    Args:
+        run_id (str): path to the run
+    Returns:
+        RunContext: configuration of the run
+    """
+    run_path = os.path.abspath(run_id)
+    if run_path not in RUN_CONTEXTS:
+        RUN_CONTEXTS[run_path] = read_run_context(run_id)
+    return RUN_CONTEXTS[run_path]
+
+
+def parse_config_file(run_id):
+    """Get the configuration of a run as a dict (see get_run_context).
+
+    Args:
+        run_id (str): path to the run
+    Returns:
+        dict: k = name of the path, v = path
+    """
+    config_data = dict(get_run_context(run_id)._asdict())
+    del config_data['run_id']
     return config_data
+
+
+class WorkspaceInventory:
+    """Inventory of the files of a run.
+
+    Each folder is listed once (with os.scandir) when it is first needed and the listing is kept in memory,
+    instead of checking each file of each organism with os.path.isfile or os.path.isdir.
+    The steps record the files they create (add_files) and drop the listing of the folders
+    modified by other tools (refresh).
+    """
+
+    def __init__(self, run_context):
+        self.run_context = run_context
+        # k = folder path, v = dict with k = entry name, v = 'dir', 'file' or 'other'.
+        self.folders = {}
+
+    def list_folder(self, folder_path):
+        """List a folder (or use its listing in memory).
+
+        Args:
+            folder_path (str): path to the folder
+        Returns:
+            dict: k = entry name, v = 'dir', 'file' or 'other' (empty if the folder does not exist)
+        """
+        folder_path = os.path.normpath(folder_path)
+        if folder_path not in self.folders:
+            entries = {}
+            try:
+                with os.scandir(folder_path) as folder_entries:
+                    for entry in folder_entries:
+                        if entry.is_dir():
+                            entries[entry.name] = 'dir'
+                        elif entry.is_file():
+                            entries[entry.name] = 'file'
+                        else:
+                            entries[entry.name] = 'other'
+            except (FileNotFoundError, NotADirectoryError):
+                pass
+            self.folders[folder_path] = entries
+        return self.folders[folder_path]
+
+    def entry_type(self, path):
+        folder_path, entry_name = os.path.split(os.path.normpath(path))
+        return self.list_folder(folder_path).get(entry_name)
+
+    def is_file(self, path):
+        return self.entry_type(path) == 'file'
+
+    def is_dir(self, path):
+        return self.entry_type(path) == 'dir'
+
+    def organisms(self):
+        """Names of the studied organisms (folders in studied_organisms_path)."""
+        return set([entry_name for entry_name, entry_type in self.list_folder(self.run_context.studied_organisms_path).items()
+                    if entry_type == 'dir'])
+
+    def organism_files(self, study_name):
+        """Find the files of an organism.
+
+        Args:
+            study_name (str): name of the organism
+        Returns:
+            dict: k = 'gbk', 'faa', 'pgdb', 'padmet' or 'sbml', v = path to the file (or folder for the pgdb), '' if it does not exist
+        """
+        studied_organisms_path = self.run_context.studied_organisms_path
+        study_from_annot_prefix = self.run_context.study_from_annot_prefix
+        organism_paths = {'gbk': "{0}/{1}/{1}.gbk".format(studied_organisms_path, study_name),
+                          'faa': "{0}/{1}/{1}.faa".format(studied_organisms_path, study_name),
+                          'pgdb': "{0}/{1}".format(self.run_context.pgdb_from_annotation_path, study_name),
+                          'padmet': "{0}/{1}{2}.padmet".format(self.run_context.padmet_from_annotation_path, study_from_annot_prefix, study_name),
+                          'sbml': "{0}/{1}{2}.sbml".format(self.run_context.sbml_from_annotation_path, study_from_annot_prefix, study_name)}
+        organism_files = {}
+        for file_type, file_path in organism_paths.items():
+            file_exists = self.is_dir(file_path) if file_type == 'pgdb' else self.is_file(file_path)
+            organism_files[file_type] = file_path if file_exists else ''
+        return organism_files
+
+    def add_files(self, file_paths):
+        """Record files created by a step (in the listings already in memory).
+
+        Args:
+            file_paths (list): paths to the created files
+        """
+        for file_path in file_paths:
+            folder_path, entry_name = os.path.split(os.path.normpath(file_path))
+            if folder_path in self.folders:
+                self.folders[folder_path][entry_name] = 'file'
+
+    def refresh(self, folder_path=None):
+        """Drop the listing of a folder (and its subfolders), or of all the folders, so it will be listed again.
+
+        Args:
+            folder_path (str): path to the folder modified outside of the inventory, None for all the folders
+        """
+        if folder_path is None:
+            self.folders = {}
+            return
+        folder_path = os.path.normpath(folder_path)
+        for listed_folder in list(self.folders):
+            if listed_folder == folder_path or listed_folder.startswith(folder_path + os.sep):
+                del self.folders[listed_folder]
+
+
+def get_workspace_inventory(run_id):
+    """Get the inventory of a run, it is created once by process (so once by command) and shared by the steps.
+
+    Args:
+        run_id (str): path to the run
+    Returns:
+        WorkspaceInventory: inventory of the run
+    """
+    run_path = os.path.abspath(run_id)
+    if run_path not in WORKSPACE_INVENTORIES:
+        WORKSPACE_INVENTORIES[run_path] = WorkspaceInventory(get_run_context(run_id))
+    return WORKSPACE_INVENTORIES[run_path]
+
+
+def file_hash(file_path):
+    """Compute the sha256 of a file.
+
+    Args:
+        file_path (str): path to the file
+    Returns:
+        str: hexadecimal sha256 of the file
+    """
+    file_sha = hashlib.sha256()
+    with open(file_path, 'rb') as input_file:
+        for block in iter(lambda: input_file.read(1024*1024), b''):
+            file_sha.update(block)
+    return file_sha.hexdigest()
+
+
+def load_padmet_ref(padmet_ref_path, verbose=None, cache_path=None):
+    """Load a padmet of reference (like MetaCyc) only once.
+
+    The PadmetRef is kept in memory for the process (and the workers forked after).
+    If cache_path is given (cache folder of the run), a binary snapshot of the PadmetRef is also written in it.
+    The snapshot is used if it was created with the same versions of padmet and aucome and if the padmet
+    has the same path, size and modification time or the same sha256 as the padmet used to create it.
+
+    The same PadmetRef is returned to all the callers of the process. padmet.copyNode and padmet._copyNodeExtend
+    insert the Node and Relation objects of the PadmetRef in the padmet by reference: the nodes and relations
+    copied from the PadmetRef must not be modified (copy them before editing their misc).
+
+    Args:
+        padmet_ref_path (str): path to the padmet of reference
+        verbose (boolean): verbose
+        cache_path (str): folder of the snapshot, None to only keep the PadmetRef in memory
+    Returns:
+        padmet.classes.PadmetRef: padmet of reference
+    """
+    padmet_ref_path = os.path.abspath(padmet_ref_path)
+    padmet_ref_stat = os.stat(padmet_ref_path)
+    padmet_ref_key = (padmet_ref_stat.st_size, padmet_ref_stat.st_mtime_ns)
+
+    if padmet_ref_path in PADMET_REF_LOADED:
+        if PADMET_REF_LOADED[padmet_ref_path][:2] == padmet_ref_key:
+            return PADMET_REF_LOADED[padmet_ref_path][2]
+
+    # The classes of the snapshot must be the ones of the installed padmet.
+    snapshot_versions = (padmet.__version__, aucome.__version__)
+    snapshot_path = None
+    if cache_path:
+        path_sha = hashlib.sha256(padmet_ref_path.encode('utf-8')).hexdigest()[:16]
+        snapshot_name = os.path.splitext(os.path.basename(padmet_ref_path))[0] + '_' + path_sha + '.pkl'
+        snapshot_path = os.path.join(cache_path, snapshot_name)
+
+    padmetRef = None
+    padmet_ref_sha = None
+    if snapshot_path and os.path.exists(snapshot_path):
+        try:
+            with open(snapshot_path, 'rb') as snapshot_file:
+                snapshot_info = pickle.load(snapshot_file)
+                if (snapshot_info['padmet_version'], snapshot_info['aucome_version']) != snapshot_versions:
+                    valid_snapshot = False
+                elif (snapshot_info['size'], snapshot_info['mtime']) == padmet_ref_key:
+                    valid_snapshot = True
+                elif snapshot_info['size'] == padmet_ref_stat.st_size:
+                    padmet_ref_sha = file_hash(padmet_ref_path)
+                    valid_snapshot = padmet_ref_sha == snapshot_info['sha256']
+                else:
+                    valid_snapshot = False
+                if valid_snapshot:
+                    padmetRef = pickle.load(snapshot_file)
+                    if verbose:
+                        print('Load padmet of reference from snapshot ' + snapshot_path)
+        except (EOFError, KeyError, AttributeError, ImportError, pickle.UnpicklingError):
+            padmetRef = None
+
+    if padmetRef is None:
+        if verbose:
+            print('Load padmet of reference ' + padmet_ref_path)
+        padmetRef = PadmetRef(padmet_ref_path)
+        if snapshot_path:
+            if padmet_ref_sha is None:
+                padmet_ref_sha = file_hash(padmet_ref_path)
+            snapshot_info = {'path': padmet_ref_path, 'size': padmet_ref_stat.st_size,
+                             'mtime': padmet_ref_stat.st_mtime_ns, 'sha256': padmet_ref_sha,
+                             'padmet_version': snapshot_versions[0], 'aucome_version': snapshot_versions[1]}
+            # Write in a temporary file then rename it, so other processes never read a partial snapshot.
+            tmp_snapshot_path = snapshot_path + '.' + str(os.getpid()) + '.tmp'
+            try:
+                os.makedirs(cache_path, exist_ok=True)
+                with open(tmp_snapshot_path, 'wb') as snapshot_file:
+                    pickle.dump(snapshot_info, snapshot_file, protocol=pickle.HIGHEST_PROTOCOL)
+                    pickle.dump(padmetRef, snapshot_file, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp_snapshot_path, snapshot_path)
+            except OSError:
+                if verbose:
+                    print('Unable to write padmet of reference snapshot in ' + cache_path)
+
+    PADMET_REF_LOADED[padmet_ref_path] = (padmet_ref_stat.st_size, padmet_ref_stat.st_mtime_ns, padmetRef)
+
+    return padmetRef
+
+
+class RelationIndex:
+    """Index of the relations of a loaded padmet by (id_in, id_out, type).
+
+    The index is built once for the padmet, then a relation is found, edited or deleted without
+    searching the lists of padmet.dicOfRelationIn and padmet.dicOfRelationOut.
+    The deleted relations are only marked and counted by node, they are removed from the lists
+    of their nodes all at once (flush) before writing the padmet.
+    """
+
+    def __init__(self, padmet, relation_types=None):
+        """
+        Args:
+            padmet (padmet.classes.PadmetSpec): padmet to index
+            relation_types (list): types of the relations to index, None for all the relations
+        """
+        self.padmet = padmet
+        # k = (id_in, id_out, type), v = first relation found in dicOfRelationIn (as a search in the list would return).
+        self.relations = {}
+        # id() of the relations deleted but still in the lists of their nodes.
+        self.deleted_relations = set()
+        # k = node ID, v = number of relations deleted but still in its list of dicOfRelationIn/dicOfRelationOut.
+        self.nb_deleted_in = {}
+        self.nb_deleted_out = {}
+        for relations in padmet.dicOfRelationIn.values():
+            for rlt in relations:
+                if relation_types is None or rlt.type in relation_types:
+                    self.relations.setdefault((rlt.id_in, rlt.id_out, rlt.type), rlt)
+
+    def get(self, id_in, id_out, relation_type):
+        """Find a relation.
+
+        Args:
+            id_in (str): ID of the node in
+            id_out (str): ID of the node out
+            relation_type (str): type of the relation
+        Returns:
+            padmet.classes.Relation: the relation (it can be edited in place), None if it does not exist
+        """
+        return self.relations.get((id_in, id_out, relation_type))
+
+    def delete(self, relation):
+        """Delete a relation from the padmet (as padmet._delRelation).
+
+        Args:
+            relation (padmet.classes.Relation): relation to delete
+        """
+        if id(relation) in self.deleted_relations:
+            return
+        relation_key = (relation.id_in, relation.id_out, relation.type)
+        if self.relations.get(relation_key) is relation:
+            del self.relations[relation_key]
+        self.deleted_relations.add(id(relation))
+        self.nb_deleted_in[relation.id_in] = self.nb_deleted_in.get(relation.id_in, 0) + 1
+        self.nb_deleted_out[relation.id_out] = self.nb_deleted_out.get(relation.id_out, 0) + 1
+
+    def is_linked(self, node_id):
+        """Check if a node still has relations (not deleted).
+
+        Args:
+            node_id (str): ID of the node
+        Returns:
+            bool: True if the node is in or out of at least one relation
+        """
+        nb_relations_in = len(self.padmet.dicOfRelationIn.get(node_id, [])) - self.nb_deleted_in.get(node_id, 0)
+        nb_relations_out = len(self.padmet.dicOfRelationOut.get(node_id, [])) - self.nb_deleted_out.get(node_id, 0)
+        return nb_relations_in > 0 or nb_relations_out > 0
+
+    def delete_node(self, node_id):
+        """Delete a node and its relations from the padmet (as padmet.delNode).
+        The nodes linked only to this node are also deleted.
+
+        Args:
+            node_id (str): ID of the node to delete
+        Returns:
+            bool: True if node successfully deleted, False if node not in padmet.dicOfNode
+        """
+        padmet = self.padmet
+        try:
+            padmet.dicOfNode.pop(node_id)
+        except KeyError:
+            print("The id %s doesnt exist. Unable to delete" % node_id)
+            return False
+
+        for rlt in [rlt for rlt in padmet.dicOfRelationIn.get(node_id, []) if id(rlt) not in self.deleted_relations]:
+            self.delete(rlt)
+            if not self.is_linked(rlt.id_out):
+                self.delete_node(rlt.id_out)
+        for rlt in [rlt for rlt in padmet.dicOfRelationOut.get(node_id, []) if id(rlt) not in self.deleted_relations]:
+            self.delete(rlt)
+            if not self.is_linked(rlt.id_in):
+                self.delete_node(rlt.id_in)
+        return True
+
+    def flush(self):
+        """Remove the deleted relations from the lists of padmet.dicOfRelationIn and padmet.dicOfRelationOut.
+        """
+        for dicOfRelation, nb_deleted in [(self.padmet.dicOfRelationIn, self.nb_deleted_in), (self.padmet.dicOfRelationOut, self.nb_deleted_out)]:
+            for node_id in nb_deleted:
+                if node_id in dicOfRelation:
+                    relations = [rlt for rlt in dicOfRelation[node_id] if id(rlt) not in self.deleted_relations]
+                    if relations:
+                        dicOfRelation[node_id] = relations
+                    else:
+                        dicOfRelation.pop(node_id)
+        self.deleted_relations = set()
+        self.nb_deleted_in = {}
+        self.nb_deleted_out = {}
+
+
+def init_aucome_worker():
+    """Initialize a worker of the aucome pool by importing the modules used by the tasks of the steps,
+    so the first task of each step does not pay for them. The modules already imported by the main process
+    (inherited by forked workers) are not imported again.
+    """
+    for module_name in WORKER_MODULES:
+        importlib.import_module(module_name)
+
+
+def create_aucome_pool(nb_cpu_to_use):
+    """Create the pool of workers used by the steps.
+    The workflow creates one pool for all its steps, the workers keep their caches (like the padmet of reference) between the steps.
+
+    Args:
+        nb_cpu_to_use (int): number of workers
+    Returns:
+        multiprocessing.Pool: pool of workers
+    """
+    return Pool(nb_cpu_to_use, initializer=init_aucome_worker)
+
+
+def read_process_memory():
+    """Read the resident memory and its peak since the last reset (see reset_peak_rss) in /proc/self/status.
+
+    Returns:
+        dict: rss_kb (VmRSS) and peak_rss_kb (VmHWM), empty if /proc/self/status can not be read (not on Linux)
+    """
+    process_memory = {}
+    try:
+        with open('/proc/self/status', 'r') as status_file:
+            for line in status_file:
+                if line.startswith('VmRSS:'):
+                    process_memory['rss_kb'] = int(line.split()[1])
+                elif line.startswith('VmHWM:'):
+                    process_memory['peak_rss_kb'] = int(line.split()[1])
+    except OSError:
+        pass
+    return process_memory
+
+
+def reset_peak_rss():
+    """Reset the peak resident memory of the process (VmHWM) to its current resident memory, by writing 5 in /proc/self/clear_refs.
+    The peak before the reset is kept in PEAK_RSS_BEFORE_RESETS, so a measure containing other measures keeps its peak.
+
+    Returns:
+        bool: True if the peak has been reset
+    """
+    peak_rss_kb = read_process_memory().get('peak_rss_kb')
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs_file:
+            clear_refs_file.write('5')
+    except OSError:
+        return False
+    PEAK_RSS_BEFORE_RESETS.append(peak_rss_kb)
+    return True
+
+
+def resource_snapshot(reset_peak=False):
+    """Get the time, the CPU time and the memory of the process.
+    The CPU time and the peak memory of the subprocesses (OrthoFinder, Pathway Tools, ...) are counted when they are waited.
+
+    Args:
+        reset_peak (bool): reset the peak resident memory of the process, to measure the peak from this snapshot
+    Returns:
+        dict: wall (time since epoch), cpu (CPU time of the process and its waited subprocesses in seconds),
+            rss_kb and peak_rss_kb (resident memory of the process and its peak since the last reset, None if unknown),
+            peak_reset_index (position in PEAK_RSS_BEFORE_RESETS of the peak reset, None without reset),
+            lifetime_peak_rss_kb (peak resident memory since the start of the process),
+            lifetime_peak_children_rss_kb (peak resident memory of the biggest waited subprocess since the start of the process)
+    """
+    peak_reset_index = len(PEAK_RSS_BEFORE_RESETS) if reset_peak and reset_peak_rss() else None
+    process_memory = read_process_memory()
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {'wall': time.time(),
+            'cpu': self_usage.ru_utime + self_usage.ru_stime + children_usage.ru_utime + children_usage.ru_stime,
+            'rss_kb': process_memory.get('rss_kb'), 'peak_rss_kb': process_memory.get('peak_rss_kb'),
+            'peak_reset_index': peak_reset_index,
+            # On Linux, ru_maxrss is also reset by reset_peak_rss, the peaks before the resets are added.
+            'lifetime_peak_rss_kb': max([self_usage.ru_maxrss] + [peak for peak in PEAK_RSS_BEFORE_RESETS + [process_memory.get('peak_rss_kb')] if peak is not None]),
+            'lifetime_peak_children_rss_kb': children_usage.ru_maxrss}
+
+
+def telemetry_record(step_name, stage_name, task_name, start_snapshot, status='done'):
+    """Create the telemetry record of a stage started at start_snapshot.
+    The peak memory of the stage (peak_rss_kb) is only known if the peak has been reset by start_snapshot,
+    the lifetime peaks are the ones of the process since its start.
+
+    Args:
+        step_name (str): name of the step
+        stage_name (str): name of the stage in the step
+        task_name (str): organism (or group) processed by the stage, None for a stage on all the organisms
+        start_snapshot (dict): resource_snapshot at the beginning of the stage
+        status (str): done or failed
+    Returns:
+        dict: record with the TELEMETRY_FIELDS
+    """
+    end_snapshot = resource_snapshot()
+    peak_rss_kb = None
+    if start_snapshot['peak_reset_index'] is not None and end_snapshot['peak_rss_kb'] is not None:
+        peak_rss_kb = max([end_snapshot['peak_rss_kb']] + [peak for peak in PEAK_RSS_BEFORE_RESETS[start_snapshot['peak_reset_index']:] if peak is not None])
+    rss_delta_kb = None
+    if start_snapshot['rss_kb'] is not None and end_snapshot['rss_kb'] is not None:
+        rss_delta_kb = end_snapshot['rss_kb'] - start_snapshot['rss_kb']
+    return {'step': step_name, 'stage': stage_name, 'task': task_name, 'status': status,
+            'start_time': start_snapshot['wall'],
+            'wall_time': end_snapshot['wall'] - start_snapshot['wall'],
+            'cpu_time': end_snapshot['cpu'] - start_snapshot['cpu'],
+            'peak_rss_kb': peak_rss_kb,
+            'rss_delta_kb': rss_delta_kb,
+            'lifetime_peak_rss_kb': end_snapshot['lifetime_peak_rss_kb'],
+            'lifetime_peak_children_rss_kb': end_snapshot['lifetime_peak_children_rss_kb']}
+
+
+def run_measured_task(measured_task_data):
+    """Run a task in a worker of the pool and measure it (see StepTelemetry.map).
+    The peak memory of the worker is reset at the beginning of the task, so peak_rss_kb is the peak of the task.
+
+    Args:
+        measured_task_data (dict): function and args of the task, step, stage and task names
+    Returns:
+        tuple: result of the task, telemetry record of the task
+    """
+    start_snapshot = resource_snapshot(reset_peak=True)
+    task_result = measured_task_data['function'](*measured_task_data['args'])
+    return task_result, telemetry_record(measured_task_data['step'], measured_task_data['stage'], measured_task_data['task'], start_snapshot)
+
+
+class StepTelemetry:
+    """Timing and resource telemetry of a step, by stage and by organism task.
+
+    The report of the step is written in the logs folder of the run: telemetry.json (all the steps) and telemetry.csv (one row by record).
+    """
+
+    def __init__(self, run_id, step_name):
+        self.log_path = get_run_context(run_id).log_path
+        self.step_name = step_name
+        self.records = []
+        self.start_snapshot = resource_snapshot(reset_peak=True)
+
+    @contextlib.contextmanager
+    def stage(self, stage_name, task_name=None):
+        """Measure a stage running in the main process.
+        The record of the stage is added even if the stage fails, with the failed status.
+
+        Args:
+            stage_name (str): name of the stage
+            task_name (str): organism (or group) processed by the stage
+        """
+        start_snapshot = resource_snapshot(reset_peak=True)
+        status = 'failed'
+        try:
+            yield
+            status = 'done'
+        finally:
+            self.records.append(telemetry_record(self.step_name, stage_name, task_name, start_snapshot, status))
+
+    def map(self, aucome_pool, stage_name, task_function, task_args, task_names, chunksize=1):
+        """Run the tasks of a stage with the pool and measure each task in its worker.
+
+        Args:
+            aucome_pool (multiprocessing.Pool): pool of workers
+            stage_name (str): name of the stage
+            task_function (function): function of the tasks
+            task_args (list): arguments (list) of each task
+            task_names (list): organism processed by each task
+            chunksize (int): chunksize of the map
+        Returns:
+            list: results of the tasks
+        """
+        measured_task_datas = [{'function': task_function, 'args': args, 'step': self.step_name, 'stage': stage_name, 'task': task_name}
+                               for args, task_name in zip(task_args, task_names)]
+        task_results = []
+        with self.stage(stage_name):
+            for task_result, task_record in aucome_pool.map(run_measured_task, measured_task_datas, chunksize=chunksize):
+                task_results.append(task_result)
+                self.records.append(task_record)
+        return task_results
+
+    def write(self, verbose=None):
+        """Write the telemetry of the step in telemetry.json and telemetry.csv (replacing the previous telemetry of the step)."""
+        step_record = telemetry_record(self.step_name, 'total', None, self.start_snapshot)
+        telemetry_json_path = os.path.join(self.log_path, 'telemetry.json')
+        telemetry_csv_path = os.path.join(self.log_path, 'telemetry.csv')
+
+        telemetry = {'steps': {}}
+        if os.path.exists(telemetry_json_path):
+            try:
+                with open(telemetry_json_path, 'r') as telemetry_file:
+                    telemetry = json.load(telemetry_file)
+            except ValueError:
+                telemetry = {'steps': {}}
+        telemetry['steps'][self.step_name] = {'total': step_record, 'records': self.records}
+
+        os.makedirs(self.log_path, exist_ok=True)
+        tmp_telemetry_json_path = telemetry_json_path + '.' + str(os.getpid()) + '.tmp'
+        with open(tmp_telemetry_json_path, 'w') as telemetry_file:
+            json.dump(telemetry, telemetry_file, indent=4)
+        os.replace(tmp_telemetry_json_path, telemetry_json_path)
+
+        tmp_telemetry_csv_path = telemetry_csv_path + '.' + str(os.getpid()) + '.tmp'
+        with open(tmp_telemetry_csv_path, 'w') as telemetry_file:
+            # The records of a step written by a previous version of aucome can have other columns.
+            telemetry_writer = csv.DictWriter(telemetry_file, fieldnames=TELEMETRY_FIELDS, extrasaction='ignore')
+            telemetry_writer.writeheader()
+            for step_telemetry in telemetry['steps'].values():
+                telemetry_writer.writerows(step_telemetry['records'])
+                telemetry_writer.writerow(step_telemetry['total'])
+        os.replace(tmp_telemetry_csv_path, telemetry_csv_path)
+
+        if verbose:
+            print('Telemetry of the ' + self.step_name + ' step written in ' + telemetry_json_path)
@@ -2,7 +2,7 @@
 # -*- coding: utf-8 -*-
 """
 usage:
-    aucome workflow --run=ID [--sequence_search_prg=STR] [--keep-tmp] [--cpu=INT] [-v] [--vv] [--filtering] [--threshold=FLOAT] [--union] [--intersection]
+    aucome workflow --run=ID [--sequence_search_prg=STR] [--keep-tmp] [--cpu=INT] [-v] [--vv] [--filtering] [--threshold=FLOAT] [--union] [--intersection] [--orthology-sbml] [--resume] [--from-step=STR] [--until-step=STR]
 
 options:
     --run=ID    Pathname to the comparison workspace.
@@ -16,12 +16,52 @@ options:
     --threshold=FLOAT     Threshold of the filter to limit propagation to use with the --filtering argument.
     --union          Use the union filter between five threshold values [0.01, 0.05, 0.1, 0.15, 0.2] to limit propagation, to use with the --filtering argument.
     --intersection   Use the intersection filter between five threshold values [0.01, 0.05, 0.1, 0.15, 0.2] to limit propagation, to use with the --filtering argument.
+    --orthology-sbml    Also write the SBML files of the reactions propagated by orthology (in 1_sbml_orthology).
+    --resume    Use the workflow manifest (in logs) to skip the steps already done and rerun only the steps (and organisms) whose inputs or outputs changed, their outputs are deleted before.
+    --from-step=STR    First step of the workflow to run: check, reconstruction, orthology, structural or spontaneous.
+    --until-step=STR    Last step of the workflow to run: check, reconstruction, orthology, structural or spontaneous.
 """
 import aucome
+import datetime
 import docopt
+import filecmp
+import hashlib
+import json
+import os
+import shutil
 import sys
 import time
 
+from aucome.utils import get_run_context, load_padmet_ref, create_aucome_pool, get_workspace_inventory
+
+WORKFLOW_STEPS = ['check', 'reconstruction', 'orthology', 'structural', 'spontaneous']
+
+# For each step: folders (fields of the run context) read by the step, folders written by the step,
+# folders to clean before rerunning the step for stale organisms and if the organisms are processed independently.
+# input_suffixes limits the fingerprint of an input folder to its files with this suffix.
+WORKFLOW_STEP_DATA = {'check': {'inputs': ['studied_organisms_path'],
+                                'outputs': ['studied_organisms_path'],
+                                'to_clean': [], 'by_organism': True},
+                      'reconstruction': {'inputs': ['studied_organisms_path'],
+                                         'outputs': ['pgdb_from_annotation_path', 'padmet_from_annotation_path', 'sbml_from_annotation_path'],
+                                         'to_clean': ['pgdb_from_annotation_path', 'padmet_from_annotation_path', 'sbml_from_annotation_path'],
+                                         'by_organism': True},
+                      'orthology': {'inputs': ['studied_organisms_path', 'padmet_from_annotation_path', 'sbml_from_annotation_path', 'orthofinder_wd_path'],
+                                    'input_suffixes': {'orthofinder_wd_path': '.faa'},
+                                    'outputs': ['orthofinder_sbml_path', 'orthofinder_padmet_path', 'orthofinder_filtered_path'],
+                                    'to_clean': ['orthofinder_sbml_path', 'orthofinder_padmet_path', 'orthofinder_filtered_path'],
+                                    'by_organism': False},
+                      # prot2genome keeps its intermediate files (specific reactions, blast analysis, genome fasta), they are cleaned with its padmets.
+                      'structural': {'inputs': ['studied_organisms_path', 'padmet_from_annotation_path', 'orthofinder_padmet_path', 'orthofinder_filtered_path'],
+                                     'outputs': ['structural_specifics_reactions_path', 'structural_blast_results_analysis_path',
+                                                 'structural_blast_results_reactions_sequences_path', 'structural_reactions_to_add_path', 'structural_padmets_path'],
+                                     'to_clean': ['structural_specifics_reactions_path', 'structural_blast_results_analysis_path', 'structural_blast_results_tmp_path',
+                                                  'structural_blast_results_reactions_sequences_path', 'structural_reactions_to_add_path', 'structural_padmets_path'],
+                                     'by_organism': False},
+                      'spontaneous': {'inputs': ['padmet_from_annotation_path', 'orthofinder_padmet_path', 'orthofinder_filtered_path', 'structural_padmets_path'],
+                                      'outputs': ['padmet_from_networks_path', 'sbml_from_networks_path'],
+                                      'to_clean': ['padmet_from_networks_path', 'sbml_from_networks_path'], 'by_organism': True}}
+
 
 def command_help():
     print(docopt.docopt(__doc__))
@@ -39,6 +79,10 @@ def workflow_parse_args(command_args):
     threshold = args['--threshold']
     union = args['--union']
     intersection = args['--intersection']
+    orthology_sbml = args['--orthology-sbml']
+    resume = args['--resume']
+    from_step = args['--from-step']
+    until_step = args['--until-step']
     filtering_threshold_list = []
     
     if filtering:
@@ -58,7 +102,11 @@ def workflow_parse_args(command_args):
             sys.exit('--union must be used with --filtering.')
         if intersection:
             sys.exit('--intersection must be used with --filtering.')
-            
+
+    for step_name in [from_step, until_step]:
+        if step_name and step_name not in WORKFLOW_STEPS:
+            sys.exit(step_name + ' not a valid step: ' + ', '.join(WORKFLOW_STEPS) + '.')
+
     if cpu:
         nb_cpu_to_use = int(cpu)
     else:
@@ -67,23 +115,52 @@ def workflow_parse_args(command_args):
     if veryverbose and not verbose:
         verbose = veryverbose
 
-    run_workflow(run_id, nb_cpu_to_use, sequence_search_prg, filtering_threshold_list, union, intersection, keep_tmp, verbose, veryverbose)
+    run_workflow(run_id, nb_cpu_to_use, sequence_search_prg, filtering_threshold_list, union, intersection, keep_tmp, verbose, veryverbose,
+                 resume, from_step, until_step, orthology_sbml)
 
 
-def run_workflow(run_id, nb_cpu_to_use, sequence_search_prg, filtering_threshold_list, union, intersection, keep_tmp, verbose, veryverbose=None):
+def run_workflow(run_id, nb_cpu_to_use, sequence_search_prg, filtering_threshold_list, union, intersection, keep_tmp, verbose, veryverbose=None,
+                 resume=None, from_step=None, until_step=None, orthology_sbml=None):
     if verbose:
         print('--- Running workflow ---')
     workflow_start_time = time.time()
 
-    aucome.check.run_check(run_id, nb_cpu_to_use, verbose, veryverbose)
+    run_context = get_run_context(run_id)
+    manifest_path = os.path.join(run_context.log_path, 'workflow_manifest.json')
+    manifest = load_manifest(manifest_path)
+
+    first_step_index = WORKFLOW_STEPS.index(from_step) if from_step else 0
+    last_step_index = WORKFLOW_STEPS.index(until_step) if until_step else len(WORKFLOW_STEPS) - 1
+    if first_step_index > last_step_index:
+        sys.exit('--from-step ' + from_step + ' is after --until-step ' + until_step + '.')
 
-    aucome.reconstruction.run_reconstruction(run_id, nb_cpu_to_use, verbose, veryverbose)
+    step_parameters = {'check': {},
+                       'reconstruction': {},
+                       'orthology': {'sequence_search_prg': sequence_search_prg, 'filtering_threshold_list': filtering_threshold_list,
+                                     'union': union, 'intersection': intersection, 'sbml': orthology_sbml},
+                       'structural': {},
+                       'spontaneous': {}}
 
-    aucome.orthology.run_orthology(run_id, sequence_search_prg, nb_cpu_to_use, filtering_threshold_list, union, intersection, verbose, veryverbose)
+    step_functions = {'check': lambda aucome_pool: aucome.check.run_check(run_id, nb_cpu_to_use, verbose, veryverbose, aucome_pool),
+                      'reconstruction': lambda aucome_pool: aucome.reconstruction.run_reconstruction(run_id, nb_cpu_to_use, verbose, veryverbose, aucome_pool),
+                      'orthology': lambda aucome_pool: aucome.orthology.run_orthology(run_id, sequence_search_prg, nb_cpu_to_use, filtering_threshold_list, union, intersection, verbose, veryverbose, aucome_pool, orthology_sbml),
+                      'structural': lambda aucome_pool: aucome.structural.run_structural(run_id, keep_tmp, nb_cpu_to_use, verbose),
+                      'spontaneous': lambda aucome_pool: aucome.spontaneous.run_spontaneous(run_id, nb_cpu_to_use, verbose, veryverbose, aucome_pool)}
 
-    aucome.structural.run_structural(run_id, keep_tmp, nb_cpu_to_use, verbose)
+    workflow_steps = WORKFLOW_STEPS[first_step_index:last_step_index+1]
 
-    aucome.spontaneous.run_spontaneous(run_id, nb_cpu_to_use, verbose, veryverbose)
+    # Load the padmet of reference before creating the pool, so the forked workers share it.
+    if ('orthology' in workflow_steps or 'spontaneous' in workflow_steps) and os.path.exists(run_context.database_path):
+        load_padmet_ref(run_context.database_path, verbose, run_context.cache_path)
+
+    # One pool for all the steps: the workers are started once and keep their caches between the steps.
+    aucome_pool = create_aucome_pool(nb_cpu_to_use)
+    try:
+        run_workflow_steps(workflow_steps, step_functions, step_parameters, run_context, manifest_path, manifest, resume, verbose, aucome_pool,
+                           get_workspace_inventory(run_id))
+    finally:
+        aucome_pool.close()
+        aucome_pool.join()
 
     workflow_end_time = (time.time() - workflow_start_time)
     integer_part, decimal_part = str(workflow_end_time).split('.')
@@ -91,3 +168,289 @@ def run_workflow(run_id, nb_cpu_to_use, sequence_search_prg, filtering_threshold
 
     if verbose:
         print("--- workflow step done in: %ss ---" %workflow_time)
+
+
+def run_workflow_steps(workflow_steps, step_functions, step_parameters, run_context, manifest_path, manifest, resume, verbose, aucome_pool,
+                       workspace_inventory=None):
+    """Run the steps of the workflow and record them in the manifest.
+
+    Args:
+        workflow_steps (list): names of the steps to run
+        step_functions (dict): k = name of the step, v = function running the step with the pool
+        step_parameters (dict): k = name of the step, v = parameters of the step
+        run_context (aucome.utils.RunContext): configuration of the run
+        manifest_path (str): path to the manifest json file
+        manifest (dict): manifest of the workflow
+        resume (boolean): skip the steps already done
+        verbose (boolean): verbose
+        aucome_pool (multiprocessing.Pool): pool shared by the steps
+        workspace_inventory (aucome.utils.WorkspaceInventory): inventory of the run shared by the steps
+    """
+    for step_name in workflow_steps:
+        previous_step_record = manifest['steps'].get(step_name)
+        stale_organisms = None
+        if resume and previous_step_record is not None:
+            # The hashes are computed just before running the step, so a step rerun changes the inputs of the next steps.
+            step_hashes = compute_step_hashes(step_name, run_context, step_parameters[step_name])
+            stale_organisms = find_stale_organisms(previous_step_record, step_hashes)
+            if previous_step_record['status'] == 'done' and stale_organisms == set():
+                print('--- ' + step_name + ' step already done, skipping it ---')
+                continue
+            # The steps skip the outputs already existing, so the stale outputs are deleted to be recreated.
+            if stale_organisms is None or stale_organisms:
+                rerun_orthofinder = previous_step_record.get('parameters', {}).get('sequence_search_prg') != step_parameters[step_name].get('sequence_search_prg')
+                clean_stale_outputs(step_name, run_context, stale_organisms, verbose, workspace_inventory, rerun_orthofinder)
+
+        step_record = {'status': 'running', 'parameters': step_parameters[step_name],
+                       'start_time': datetime.datetime.now().isoformat()}
+        # The hashes of the outputs kept are recorded until the end of the step, so the outputs of the organisms
+        # changed by an interrupted step are deleted by the next resume.
+        if stale_organisms is not None and 'global' in previous_step_record:
+            step_record['global'] = previous_step_record['global']
+            step_record['organisms'] = previous_step_record['organisms']
+        manifest['steps'][step_name] = step_record
+        write_manifest(manifest_path, manifest)
+
+        step_start_time = time.time()
+        try:
+            step_functions[step_name](aucome_pool)
+        except BaseException:
+            step_record['status'] = 'failed'
+            step_record['end_time'] = datetime.datetime.now().isoformat()
+            step_record['duration'] = time.time() - step_start_time
+            write_manifest(manifest_path, manifest)
+            raise
+
+        step_hashes = compute_step_hashes(step_name, run_context, step_parameters[step_name])
+        step_record['status'] = 'done'
+        step_record['end_time'] = datetime.datetime.now().isoformat()
+        step_record['duration'] = time.time() - step_start_time
+        step_record['global'] = step_hashes['global']
+        step_record['organisms'] = step_hashes['organisms']
+        write_manifest(manifest_path, manifest)
+
+
+def load_manifest(manifest_path):
+    """Load the workflow manifest.
+
+    Args:
+        manifest_path (str): path to the manifest json file
+    Returns:
+        dict: manifest with a record for each step already launched
+    """
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as manifest_file:
+            return json.load(manifest_file)
+    return {'steps': {}}
+
+
+def write_manifest(manifest_path, manifest):
+    """Write the workflow manifest, in a temporary file renamed after to never leave a partial manifest.
+
+    Args:
+        manifest_path (str): path to the manifest json file
+        manifest (dict): manifest to write
+    """
+    tmp_manifest_path = manifest_path + '.tmp'
+    with open(tmp_manifest_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=4, sort_keys=True)
+    os.replace(tmp_manifest_path, manifest_path)
+
+
+def organism_of_entry(entry_name, organisms, study_from_annot_prefix):
+    """Find the organism of a file or a folder in a folder of the run.
+
+    Args:
+        entry_name (str): name of the file or folder (like output_pathwaytools_org.padmet)
+        organisms (set): names of the studied organisms
+        study_from_annot_prefix (str): prefix of the files created from the annotation
+    Returns:
+        str: name of the organism or '' if the file is not linked to an organism
+    """
+    if entry_name in organisms:
+        return entry_name
+    entry_organism = os.path.splitext(entry_name)[0]
+    if entry_organism.startswith(study_from_annot_prefix):
+        entry_organism = entry_organism[len(study_from_annot_prefix):]
+    if entry_organism in organisms:
+        return entry_organism
+    return ''
+
+
+def folder_fingerprints(folder_path, organisms, study_from_annot_prefix, suffix=None):
+    """Compute a fingerprint of the files of a folder by organism, using the relative path, size and modification time of the files.
+
+    Args:
+        folder_path (str): path to the folder
+        organisms (set): names of the studied organisms
+        study_from_annot_prefix (str): prefix of the files created from the annotation
+        suffix (str): only use the files of the folder (not of its subfolders) ending with this suffix, None for all the files
+    Returns:
+        dict: k = organism name ('' for files not linked to an organism), v = list of (relative path, size, mtime)
+    """
+    dict_fingerprints = {}
+    if not os.path.isdir(folder_path):
+        return dict_fingerprints
+    for entry_name in sorted(os.listdir(folder_path)):
+        entry_path = os.path.join(folder_path, entry_name)
+        if suffix and (not entry_name.endswith(suffix) or not os.path.isfile(entry_path)):
+            continue
+        entry_organism = organism_of_entry(entry_name, organisms, study_from_annot_prefix)
+        if entry_organism not in dict_fingerprints:
+            dict_fingerprints[entry_organism] = []
+        if os.path.isdir(entry_path):
+            for _path, _folders, _files in os.walk(entry_path):
+                _folders.sort()
+                for _file in sorted(_files):
+                    file_path = os.path.join(_path, _file)
+                    file_stat = os.stat(file_path)
+                    dict_fingerprints[entry_organism].append((os.path.relpath(file_path, folder_path), file_stat.st_size, file_stat.st_mtime_ns))
+        else:
+            file_stat = os.stat(entry_path)
+            dict_fingerprints[entry_organism].append((entry_name, file_stat.st_size, file_stat.st_mtime_ns))
+    return dict_fingerprints
+
+
+def compute_step_hashes(step_name, run_context, parameters):
+    """Compute the hashes of the inputs and outputs of a step, for each organism and for the files not linked to an organism.
+
+    Args:
+        step_name (str): name of the step
+        run_context (aucome.utils.RunContext): configuration of the run
+        parameters (dict): parameters of the step
+    Returns:
+        dict: {'global': {'input_hash': str, 'output_hash': str}, 'organisms': {organism: {'input_hash': str, 'output_hash': str}}}
+    """
+    organisms = set(next(os.walk(run_context.studied_organisms_path))[1])
+    step_data = WORKFLOW_STEP_DATA[step_name]
+
+    global_input = [parameters]
+    if step_name != 'check':
+        database_stat = os.stat(run_context.database_path) if os.path.exists(run_context.database_path) else None
+        global_input.append((run_context.database_path, database_stat.st_size if database_stat else None, database_stat.st_mtime_ns if database_stat else None))
+
+    dict_data = {'global': {'input': global_input, 'output': []}}
+    for organism in organisms:
+        dict_data[organism] = {'input': [], 'output': []}
+    for data_type in ['input', 'output']:
+        for folder_key in step_data[data_type + 's']:
+            suffix = step_data.get(data_type + '_suffixes', {}).get(folder_key)
+            for entry_organism, fingerprints in folder_fingerprints(getattr(run_context, folder_key), organisms, run_context.study_from_annot_prefix, suffix).items():
+                dict_data[entry_organism if entry_organism else 'global'][data_type].append((folder_key, fingerprints))
+
+    step_hashes = {'organisms': {}}
+    for data_name, data in dict_data.items():
+        data_hashes = {data_type + '_hash': hashlib.sha256(json.dumps(data[data_type], sort_keys=True).encode('utf-8')).hexdigest()
+                       for data_type in ['input', 'output']}
+        if data_name == 'global':
+            step_hashes['global'] = data_hashes
+        else:
+            step_hashes['organisms'][data_name] = data_hashes
+
+    return step_hashes
+
+
+def find_stale_organisms(step_record, step_hashes):
+    """Compare the hashes recorded in the manifest with the current hashes of a step.
+
+    Args:
+        step_record (dict): record of the step in the manifest (None if the step has never been launched)
+        step_hashes (dict): current hashes of the step (from compute_step_hashes)
+    Returns:
+        set: organisms with changed inputs or outputs or without recorded hashes (organisms not reached by an interrupted step),
+            None if all the outputs of the step are stale: no hashes were recorded, files shared by all the organisms changed
+            (like the parameters of the step or the padmet of reference) or organisms were removed
+    """
+    if step_record is None or 'global' not in step_record:
+        return None
+    if step_record['global'] != step_hashes['global']:
+        return None
+    stale_organisms = set()
+    for organism, organism_hashes in step_hashes['organisms'].items():
+        if step_record['organisms'].get(organism) != organism_hashes:
+            stale_organisms.add(organism)
+    # Removed organisms change the results of the steps comparing organisms.
+    if set(step_record['organisms']) - set(step_hashes['organisms']):
+        return None
+    return stale_organisms
+
+
+def clean_stale_outputs(step_name, run_context, stale_organisms, verbose, workspace_inventory=None, rerun_orthofinder=False):
+    """Delete the outputs of the stale organisms, so the step will recreate them.
+    If the step compares organisms or if all the organisms are stale, all the outputs are deleted.
+
+    Args:
+        step_name (str): name of the step
+        run_context (aucome.utils.RunContext): configuration of the run
+        stale_organisms (set): organisms with changed inputs or outputs, None for all the organisms
+        verbose (boolean): verbose
+        workspace_inventory (aucome.utils.WorkspaceInventory): inventory of the run, updated after the deletion
+        rerun_orthofinder (boolean): for the orthology step, delete the OrthoFinder results even if the proteomes did not change
+    """
+    step_data = WORKFLOW_STEP_DATA[step_name]
+    organisms = set(next(os.walk(run_context.studied_organisms_path))[1])
+    if verbose:
+        print('Rerun ' + step_name + ' step for: ' + (', '.join(sorted(stale_organisms)) if stale_organisms is not None else 'all the organisms'))
+    for folder_key in step_data['to_clean']:
+        folder_path = getattr(run_context, folder_key)
+        if not os.path.isdir(folder_path):
+            continue
+        for entry_name in os.listdir(folder_path):
+            if step_data['by_organism'] and stale_organisms is not None \
+                and organism_of_entry(entry_name, organisms, run_context.study_from_annot_prefix) not in stale_organisms:
+                continue
+            entry_path = os.path.join(folder_path, entry_name)
+            if verbose:
+                print('Delete ' + entry_path)
+            if os.path.isdir(entry_path):
+                shutil.rmtree(entry_path)
+            else:
+                os.remove(entry_path)
+        if workspace_inventory:
+            workspace_inventory.refresh(folder_path)
+
+    if step_name == 'orthology':
+        clean_orthofinder_results(run_context, organisms, verbose, workspace_inventory, rerun_orthofinder)
+
+
+def clean_orthofinder_results(run_context, organisms, verbose, workspace_inventory=None, rerun_orthofinder=False):
+    """Delete the OrthoFinder results if the proteomes given to OrthoFinder (copied in orthofinder_wd_path) are not the
+    proteomes of the studied organisms anymore. run_orthology reuses the OrthoFinder results of the organisms already analysed,
+    so OrthoFinder is run again on all the proteomes.
+
+    Args:
+        run_context (aucome.utils.RunContext): configuration of the run
+        organisms (set): names of the studied organisms
+        verbose (boolean): verbose
+        workspace_inventory (aucome.utils.WorkspaceInventory): inventory of the run, updated after the deletion
+        rerun_orthofinder (boolean): delete the OrthoFinder results even if the proteomes did not change (like for a new sequence search program)
+    """
+    orthofinder_wd_path = run_context.orthofinder_wd_path
+    if not os.path.isdir(orthofinder_wd_path):
+        return
+    analysed_faa_files = [faa_file for faa_file in os.listdir(orthofinder_wd_path)
+                          if faa_file.endswith('.faa') and os.path.isfile(os.path.join(orthofinder_wd_path, faa_file))]
+    changed_proteomes = []
+    for faa_file in analysed_faa_files:
+        organism = faa_file[:-len('.faa')]
+        studied_faa = os.path.join(run_context.studied_organisms_path, organism, faa_file)
+        if organism in organisms and os.path.isfile(studied_faa) and filecmp.cmp(studied_faa, os.path.join(orthofinder_wd_path, faa_file), shallow=False):
+            continue
+        changed_proteomes.append(organism)
+    if not changed_proteomes and not rerun_orthofinder:
+        return
+
+    if verbose and changed_proteomes:
+        print('Proteomes changed since the OrthoFinder run: ' + ', '.join(sorted(changed_proteomes)) + ', OrthoFinder will be run again')
+    elif verbose:
+        print('Parameters of OrthoFinder changed, OrthoFinder will be run again')
+    for entry_name in ['OrthoFinder', 'orthologue_cache'] + analysed_faa_files:
+        entry_path = os.path.join(orthofinder_wd_path, entry_name)
+        if verbose and os.path.exists(entry_path):
+            print('Delete ' + entry_path)
+        if os.path.isdir(entry_path):
+            shutil.rmtree(entry_path)
+        elif os.path.exists(entry_path):
+            os.remove(entry_path)
+    if workspace_inventory:
+        workspace_inventory.refresh(orthofinder_wd_path)
@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the orthology propagation and filtering functions on synthetic data.
+It runs offline: the OrthoFinder Orthologues files, the annotation networks (padmet and sbml) and the database are generated, no external tool is needed.
+
+usage:
+    benchmark_orthology.py [--organisms=INT] [--genes=INT] [--reactions=INT] [--repeat=INT] [--cpu=INT] [--threshold=FLOAT] [--seed=INT] [--output=FILE] [--keep=DIR]
+
+options:
+    --organisms=INT    Number of organisms. [default: 20]
+    --genes=INT    Number of genes by organism. [default: 2000]
+    --reactions=INT    Number of reactions. [default: 1000]
+    --repeat=INT    Number of runs of each function, the minimum and the median times are reported. [default: 3]
+    --cpu=INT    Number of cpu of the pool used by the functions. [default: 1]
+    --threshold=FLOAT    Threshold of the filtering. [default: 0.05]
+    --seed=INT    Seed of the random generation of the data. [default: 1]
+    --output=FILE    Write the times in a json file (to track them between versions).
+    --keep=DIR    Generate the data in this folder and keep it (by default in a temporary folder deleted at the end).
+"""
+
+import docopt
+import json
+import os
+import random
+import shutil
+import statistics
+import tempfile
+import time
+
+from padmet.classes import PadmetRef, PadmetSpec
+from padmet.classes.node import Node
+from padmet.classes.policy import Policy
+from padmet.classes.relation import Relation
+from padmet.utils.connection import extract_orthofinder, sbmlGenerator
+
+from aucome.orthologue_cache import get_orthologue_cache
+from aucome.orthology import create_model_store, orthology_organism, extractRGL, extractPropagation, \
+                             extractPropagationToRemove, cleanPadmet
+from aucome.utils import create_aucome_pool
+
+PADMET_POLICY = [['reaction', 'consumes', 'compound', 'STOICHIOMETRY', 'X', 'COMPARTMENT', 'Y'], ['reaction', 'produces', 'compound', 'STOICHIOMETRY', 'X', 'COMPARTMENT', 'Y'],
+                 ['reaction', 'is_linked_to', 'gene', 'SOURCE:ASSIGNMENT', 'X:Y'], ['reaction', 'has_suppData', 'suppData'],
+                 ['reaction', 'has_reconstructionData', 'reconstructionData']]
+PADMET_INFO = {'DB_info': {'DB': 'benchmark', 'version': '1'}}
+
+
+def create_orthologues(orthodata_path, organisms, organism_genes):
+    """Write the OrthoFinder Orthologues_<org>/<org>__v__<other_org>.tsv files.
+    The gene i of each organism is in the orthogroup OGi, some orthogroups have two genes in an organism (paralogs).
+
+    Args:
+        orthodata_path (str): path to the Orthologues folder
+        organisms (list): organism names
+        organism_genes (dict): k = organism, v = dict: k = orthogroup index, v = list of genes of the organism in the orthogroup
+    """
+    for org_A in organisms:
+        org_A_path = os.path.join(orthodata_path, 'Orthologues_' + org_A)
+        os.makedirs(org_A_path)
+        for org_B in organisms:
+            if org_A == org_B:
+                continue
+            with open(os.path.join(org_A_path, org_A + '__v__' + org_B + '.tsv'), 'w') as orthologue_file:
+                orthologue_file.write('Orthogroup\t' + org_A + '\t' + org_B + '\n')
+                for orthogroup_index, genes_A in organism_genes[org_A].items():
+                    genes_B = organism_genes[org_B].get(orthogroup_index)
+                    if genes_B:
+                        orthologue_file.write('OG' + str(orthogroup_index) + '\t' + ', '.join(genes_A) + '\t' + ', '.join(genes_B) + '\n')
+
+
+def create_annotation_networks(run_path, database_path, organisms, organism_genes, nb_reactions, random_generator):
+    """Write the annotation padmets and sbml of the organisms (as created by the reconstruction step) and the database.
+    A reaction is linked to the genes of one orthogroup, it is annotated (GENOME source) in some of the organisms having a gene in the orthogroup.
+    Half of the reactions are in the database.
+
+    Args:
+        run_path (str): path to the run folder (the networks are written in annotation_based)
+        database_path (str): path to the database padmet
+        organisms (list): organism names
+        organism_genes (dict): k = organism, v = dict: k = orthogroup index, v = list of genes of the organism in the orthogroup
+        nb_reactions (int): number of reactions
+        random_generator (random.Random): random generator
+    """
+    padmetRef = PadmetRef()
+    padmetRef.policy = Policy(PADMET_POLICY)
+    padmetRef.info = PADMET_INFO
+    padmets = {}
+    for organism in organisms:
+        padmet = PadmetSpec()
+        padmet.policy = Policy(PADMET_POLICY)
+        padmet.info = PADMET_INFO
+        padmets[organism] = padmet
+
+    nb_orthogroups = len(organism_genes[organisms[0]])
+    for rxn_index in range(nb_reactions):
+        rxn_id = 'RXN-' + str(rxn_index)
+        orthogroup_index = random_generator.randrange(nb_orthogroups)
+        organisms_with_genes = [organism for organism in organisms if orthogroup_index in organism_genes[organism]]
+        if not organisms_with_genes:
+            continue
+        # Most reactions are annotated in few organisms.
+        nb_annotations = min(len(organisms_with_genes), 1 + int(random_generator.expovariate(1 / 3)))
+        annotated_organisms = random_generator.sample(organisms_with_genes, nb_annotations)
+        network_padmets = [padmets[organism] for organism in annotated_organisms]
+        if rxn_index % 2 == 0:
+            network_padmets.append(padmetRef)
+        for padmet in network_padmets:
+            padmet.dicOfNode[rxn_id] = Node('reaction', rxn_id, {'DIRECTION': ['LEFT-TO-RIGHT'], 'EC-NUMBER': ['EC-1.1.1.' + str(rxn_index)]})
+            for compound_id, relation_type in [('C-' + str(rxn_index), 'consumes'), ('C-' + str(rxn_index + 1), 'produces')]:
+                if compound_id not in padmet.dicOfNode:
+                    padmet.dicOfNode[compound_id] = Node('compound', compound_id)
+                padmet._addRelation(Relation(rxn_id, relation_type, compound_id, {'STOICHIOMETRY': ['1'], 'COMPARTMENT': ['c']}))
+        for organism in annotated_organisms:
+            padmet = padmets[organism]
+            for gene_id in organism_genes[organism][orthogroup_index]:
+                if gene_id not in padmet.dicOfNode:
+                    padmet.dicOfNode[gene_id] = Node('gene', gene_id)
+                padmet._addRelation(Relation(rxn_id, 'is_linked_to', gene_id, {'SOURCE:ASSIGNMENT': ['GENOME:' + organism]}))
+
+    padmetRef.generateFile(database_path)
+    for organism, padmet in padmets.items():
+        padmet_path = os.path.join(run_path, 'annotation_based', 'PADMETs', 'output_pathwaytools_' + organism + '.padmet')
+        padmet.generateFile(padmet_path)
+        sbmlGenerator.padmet_to_sbml(padmet=padmet_path, output=os.path.join(run_path, 'annotation_based', 'SBMLs', 'output_pathwaytools_' + organism + '.sbml'),
+                                     sbml_lvl=3, verbose=False)
+
+
+def create_benchmark_data(benchmark_path, nb_organisms, nb_genes, nb_reactions, seed):
+    """Create the synthetic Orthologues folder, annotation networks and database.
+
+    Args:
+        benchmark_path (str): path to the output folder
+        nb_organisms (int): number of organisms
+        nb_genes (int): number of genes by organism
+        nb_reactions (int): number of reactions
+        seed (int): seed of the random generator
+    Returns:
+        dict: paths to the Orthologues folder (orthodata_path), to the run folder with the annotation networks (run_path) and to the database (database_path)
+    """
+    random_generator = random.Random(seed)
+    organisms = ['org' + str(org_index) for org_index in range(nb_organisms)]
+    organism_genes = {}
+    for organism in organisms:
+        organism_genes[organism] = {}
+        for gene_index in range(nb_genes):
+            # Some genes have no orthologue in this organism, some have a paralog.
+            if random_generator.random() < 0.1:
+                continue
+            genes = [organism + '_g' + str(gene_index)]
+            if random_generator.random() < 0.05:
+                genes.append(organism + '_g' + str(gene_index) + 'b')
+            organism_genes[organism][gene_index] = genes
+
+    orthodata_path = os.path.join(benchmark_path, 'Orthologues')
+    run_path = os.path.join(benchmark_path, 'run')
+    database_path = os.path.join(benchmark_path, 'database.padmet')
+    os.makedirs(os.path.join(run_path, 'annotation_based', 'PADMETs'))
+    os.makedirs(os.path.join(run_path, 'annotation_based', 'SBMLs'))
+    create_orthologues(orthodata_path, organisms, organism_genes)
+    create_annotation_networks(run_path, database_path, organisms, organism_genes, nb_reactions, random_generator)
+
+    return {'orthodata_path': orthodata_path, 'run_path': run_path, 'database_path': database_path}
+
+
+def run_benchmark(benchmark_data, nb_repeat, nb_cpu_to_use, filtering_threshold):
+    """Time the orthology functions on the benchmark data.
+
+    Args:
+        benchmark_data (dict): paths from create_benchmark_data
+        nb_repeat (int): number of runs of each function
+        nb_cpu_to_use (int): number of cpu of the pool
+        filtering_threshold (float): threshold of the filtering
+    Returns:
+        dict: k = function name, v = list of times (in seconds)
+    """
+    orthodata_path = benchmark_data['orthodata_path']
+    run_path = benchmark_data['run_path']
+    benchmark_path = os.path.dirname(run_path)
+    orthologue_cache_path = os.path.join(benchmark_path, 'orthologue_cache')
+    model_store_path = os.path.join(benchmark_path, 'Orthologues_models')
+    model_ids = sorted([folder_name.replace('Orthologues_', '') for folder_name in os.listdir(orthodata_path)])
+    all_model_sbml = extract_orthofinder.get_sbml_files(run_path, workflow="aucome")
+    benchmark_times = {function_name: [] for function_name in ['get_orthologue_cache', 'create_model_store', 'orthology_organism', 'extractRGL', 'extractPropagation',
+                                                               'extractPropagationToRemove', 'cleanPadmet']}
+
+    aucome_pool = create_aucome_pool(nb_cpu_to_use)
+    try:
+        for repeat_index in range(nb_repeat):
+            repeat_padmet_folder = os.path.join(benchmark_path, 'padmet_' + str(repeat_index))
+            output_folder = os.path.join(benchmark_path, 'filtered_' + str(repeat_index))
+            os.makedirs(repeat_padmet_folder)
+            os.makedirs(output_folder)
+
+            # The cache is removed, so each run reads the orthologues files.
+            if os.path.exists(orthologue_cache_path):
+                shutil.rmtree(orthologue_cache_path)
+            start_time = time.perf_counter()
+            get_orthologue_cache(orthodata_path, orthologue_cache_path, aucome_pool)
+            benchmark_times['get_orthologue_cache'].append(time.perf_counter() - start_time)
+
+            start_time = time.perf_counter()
+            create_model_store(all_model_sbml, model_ids, model_store_path, aucome_pool)
+            benchmark_times['create_model_store'].append(time.perf_counter() - start_time)
+
+            start_time = time.perf_counter()
+            for study_name in model_ids:
+                orthology_organism({'study_name': study_name, 'model_ids': model_ids, 'all_model_sbml': all_model_sbml,
+                                    'model_store_path': model_store_path, 'orthologue_cache_path': orthologue_cache_path,
+                                    'input_pwt_padmet': os.path.join(run_path, 'annotation_based', 'PADMETs', 'output_pathwaytools_' + study_name + '.padmet'),
+                                    'database_path': benchmark_data['database_path'],
+                                    'output_padmet': os.path.join(repeat_padmet_folder, study_name + '.padmet'), 'output_sbml': None,
+                                    'verbose': False, 'veryverbose': False})
+            benchmark_times['orthology_organism'].append(time.perf_counter() - start_time)
+
+            start_time = time.perf_counter()
+            gene_links, dict_rxn_ec = extractRGL(repeat_padmet_folder, aucome_pool)
+            benchmark_times['extractRGL'].append(time.perf_counter() - start_time)
+
+            start_time = time.perf_counter()
+            propagation = extractPropagation(gene_links)
+            benchmark_times['extractPropagation'].append(time.perf_counter() - start_time)
+
+            start_time = time.perf_counter()
+            propagation_to_remove = extractPropagationToRemove(propagation,
+                                                               output=os.path.join(output_folder, 'propagation_to_remove.tsv'),
+                                                               orthology_threshold_list=[filtering_threshold])
+            benchmark_times['extractPropagationToRemove'].append(time.perf_counter() - start_time)
+
+            start_time = time.perf_counter()
+            cleanPadmet(propagation_to_remove, dict_rxn_ec, gene_links, repeat_padmet_folder,
+                        output_folder, os.path.join(benchmark_path, 'reactions_to_remove_' + str(repeat_index) + '.tsv'), aucome_pool)
+            benchmark_times['cleanPadmet'].append(time.perf_counter() - start_time)
+    finally:
+        aucome_pool.close()
+        aucome_pool.join()
+
+    return benchmark_times
+
+
+def main():
+    args = docopt.docopt(__doc__)
+    nb_organisms = int(args['--organisms'])
+    nb_genes = int(args['--genes'])
+    nb_reactions = int(args['--reactions'])
+    nb_repeat = int(args['--repeat'])
+    nb_cpu_to_use = int(args['--cpu'])
+    filtering_threshold = float(args['--threshold'])
+    seed = int(args['--seed'])
+
+    if args['--keep']:
+        benchmark_path = args['--keep']
+        os.makedirs(benchmark_path)
+    else:
+        benchmark_path = tempfile.mkdtemp(prefix='aucome_benchmark_')
+
+    try:
+        start_time = time.perf_counter()
+        benchmark_data = create_benchmark_data(benchmark_path, nb_organisms, nb_genes, nb_reactions, seed)
+        print('Data generated in %.3fs: %s organisms, %s genes, %s reactions' %(time.perf_counter() - start_time, nb_organisms, nb_genes, nb_reactions))
+
+        benchmark_times = run_benchmark(benchmark_data, nb_repeat, nb_cpu_to_use, filtering_threshold)
+    finally:
+        if not args['--keep']:
+            shutil.rmtree(benchmark_path)
+
+    print('%-28s %10s %10s' %('function', 'min (s)', 'median (s)'))
+    for function_name, function_times in benchmark_times.items():
+        print('%-28s %10.3f %10.3f' %(function_name, min(function_times), statistics.median(function_times)))
+
+    if args['--output']:
+        benchmark_result = {'parameters': {'organisms': nb_organisms, 'genes': nb_genes, 'reactions': nb_reactions,
+                                           'repeat': nb_repeat, 'cpu': nb_cpu_to_use, 'threshold': filtering_threshold, 'seed': seed},
+                            'times': benchmark_times}
+        with open(args['--output'], 'w') as output_file:
+            json.dump(benchmark_result, output_file, indent=4)
+
+
+if __name__ == '__main__':
+    main()
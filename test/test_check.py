@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import glob
+import os
+import pytest
+
+from multiprocessing.pool import ThreadPool
+
+from Bio import SeqIO
+
+from padmet.utils.connection import gbk_to_faa
+
+from aucome import check
+from aucome.check import INVALID_CHARACTERS, checking_genbank, genbank_chunks, genbank_to_faa, load_genbank_scan, scan_genbank
+
+TEST_GENBANKS = glob.glob(os.path.join(os.path.dirname(__file__), 'data', '*.gbk'))
+
+WRAPPED_GENBANK = """LOCUS       contig_1                 120 bp    DNA     linear   UNK 01-JAN-2020
+DEFINITION  Test contig.
+ACCESSION   contig_1
+VERSION     contig_1.1
+KEYWORDS    .
+SOURCE      Test organism
+  ORGANISM  Test organism
+            Unclassified.
+FEATURES             Location/Qualifiers
+     source          1..120
+                     /organism="Test organism"
+     gene            1..30
+                     /locus_tag="gene_with_a_very_long_locus_tag_wrapped_on
+                     two_lines"
+     CDS             1..30
+                     /locus_tag="gene_with_a_very_long_locus_tag_wrapped_on
+                     two_lines"
+                     /translation="MKVLAAGIKR"
+     gene            31..60
+                     /locus_tag="gene|2"
+     CDS             31..60
+                     /locus_tag="gene|2"
+                     /translation="MKVL.AGIKR"
+     gene            61..90
+                     /locus_tag="gene_3"
+     CDS             61..90
+                     /locus_tag="gene_3"
+                     /translation="MKVLAAGIKRMKVLAAGIKRMKVLAAGIKRMKVLAAGIKRMKVLAAGIKRMKVLAAGIKRMK
+                     VLAAGIKR"
+ORIGIN
+        1 atgaaagtgc tggcggcggg cattaaacgc atgaaagtgc tggcggcggg cattaaacgc
+       61 atgaaagtgc tggcggcggg cattaaacgc atgaaagtgc tggcggcggg cattaaacgc
+//
+"""
+
+ISOFORM_GENBANK = """LOCUS       contig_1                 120 bp    DNA     linear   UNK 01-JAN-2020
+DEFINITION  Test contig.
+ACCESSION   contig_1
+VERSION     contig_1.1
+KEYWORDS    .
+SOURCE      Test organism
+  ORGANISM  Test organism
+            Unclassified.
+FEATURES             Location/Qualifiers
+     source          1..120
+                     /organism="Test organism"
+     CDS             1..30
+                     /locus_tag="gene_1"
+     CDS             1..30
+                     /locus_tag="gene_2"
+                     /translation="MKVLAAGIKR"
+     CDS             1..60
+                     /locus_tag="gene_2"
+     CDS             1..90
+                     /locus_tag="gene_2"
+                     /translation="MKVLAAGIKRMKVLAAGIKR"
+     CDS             31..60
+                     /locus_tag="gene_1"
+                     /translation="MKVLAAGIKR"
+ORIGIN
+        1 atgaaagtgc tggcggcggg cattaaacgc atgaaagtgc tggcggcggg cattaaacgc
+       61 atgaaagtgc tggcggcggg cattaaacgc atgaaagtgc tggcggcggg cattaaacgc
+//
+"""
+
+
+def biopython_scan(genbank_path):
+    """Issues fixed by fix_genbank_file found with Biopython, as in the check before scan_genbank."""
+    genbank_scan = {'invalid_gene_ids': 0, 'non_utf8_ids': 0, 'too_long_ids': 0, 'fix_dot_protein_seq': False, 'number_genes': 0}
+    for record in SeqIO.parse(genbank_path, 'genbank'):
+        for feature in record.features:
+            if feature.type == 'gene':
+                genbank_scan['number_genes'] += 1
+            if 'locus_tag' in feature.qualifiers:
+                locus_tag = feature.qualifiers['locus_tag'][0]
+                if any(char in locus_tag for char in INVALID_CHARACTERS):
+                    genbank_scan['invalid_gene_ids'] += 1
+                if len(locus_tag) >= 40:
+                    genbank_scan['too_long_ids'] += 1
+            if 'translation' in feature.qualifiers and '.' in feature.qualifiers['translation'][0]:
+                genbank_scan['fix_dot_protein_seq'] = True
+    return genbank_scan
+
+
+def without_sha(genbank_scan):
+    return dict([(key, value) for key, value in genbank_scan.items() if key != 'sha256'])
+
+
+@pytest.mark.parametrize('genbank_path', TEST_GENBANKS)
+def test_scan_genbank(genbank_path):
+    assert without_sha(scan_genbank(genbank_path)) == biopython_scan(genbank_path)
+
+
+@pytest.mark.parametrize('genbank_path', TEST_GENBANKS)
+def test_scan_genbank_chunks(genbank_path):
+    genbank_scan = scan_genbank(genbank_path)
+    chunk_scans = [scan_genbank(genbank_path, start, end) for start, end in genbank_chunks(genbank_path, 64 * 1024)]
+    assert len(chunk_scans) > 1
+    assert sum([chunk_scan['number_genes'] for chunk_scan in chunk_scans]) == genbank_scan['number_genes']
+    assert sum([chunk_scan['invalid_gene_ids'] for chunk_scan in chunk_scans]) == genbank_scan['invalid_gene_ids']
+    assert sum([chunk_scan['too_long_ids'] for chunk_scan in chunk_scans]) == genbank_scan['too_long_ids']
+
+
+def test_scan_genbank_wrapped_locus_tag(tmp_path):
+    genbank_path = str(tmp_path / 'contig.gbk')
+    with open(genbank_path, 'w') as genbank_file:
+        genbank_file.write(WRAPPED_GENBANK)
+
+    genbank_scan = scan_genbank(genbank_path)
+    assert without_sha(genbank_scan) == biopython_scan(genbank_path)
+    assert without_sha(genbank_scan) == {'invalid_gene_ids': 4, 'non_utf8_ids': 0, 'too_long_ids': 2, 'fix_dot_protein_seq': True, 'number_genes': 3}
+
+
+@pytest.mark.parametrize('chunk_size', [None, 512])
+def test_checking_genbank_latin1(tmp_path, monkeypatch, chunk_size):
+    studied_organisms_path = str(tmp_path / 'studied_organisms')
+    genbank_folder = os.path.join(studied_organisms_path, 'contig')
+    os.makedirs(genbank_folder)
+    genbank_path = os.path.join(genbank_folder, 'contig.gbk')
+    # A latin-1 character in the definition and in a locus_tag.
+    with open(genbank_path, 'wb') as genbank_file:
+        genbank_file.write(WRAPPED_GENBANK.replace('Test contig.', 'Test contig of Sa\xf4ne.').replace('gene_3', 'g\xe8ne_3').encode('latin-1'))
+
+    # The locus_tag which is not utf-8 is invalid, the genbank is renamed.
+    genbank_scan = scan_genbank(genbank_path)
+    assert without_sha(genbank_scan) == {'invalid_gene_ids': 6, 'non_utf8_ids': 2, 'too_long_ids': 2, 'fix_dot_protein_seq': True, 'number_genes': 3}
+
+    aucome_pool = None
+    if chunk_size:
+        # The genbank is checked by chunks.
+        monkeypatch.setattr(check, 'GENBANK_CHUNK_SIZE', chunk_size)
+        aucome_pool = ThreadPool(2)
+    faa_path = os.path.join(genbank_folder, 'contig.faa')
+    try:
+        checking_genbank('contig', studied_organisms_path, False, faa_path, aucome_pool)
+    finally:
+        if aucome_pool:
+            aucome_pool.close()
+
+    faa_records = list(SeqIO.parse(faa_path, 'fasta'))
+    assert [record.id for record in faa_records] == ['contig_1_1_1', 'contig_1_1_2', 'contig_1_1_3']
+    assert [str(record.seq) for record in faa_records] == ['MKVLAAGIKR', 'MKVLAGIKR', 'MKVLAAGIKR' * 7]
+    with open(os.path.join(genbank_folder, 'contig_dict.csv'), 'rb') as mapping_file:
+        assert b'g\xe8ne_3\tcontig_1_1_3' in mapping_file.read()
+    # The other bytes which are not utf-8 are kept in the renamed genbank.
+    with open(genbank_path, 'rb') as genbank_file:
+        genbank_text = genbank_file.read()
+    assert b'Sa\xf4ne' in genbank_text
+    assert b'/old_locus_tag="g\xe8ne_3"' in genbank_text
+    assert b'/locus_tag="contig_1_1_3"' in genbank_text
+
+    # The faa of the renamed genbank is the same with and without chunks.
+    faa_from_renamed_path = os.path.join(genbank_folder, 'contig_renamed.faa')
+    with ThreadPool(2) as chunk_pool:
+        monkeypatch.setattr(check, 'GENBANK_CHUNK_SIZE', 512)
+        genbank_to_faa(genbank_path, faa_from_renamed_path, False, chunk_pool)
+    with open(faa_path) as faa_file, open(faa_from_renamed_path) as faa_from_renamed_file:
+        assert faa_file.read() == faa_from_renamed_file.read()
+
+
+def test_genbank_to_faa_isoforms(tmp_path):
+    genbank_path = str(tmp_path / 'contig.gbk')
+    with open(genbank_path, 'w') as genbank_file:
+        genbank_file.write(ISOFORM_GENBANK)
+    faa_path = str(tmp_path / 'contig.faa')
+    padmet_faa_path = str(tmp_path / 'contig_padmet.faa')
+
+    genbank_to_faa(genbank_path, faa_path, False)
+    gbk_to_faa.gbk_to_faa(genbank_path, padmet_faa_path, verbose=False)
+    # The CDS of gene_2 without translation counts as an isoform, like in padmet.
+    assert [record.id for record in SeqIO.parse(faa_path, 'fasta')] == ['gene_2', 'gene_2_isoform3', 'gene_1']
+    with open(faa_path) as faa_file, open(padmet_faa_path) as padmet_faa_file:
+        assert faa_file.read() == padmet_faa_file.read()
+
+
+def test_load_genbank_scan_cache(tmp_path):
+    genbank_path = str(tmp_path / 'contig.gbk')
+    with open(genbank_path, 'w') as genbank_file:
+        genbank_file.write(WRAPPED_GENBANK)
+    cache_path = str(tmp_path / 'cache' / 'genbank_scan')
+
+    genbank_scan = load_genbank_scan(genbank_path, cache_path=cache_path)
+    assert os.listdir(cache_path) == ['contig.json']
+    assert load_genbank_scan(genbank_path, cache_path=cache_path) == genbank_scan
+
+    # The genbank changed: it is scanned again.
+    with open(genbank_path, 'w') as genbank_file:
+        genbank_file.write(WRAPPED_GENBANK.replace('gene|2', 'gene_two'))
+    assert load_genbank_scan(genbank_path, cache_path=cache_path)['invalid_gene_ids'] == 2
+
+    # Without cache_path, nothing is written.
+    load_genbank_scan(genbank_path)
+    assert os.listdir(cache_path) == ['contig.json']
@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import csv
+import libsbml
+import os
+import pytest
+
+from padmet.classes import PadmetRef, PadmetSpec
+from padmet.classes.node import Node
+from padmet.classes.policy import Policy
+from padmet.classes.relation import Relation
+
+from aucome.orthologue_cache import get_orthologue_cache
+from aucome.orthology import create_model_store, filter_propagation, orthology_organism
+from aucome.utils import create_aucome_pool
+
+from benchmark_orthology import PADMET_POLICY, PADMET_INFO
+
+# Gene-reaction relations of the orthology padmets, k = organism, v = dict: k = reaction, v = dict: k = gene, v = SOURCE:ASSIGNMENT.
+# RXN-1 is annotated in A and propagated to B, C and D, it is also annotated with another gene in C.
+# RXN-2 is annotated in A and B, B also has it by orthology from A, so its propagations are kept.
+# RXN-3 is annotated in A and D, propagated from A to B and C, and from D to C.
+# RXN-4 is annotated with two genes of A, a4 is propagated to B, C and D, a4b only to B.
+ORTHOLOGY_NETWORKS = {
+    'A': {'RXN-1': {'a1': ['GENOME:A']},
+          'RXN-2': {'a2': ['GENOME:A']},
+          'RXN-3': {'a3': ['GENOME:A']},
+          'RXN-4': {'a4': ['GENOME:A'], 'a4b': ['GENOME:A']}},
+    'B': {'RXN-1': {'b1': ['OUTPUT_ORTHOFINDER_FROM_A:a1']},
+          'RXN-2': {'b2': ['GENOME:B', 'OUTPUT_ORTHOFINDER_FROM_A:a2']},
+          'RXN-3': {'b3': ['OUTPUT_ORTHOFINDER_FROM_A:a3']},
+          'RXN-4': {'b4': ['OUTPUT_ORTHOFINDER_FROM_A:a4;a4b']}},
+    'C': {'RXN-1': {'c1': ['OUTPUT_ORTHOFINDER_FROM_A:a1'], 'c1b': ['GENOME:C']},
+          'RXN-2': {'c2': ['OUTPUT_ORTHOFINDER_FROM_A:a2']},
+          'RXN-3': {'c3': ['OUTPUT_ORTHOFINDER_FROM_A:a3', 'OUTPUT_ORTHOFINDER_FROM_D:d3']},
+          'RXN-4': {'c4': ['OUTPUT_ORTHOFINDER_FROM_A:a4']}},
+    'D': {'RXN-1': {'d1': ['OUTPUT_ORTHOFINDER_FROM_A:a1']},
+          'RXN-3': {'d3': ['GENOME:D']},
+          'RXN-4': {'d4': ['OUTPUT_ORTHOFINDER_FROM_A:a4']}},
+}
+
+
+# Reactions of the model sbml: reaction ID, name, reversible, reactants, products (coded species IDs) and gene association.
+MODEL_REACTIONS = {
+    'M1': [('R_RXN__45__1', 'reaction 1', False, ['M_CPD__45__1_c'], ['M_CPD__45__2_c'], 'm1_a'),
+           ('R_RXN__45__2', 'reaction 2', True, ['M_CPD__45__2_c'], ['M_NEW__45__CPD_c'], '(m1_b and m1_c) or m1_d'),
+           ('R_RXN__45__3', 'reaction 3', False, ['M_CPD__45__1_c'], ['M_NEW__45__CPD_c'], 'm1_e'),
+           ('R_RXN__45__4', 'reaction 4', False, ['M_CPD__45__1_c'], ['M_CPD__45__2_c'], None),
+           ('R_RXN__45__S', 'reaction S', False, ['M_CPD__45__1_c'], ['M_CPD__45__2_c'], 'm1_a')],
+    'M2': [('R_RXN__45__1', 'reaction 1', False, ['M_CPD__45__1_c'], ['M_CPD__45__2_c'], 'm2_a')],
+}
+# OrthoFinder orthologues files, k = (org_A, org_B), v = rows (genes of org_A, genes of org_B).
+# m1_d and m1_e have no orthologue in S, m2_a has two orthologues in S.
+ORTHOLOGUES = {
+    ('M1', 'S'): [('m1_a', 's_a'), ('m1_b', 's_b'), ('m1_c', 's_c')],
+    ('S', 'M1'): [('s_a', 'm1_a'), ('s_b', 'm1_b'), ('s_c', 'm1_c')],
+    ('M2', 'S'): [('m2_a', 's_a, s_a2')],
+    ('S', 'M2'): [('s_a, s_a2', 'm2_a')],
+    ('M1', 'M2'): [('m1_a', 'm2_a')],
+    ('M2', 'M1'): [('m2_a', 'm1_a')],
+}
+
+
+def write_model_sbml(sbml_path, model_reactions):
+    species_ids = sorted(set([species_id for reaction in model_reactions for species_id in reaction[3] + reaction[4]]))
+    with open(sbml_path, 'w') as sbml_file:
+        sbml_file.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                        '<sbml xmlns="http://www.sbml.org/sbml/level3/version1/core" level="3" version="1">\n'
+                        '  <model id="model">\n'
+                        '    <listOfCompartments>\n'
+                        '      <compartment id="c" name="cytosol" size="1" constant="true"/>\n'
+                        '    </listOfCompartments>\n'
+                        '    <listOfSpecies>\n')
+        for species_id in species_ids:
+            sbml_file.write('      <species id="%s" name="%s" compartment="c" initialAmount="0" hasOnlySubstanceUnits="false" '
+                            'boundaryCondition="false" constant="false"/>\n' %(species_id, species_id[2:-2].lower()))
+        sbml_file.write('    </listOfSpecies>\n'
+                        '    <listOfReactions>\n')
+        for rxn_id, rxn_name, reversible, reactants, products, gene_association in model_reactions:
+            sbml_file.write('      <reaction id="%s" name="%s" reversible="%s" fast="false">\n' %(rxn_id, rxn_name, str(reversible).lower()))
+            if gene_association:
+                sbml_file.write('        <notes>\n'
+                                '          <body xmlns="http://www.w3.org/1999/xhtml">\n'
+                                '            <p>GENE_ASSOCIATION: %s</p>\n'
+                                '          </body>\n'
+                                '        </notes>\n' %gene_association)
+            for list_name, species_references in [('listOfReactants', reactants), ('listOfProducts', products)]:
+                sbml_file.write('        <%s>\n' %list_name)
+                for species_id in species_references:
+                    sbml_file.write('          <speciesReference species="%s" stoichiometry="1" constant="false"/>\n' %species_id)
+                sbml_file.write('        </%s>\n' %list_name)
+            sbml_file.write('      </reaction>\n')
+        sbml_file.write('    </listOfReactions>\n'
+                        '  </model>\n'
+                        '</sbml>\n')
+
+
+def create_padmet(nodes, relations, padmet_path, padmet_type=PadmetSpec):
+    padmet = padmet_type()
+    padmet.policy = Policy(PADMET_POLICY)
+    padmet.info = PADMET_INFO
+    for node in nodes:
+        padmet.dicOfNode[node.id] = node
+    for relation in relations:
+        padmet._addRelation(relation)
+    padmet.generateFile(padmet_path)
+
+
+def write_orthology_networks(padmet_folder):
+    for organism, organism_reactions in ORTHOLOGY_NETWORKS.items():
+        nodes = []
+        relations = []
+        for rxn_id, rxn_genes in organism_reactions.items():
+            nodes.append(Node('reaction', rxn_id, {'DIRECTION': ['LEFT-TO-RIGHT'], 'EC-NUMBER': ['EC-1.1.1.' + rxn_id[-1]]}))
+            for gene_id, sources in rxn_genes.items():
+                nodes.append(Node('gene', gene_id))
+                relations.append(Relation(rxn_id, 'is_linked_to', gene_id, {'SOURCE:ASSIGNMENT': list(sources)}))
+        create_padmet(nodes, relations, os.path.join(padmet_folder, organism + '.padmet'))
+
+
+def read_tsv(tsv_path):
+    with open(tsv_path, 'r') as tsv_file:
+        return list(csv.DictReader(tsv_file, delimiter='\t'))
+
+
+def read_filtered_networks(output_folder):
+    """Gene-reaction relations of the filtered padmets, as ORTHOLOGY_NETWORKS."""
+    filtered_networks = {}
+    for organism in ORTHOLOGY_NETWORKS:
+        padmet = PadmetSpec(os.path.join(output_folder, organism + '.padmet'))
+        filtered_networks[organism] = {}
+        for node in padmet.dicOfNode.values():
+            if node.type == 'reaction':
+                filtered_networks[organism][node.id] = dict([(rlt.id_out, rlt.misc['SOURCE:ASSIGNMENT']) for rlt in padmet.dicOfRelationIn[node.id]
+                                                             if rlt.type == 'is_linked_to'])
+    return filtered_networks
+
+
+@pytest.fixture(scope='module')
+def aucome_pool():
+    aucome_pool = create_aucome_pool(2)
+    yield aucome_pool
+    aucome_pool.close()
+    aucome_pool.join()
+
+
+# Threshold of a propagation with 3 other organisms: round(max(1/threshold/3, threshold*3)) organisms without annotation receiving it.
+# 0.5 and 0.2: 2, 0.1: 3, 0.3 and 0.4: 1.
+@pytest.mark.parametrize('filtering_threshold_list, union, intersection, removed_propagations', [
+    ([0.5], None, None, {('RXN-1', 'A', 'a1'), ('RXN-3', 'A', 'a3'), ('RXN-4', 'A', 'a4')}),
+    ([0.1], None, None, {('RXN-1', 'A', 'a1'), ('RXN-4', 'A', 'a4')}),
+    ([0.1, 0.2, 0.3, 0.4, 0.5], True, None, {('RXN-1', 'A', 'a1'), ('RXN-3', 'A', 'a3'), ('RXN-3', 'D', 'd3'), ('RXN-4', 'A', 'a4'), ('RXN-4', 'A', 'a4b')}),
+    ([0.1, 0.2, 0.3, 0.4, 0.5], None, True, {('RXN-1', 'A', 'a1'), ('RXN-4', 'A', 'a4')}),
+])
+def test_filter_propagation(tmp_path, aucome_pool, filtering_threshold_list, union, intersection, removed_propagations):
+    padmet_folder = str(tmp_path / 'padmet_orthology')
+    output_folder = str(tmp_path / 'padmet_filtered')
+    os.makedirs(padmet_folder)
+    os.makedirs(output_folder)
+    write_orthology_networks(padmet_folder)
+
+    filter_propagation(padmet_folder, output_folder, aucome_pool, filtering_threshold_list, union, intersection)
+
+    # One line by reaction: one of its propagations to remove.
+    propagation_rows = read_tsv(os.path.join(output_folder, 'propagation_to_remove.tsv'))
+    assert sorted([row['reaction_id'] for row in propagation_rows]) == sorted(set([rxn_id for rxn_id, _org_id, _gene_id in removed_propagations]))
+    assert all([(row['reaction_id'], row['org_id'], row['gene_id']) in removed_propagations for row in propagation_rows])
+
+    # The sources of the removed propagations are deleted, then the relations and the reactions without source.
+    # As in the previous versions, all the sources of the relations of a reaction with removed propagations are written
+    # with the OUTPUT_ORTHOFINDER_FROM_ prefix, the GENOME sources too.
+    removed_rxn_ids = set([rxn_id for rxn_id, _org_id, _gene_id in removed_propagations])
+    expected_networks = {}
+    for organism, organism_reactions in ORTHOLOGY_NETWORKS.items():
+        expected_networks[organism] = {}
+        for rxn_id, rxn_genes in organism_reactions.items():
+            new_rxn_genes = {}
+            for gene_id, sources in rxn_genes.items():
+                new_sources = []
+                for source in sources:
+                    if rxn_id not in removed_rxn_ids:
+                        new_sources.append(source)
+                    elif source.startswith('OUTPUT_ORTHOFINDER_FROM_'):
+                        ortho_org_id, ortho_gene_ids = source.replace('OUTPUT_ORTHOFINDER_FROM_', '').split(':')
+                        ortho_gene_ids = [ortho_gene_id for ortho_gene_id in ortho_gene_ids.split(';') if (rxn_id, ortho_org_id, ortho_gene_id) not in removed_propagations]
+                        if ortho_gene_ids:
+                            new_sources.append('OUTPUT_ORTHOFINDER_FROM_' + ortho_org_id + ':' + ';'.join(ortho_gene_ids))
+                    else:
+                        new_sources.append('OUTPUT_ORTHOFINDER_FROM_' + source)
+                if new_sources:
+                    new_rxn_genes[gene_id] = new_sources
+            if new_rxn_genes:
+                expected_networks[organism][rxn_id] = new_rxn_genes
+    filtered_networks = read_filtered_networks(output_folder)
+    assert filtered_networks == expected_networks
+
+    reactions_to_remove = set([(organism, rxn_id, 'EC-1.1.1.' + rxn_id[-1], ';'.join(rxn_genes))
+                               for organism, organism_reactions in ORTHOLOGY_NETWORKS.items() for rxn_id, rxn_genes in organism_reactions.items()
+                               if rxn_id not in filtered_networks[organism]])
+    assert set([(row['org_id'], row['reaction_id'], row['ec-number'], row['gene_id'])
+                for row in read_tsv(os.path.join(output_folder, 'reactions_to_remove.tsv'))]) == reactions_to_remove
+
+
+def test_filter_propagation_cases(tmp_path, aucome_pool):
+    """The reactions left in the filtered padmets for the threshold 0.5, written explicitly."""
+    padmet_folder = str(tmp_path / 'padmet_orthology')
+    output_folder = str(tmp_path / 'padmet_filtered')
+    os.makedirs(padmet_folder)
+    os.makedirs(output_folder)
+    write_orthology_networks(padmet_folder)
+
+    filter_propagation(padmet_folder, output_folder, aucome_pool, [0.5])
+
+    filtered_networks = read_filtered_networks(output_folder)
+    assert filtered_networks['A'] == {'RXN-1': {'a1': ['OUTPUT_ORTHOFINDER_FROM_GENOME:A']},
+                                      'RXN-2': {'a2': ['GENOME:A']},
+                                      'RXN-3': {'a3': ['OUTPUT_ORTHOFINDER_FROM_GENOME:A']},
+                                      'RXN-4': {'a4': ['OUTPUT_ORTHOFINDER_FROM_GENOME:A'], 'a4b': ['OUTPUT_ORTHOFINDER_FROM_GENOME:A']}}
+    # b4 keeps the propagation of a4b, c3 the propagation of D, the relation of c1 is removed.
+    assert filtered_networks['B'] == {'RXN-2': {'b2': ['GENOME:B', 'OUTPUT_ORTHOFINDER_FROM_A:a2']},
+                                      'RXN-4': {'b4': ['OUTPUT_ORTHOFINDER_FROM_A:a4b']}}
+    assert filtered_networks['C'] == {'RXN-1': {'c1b': ['OUTPUT_ORTHOFINDER_FROM_GENOME:C']},
+                                      'RXN-2': {'c2': ['OUTPUT_ORTHOFINDER_FROM_A:a2']},
+                                      'RXN-3': {'c3': ['OUTPUT_ORTHOFINDER_FROM_D:d3']}}
+    assert filtered_networks['D'] == {'RXN-3': {'d3': ['OUTPUT_ORTHOFINDER_FROM_GENOME:D']}}
+    assert sorted([(row['org_id'], row['reaction_id']) for row in read_tsv(os.path.join(output_folder, 'reactions_to_remove.tsv'))]) == \
+        [('B', 'RXN-1'), ('B', 'RXN-3'), ('C', 'RXN-4'), ('D', 'RXN-1'), ('D', 'RXN-4')]
+
+
+def test_orthology_organism(tmp_path, aucome_pool):
+    orthodata_path = str(tmp_path / 'Orthologues')
+    for (org_A, org_B), rows in ORTHOLOGUES.items():
+        os.makedirs(os.path.join(orthodata_path, 'Orthologues_' + org_A), exist_ok=True)
+        with open(os.path.join(orthodata_path, 'Orthologues_' + org_A, org_A + '__v__' + org_B + '.tsv'), 'w') as orthologue_file:
+            orthologue_file.write('Orthogroup\t' + org_A + '\t' + org_B + '\n')
+            for row_index, (genes_A, genes_B) in enumerate(rows):
+                orthologue_file.write('OG' + str(row_index) + '\t' + genes_A + '\t' + genes_B + '\n')
+    all_model_sbml = {}
+    for model_id, model_reactions in MODEL_REACTIONS.items():
+        all_model_sbml[model_id] = str(tmp_path / (model_id + '.sbml'))
+        write_model_sbml(all_model_sbml[model_id], model_reactions)
+
+    # RXN-1 and its compounds are in the database, RXN-2 and NEW-CPD are not.
+    database_path = str(tmp_path / 'database.padmet')
+    create_padmet([Node('reaction', 'RXN-1', {'DIRECTION': ['LEFT-TO-RIGHT'], 'COMMON-NAME': ['database reaction 1'], 'EC-NUMBER': ['EC-1.1.1.1']}),
+                   Node('compound', 'CPD-1', {'COMMON-NAME': ['database compound 1']}),
+                   Node('compound', 'CPD-2', {'COMMON-NAME': ['database compound 2']})],
+                  [Relation('RXN-1', 'consumes', 'CPD-1', {'STOICHIOMETRY': ['1'], 'COMPARTMENT': ['c']}),
+                   Relation('RXN-1', 'produces', 'CPD-2', {'STOICHIOMETRY': ['1'], 'COMPARTMENT': ['c']})],
+                  database_path, PadmetRef)
+    # RXN-S is already in the annotation padmet of S, with s_a.
+    input_pwt_padmet = str(tmp_path / 'output_pathwaytools_S.padmet')
+    create_padmet([Node('reaction', 'RXN-S', {'DIRECTION': ['LEFT-TO-RIGHT']}), Node('gene', 's_a')],
+                  [Relation('RXN-S', 'is_linked_to', 's_a', {'SOURCE:ASSIGNMENT': ['GENOME:S']})],
+                  input_pwt_padmet)
+
+    orthologue_cache_path = str(tmp_path / 'orthologue_cache')
+    model_store_path = str(tmp_path / 'Orthologues_models')
+    model_ids = ['M1', 'M2', 'S']
+    get_orthologue_cache(orthodata_path, orthologue_cache_path, aucome_pool)
+    create_model_store(all_model_sbml, model_ids, model_store_path, aucome_pool)
+    output_padmet = str(tmp_path / 'S.padmet')
+    output_sbml = str(tmp_path / 'sbml_orthology' / 'S')
+    orthology_organism({'study_name': 'S', 'model_ids': model_ids, 'all_model_sbml': all_model_sbml, 'model_store_path': model_store_path,
+                        'orthologue_cache_path': orthologue_cache_path, 'input_pwt_padmet': input_pwt_padmet, 'database_path': database_path,
+                        'output_padmet': output_padmet, 'output_sbml': output_sbml, 'verbose': False, 'veryverbose': False})
+
+    padmet = PadmetSpec(output_padmet)
+    reactions = dict([(node.id, node) for node in padmet.dicOfNode.values() if node.type == 'reaction'])
+    # RXN-3 has no orthologue gene in S, RXN-4 has no gene association.
+    assert sorted(reactions) == ['RXN-1', 'RXN-2', 'RXN-S']
+
+    def relations(rxn_id, relation_type):
+        return dict([(rlt.id_out, rlt.misc) for rlt in padmet.dicOfRelationIn[rxn_id] if rlt.type == relation_type])
+
+    # RXN-1 is copied from the database, with its compounds.
+    assert reactions['RXN-1'].misc == {'DIRECTION': ['LEFT-TO-RIGHT'], 'COMMON-NAME': ['database reaction 1'], 'EC-NUMBER': ['EC-1.1.1.1']}
+    assert relations('RXN-1', 'consumes') == {'CPD-1': {'STOICHIOMETRY': ['1'], 'COMPARTMENT': ['c']}}
+    assert relations('RXN-1', 'produces') == {'CPD-2': {'STOICHIOMETRY': ['1'], 'COMPARTMENT': ['c']}}
+    assert padmet.dicOfNode['CPD-1'].misc == {'COMMON-NAME': ['database compound 1']}
+    # The orthologues of m2_a (s_a and s_a2) are both linked to RXN-1, s_a also by M1.
+    assert relations('RXN-1', 'is_linked_to') == {
+        's_a': {'SOURCE:ASSIGNMENT': ['OUTPUT_ORTHOFINDER_FROM_M1:m1_a', 'OUTPUT_ORTHOFINDER_FROM_M2:m2_a']},
+        's_a2': {'SOURCE:ASSIGNMENT': ['OUTPUT_ORTHOFINDER_FROM_M2:m2_a']}}
+    assert sorted(relations('RXN-1', 'has_reconstructionData')) == ['RXN-1_reconstructionData_OUTPUT_ORTHOFINDER_FROM_M1',
+                                                                     'RXN-1_reconstructionData_OUTPUT_ORTHOFINDER_FROM_M2']
+    assert padmet.dicOfNode['RXN-1_reconstructionData_OUTPUT_ORTHOFINDER_FROM_M1'].misc == {
+        'SOURCE': ['OUTPUT_ORTHOFINDER_FROM_M1'], 'TOOL': ['ORTHOFINDER'], 'CATEGORY': ['ORTHOLOGY']}
+    suppdata = padmet.dicOfNode['RXN-1_SuppData_OUTPUT_ORTHOFINDER_FROM_M1'].misc
+    assert suppdata['SOURCE'] == ['OUTPUT_ORTHOFINDER_FROM_M1']
+    assert suppdata['ORIGIN_ID'] == ['R_RXN__45__1']
+    assert suppdata['GENE_ASSOCIATION'] == [' (s_a)']
+
+    # RXN-2 is not in the database, it is created from the sbml of M1 with the subset of genes having orthologues.
+    assert reactions['RXN-2'].misc == {'DIRECTION': ['REVERSIBLE'], 'COMMON-NAME': ['reaction 2']}
+    assert relations('RXN-2', 'consumes') == {'CPD-2': {'STOICHIOMETRY': ['1.0'], 'COMPARTMENT': ['c']}}
+    assert relations('RXN-2', 'produces') == {'NEW-CPD': {'STOICHIOMETRY': ['1.0'], 'COMPARTMENT': ['c']}}
+    assert padmet.dicOfNode['NEW-CPD'].misc == {'COMMON-NAME': ['new__45__cpd']}
+    assert relations('RXN-2', 'is_linked_to') == {'s_b': {'SOURCE:ASSIGNMENT': ['OUTPUT_ORTHOFINDER_FROM_M1:m1_b']},
+                                                  's_c': {'SOURCE:ASSIGNMENT': ['OUTPUT_ORTHOFINDER_FROM_M1:m1_c']}}
+    assert padmet.dicOfNode['RXN-2_SuppData_OUTPUT_ORTHOFINDER_FROM_M1'].misc['GENE_ASSOCIATION'] in [[' (s_b and s_c)'], [' (s_c and s_b)']]
+
+    # RXN-S is already in the annotation padmet, the source of M1 is added to its relation.
+    assert reactions['RXN-S'].misc == {'DIRECTION': ['LEFT-TO-RIGHT']}
+    assert relations('RXN-S', 'is_linked_to') == {'s_a': {'SOURCE:ASSIGNMENT': ['GENOME:S', 'OUTPUT_ORTHOFINDER_FROM_M1:m1_a']}}
+
+    # The sbml of each model keeps its reactions with orthologues.
+    assert sorted(os.listdir(output_sbml)) == ['output_orthofinder_from_M1.sbml', 'output_orthofinder_from_M2.sbml']
+    document = libsbml.SBMLReader().readSBML(os.path.join(output_sbml, 'output_orthofinder_from_M1.sbml'))
+    assert sorted([rxn.id for rxn in document.getModel().getListOfReactions()]) == ['R_RXN__45__1', 'R_RXN__45__2', 'R_RXN__45__S']
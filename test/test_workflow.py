@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import pytest
+
+from aucome.__main__ import create_run
+from aucome.utils import get_run_context
+from aucome.workflow import load_manifest, run_workflow_steps
+
+
+def fake_orthology(run_context, organisms, orthofinder_runs, padmet_writes=None):
+    """Create the outputs of the orthology step as run_orthology does: OrthoFinder is only run
+    if there are no OrthoFinder results in orthofinder_wd_path and the padmets already existing are kept."""
+    orthofinder_wd_path = run_context.orthofinder_wd_path
+    if not os.path.exists(os.path.join(orthofinder_wd_path, 'OrthoFinder')):
+        orthofinder_runs.append(sorted(organisms))
+        for organism in organisms:
+            with open(os.path.join(run_context.studied_organisms_path, organism, organism + '.faa'), 'r') as studied_faa:
+                with open(os.path.join(orthofinder_wd_path, organism + '.faa'), 'w') as analysed_faa:
+                    analysed_faa.write(studied_faa.read())
+        os.makedirs(os.path.join(orthofinder_wd_path, 'OrthoFinder', 'Results_1', 'Orthologues'))
+        os.makedirs(os.path.join(orthofinder_wd_path, 'orthologue_cache'))
+    for organism in organisms:
+        output_padmet = os.path.join(run_context.orthofinder_padmet_path, organism + '.padmet')
+        if not os.path.exists(output_padmet):
+            with open(output_padmet, 'w') as padmet_file:
+                padmet_file.write(organism)
+            if padmet_writes is not None:
+                padmet_writes.append(organism)
+
+
+def create_test_run(tmp_path, organisms):
+    run_id = str(tmp_path / 'run')
+    create_run(run_id)
+    run_context = get_run_context(run_id)
+    for organism in organisms:
+        os.makedirs(os.path.join(run_context.studied_organisms_path, organism))
+        with open(os.path.join(run_context.studied_organisms_path, organism, organism + '.faa'), 'w') as faa_file:
+            faa_file.write('>' + organism + '_1\nMKV\n')
+    return run_context
+
+
+def test_workflow_resume_changed_proteome(tmp_path):
+    organisms = ['org_a', 'org_b']
+    run_context = create_test_run(tmp_path, organisms)
+
+    orthofinder_runs = []
+    step_functions = {'orthology': lambda aucome_pool: fake_orthology(run_context, organisms, orthofinder_runs)}
+    manifest_path = os.path.join(run_context.log_path, 'workflow_manifest.json')
+
+    def resume_orthology():
+        run_workflow_steps(['orthology'], step_functions, {'orthology': {}}, run_context, manifest_path,
+                           load_manifest(manifest_path), True, False, None)
+
+    resume_orthology()
+    assert orthofinder_runs == [organisms]
+
+    # Nothing changed: the step is skipped.
+    resume_orthology()
+    assert orthofinder_runs == [organisms]
+
+    # The proteome of org_a changed: the OrthoFinder results are deleted and OrthoFinder is run again.
+    with open(os.path.join(run_context.studied_organisms_path, 'org_a', 'org_a.faa'), 'w') as faa_file:
+        faa_file.write('>org_a_1\nMKVL\n')
+    resume_orthology()
+    assert orthofinder_runs == [organisms, organisms]
+    with open(os.path.join(run_context.orthofinder_wd_path, 'org_a.faa'), 'r') as analysed_faa:
+        assert analysed_faa.read() == '>org_a_1\nMKVL\n'
+    assert load_manifest(manifest_path)['steps']['orthology']['status'] == 'done'
+
+    # The annotation changed but not the proteomes: the OrthoFinder results are kept.
+    with open(os.path.join(run_context.padmet_from_annotation_path, 'output_pathwaytools_org_b.padmet'), 'w') as padmet_file:
+        padmet_file.write('org_b')
+    resume_orthology()
+    assert orthofinder_runs == [organisms, organisms]
+    assert os.path.exists(os.path.join(run_context.orthofinder_padmet_path, 'org_b.padmet'))
+
+
+@pytest.mark.parametrize('changed_input', ['parameters', 'database'])
+def test_workflow_resume_changed_shared_input(tmp_path, changed_input):
+    organisms = ['org_a', 'org_b']
+    run_context = create_test_run(tmp_path, organisms)
+    run_context = run_context._replace(database_path=str(tmp_path / 'metacyc.padmet'))
+    with open(run_context.database_path, 'w') as database_file:
+        database_file.write('database')
+
+    orthofinder_runs = []
+    padmet_writes = []
+    step_functions = {'orthology': lambda aucome_pool: fake_orthology(run_context, organisms, orthofinder_runs, padmet_writes)}
+    manifest_path = os.path.join(run_context.log_path, 'workflow_manifest.json')
+
+    def resume_orthology(step_parameters):
+        run_workflow_steps(['orthology'], step_functions, {'orthology': step_parameters}, run_context, manifest_path,
+                           load_manifest(manifest_path), True, False, None)
+
+    resume_orthology({'sequence_search_prg': 'diamond', 'union': False})
+    assert padmet_writes == organisms
+
+    # A parameter of the step or the padmet of reference changed: all the padmets are recreated.
+    if changed_input == 'parameters':
+        resume_orthology({'sequence_search_prg': 'diamond', 'union': True})
+    else:
+        with open(run_context.database_path, 'w') as database_file:
+            database_file.write('new database')
+        resume_orthology({'sequence_search_prg': 'diamond', 'union': False})
+    assert padmet_writes == organisms + organisms
+    # The proteomes and the sequence search program did not change: the OrthoFinder results are kept.
+    assert orthofinder_runs == [organisms]
+    assert load_manifest(manifest_path)['steps']['orthology']['status'] == 'done'
+
+    # A new sequence search program: OrthoFinder is run again.
+    resume_orthology({'sequence_search_prg': 'blast', 'union': False})
+    assert orthofinder_runs == [organisms, organisms]
+    assert padmet_writes == organisms + organisms + organisms
+
+
+def test_workflow_resume_interrupted_step(tmp_path):
+    organisms = ['org_a', 'org_b']
+    run_context = create_test_run(tmp_path, organisms)
+
+    orthofinder_runs = []
+    padmet_writes = []
+    manifest_path = os.path.join(run_context.log_path, 'workflow_manifest.json')
+
+    def interrupted_orthology(aucome_pool):
+        # The padmet of org_a is written partially.
+        with open(os.path.join(run_context.orthofinder_padmet_path, 'org_a.padmet'), 'w') as padmet_file:
+            padmet_file.write('org')
+        raise KeyboardInterrupt()
+
+    def resume_orthology(step_function):
+        run_workflow_steps(['orthology'], {'orthology': step_function}, {'orthology': {}}, run_context, manifest_path,
+                           load_manifest(manifest_path), True, False, None)
+
+    with pytest.raises(KeyboardInterrupt):
+        resume_orthology(interrupted_orthology)
+    assert load_manifest(manifest_path)['steps']['orthology']['status'] == 'failed'
+
+    # The step is rerun and the partial padmet (without recorded hash) is deleted.
+    resume_orthology(lambda aucome_pool: fake_orthology(run_context, organisms, orthofinder_runs, padmet_writes))
+    assert padmet_writes == organisms
+    with open(os.path.join(run_context.orthofinder_padmet_path, 'org_a.padmet'), 'r') as padmet_file:
+        assert padmet_file.read() == 'org_a'
+    assert load_manifest(manifest_path)['steps']['orthology']['status'] == 'done'